@@ -7,17 +7,56 @@ import time
 import uuid
 import socket
 import subprocess
-from typing import Dict, Any, Optional
-from dataclasses import dataclass
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
 from enum import Enum
 import logging
 
+from agent.core.metrics import (
+    DURATION_BUCKETS, SIZE_BUCKETS, Counter, Histogram, MetricsRegistry, MetricsServer
+)
+from agent.core.startup import StartupStages
+from agent.core.supervisor import LAG_BUCKETS, LoopLagProbe, TaskSupervisor
+from agent.networking.framing import (
+    FLAG_AU_END, FLAG_AU_START, FLAG_KEYFRAME, FLAG_PARAMETER_SETS, FLAG_SPOOLED,
+    pack_media_frame
+)
+from agent.networking.backoff import DecorrelatedJitterBackoff
+from agent.networking.coalescer import SendCoalescer
+from agent.networking.netlink import AddressMonitor, NetworkState, detect_primary_address
+from agent.networking.pacer import MediaPacer
+from agent.networking.scheduler import StreamScheduler, TokenBucket
+from agent.networking.tunnel_mux import ChannelHandler, TunnelMultiplexer
+from agent.streaming.adaptive import MAIN_STREAM, SUBSTREAM, AdaptiveStreamSelector
+from agent.streaming.depacketizer import AccessUnit, Depacketizer, create_depacketizer
+from agent.streaming.ring_buffer import GopRingBuffer
+from agent.streaming.rtsp_relay import RtspRelay
+from agent.streaming.sdp_cache import sdp_cache
+from agent.streaming.spool import SegmentSpool
+from agent.streaming.rtsp_client import (
+    RtspClient, RtspError, SessionDescription, parse_rtp_header
+)
+
 # Платформо-специфичные импорты (будут разными для разных камер)
 try:
     import platform_specific  # Модуль для конкретной платформы камеры
 except ImportError:
     platform_specific = None
 
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+# Поток планировщика для кадров из хранилища (не канал медиа кадров)
+SPOOL_CHANNEL = 0xFFFF
+
+# Этапы запуска: платформа, камера и сервер выполняются одновременно;
+# first_frame - первый кадр камеры, first_sent - первый кадр на сервере
+STARTUP_STAGES = ("camera_platform", "camera", "network_platform", "cloud",
+                  "first_frame", "first_sent")
+
 
 class AgentStatus(Enum):
     """Статусы агента"""
@@ -40,6 +79,9 @@ class AgentConfig:
     tunnel_server_url: str = ""  # URL туннельного сервера
     tunnel_server_token: str = ""
     tunnel_port: int = 8554  # Порт для туннеля на сервере
+    tunnel_ports: list = None  # Локальные порты камеры, доступные через туннель
+    rtsp_relay: bool = True  # RTSP порт туннеля обслуживает агент поверх одной сессии с камерой
+    relay_queue_bytes: int = 2 * 1024 * 1024  # Очередь клиента ретранслятора
     
     # P2P настройки
     p2p_enabled: bool = False
@@ -52,23 +94,79 @@ class AgentConfig:
     camera_rtsp_port: int = 554   # RTSP порт камеры
     camera_username: str = "admin"
     camera_password: str = "admin"
+    stream_paths: list = None  # Пути RTSP потоков (основной, подпоток)
     
     # Сетевые настройки
     connection_timeout: int = 30
-    reconnect_interval: int = 10
+    reconnect_interval: int = 10       # Начальная задержка переподключения
+    reconnect_max_interval: int = 300  # Предельная задержка переподключения
     heartbeat_interval: int = 30
+    stats_interval: int = 300  # Heartbeat со статистикой не реже, даже при потоке подтверждений
+    socket_send_buffer: int = 64 * 1024  # SO_SNDBUF: очередь медиа остается в агенте
+    network_monitor: bool = True  # Перенос соединения при смене адреса или шлюза (rtnetlink)
+    network_debounce: float = 1.0  # Ожидание после изменения сети до переноса
     
     # Настройки стриминга
-    stream_quality: str = "medium"  # low/medium/high
+    stream_quality: str = "medium"  # low/medium/high; low - начинать с подпотока
+    adaptive_quality: bool = True   # Переключение основной поток/подпоток по каналу
+    concurrent_streams: bool = False  # Передавать все stream_paths одновременно
+    stream_weights: list = None       # Доли канала потоков (по умолчанию основной 1, подпоток 4)
     buffer_size: int = 1024 * 1024  # 1MB буфер
+    coalesce_bytes: int = 16 * 1024  # Порог объединения кадров в одну запись
+    coalesce_delay: float = 0.005    # Максимальная задержка объединения (сек)
+    pacing_enabled: bool = True      # Распределение кадра по его интервалу
+    max_upload_rate: int = 0         # Предельная скорость отправки, байт/с (0 - без ограничения)
+    pacing_burst: int = 64 * 1024    # Допустимый всплеск сверх предельной скорости, байт
+    
+    # Хранилище на карте памяти на время обрыва соединения
+    spool_dir: str = ""  # Каталог сегментов, пусто - кадры копятся только в buffer_size
+    spool_max_bytes: int = 2 * 1024 ** 3
+    spool_drain_rate: int = 256 * 1024  # Скорость отправки накопленного, байт/с
+    spool_weight: float = 0.25          # Доля канала накопленного относительно живого потока
+    spool_sync_interval: float = 5.0    # Сброс записанного на карту, секунды
     
     # Безопасность
     encryption_enabled: bool = True
     ssl_verify: bool = True
     
+    # Метрики: локальный endpoint /metrics в формате Prometheus
+    metrics_port: int = 0  # 0 - выключен
+    metrics_host: str = "127.0.0.1"
+    
     # Логирование
     log_level: str = "INFO"
     log_file: Optional[str] = None
+    
+    @property
+    def camera_rtsp_url(self) -> str:
+        """RTSP URL основного потока камеры"""
+        return self.camera_rtsp_urls[0]
+    
+    @property
+    def camera_rtsp_urls(self) -> List[str]:
+        """RTSP URL всех потоков камеры: основной, подпоток"""
+        return [
+            f"rtsp://{self.camera_ip}:{self.camera_rtsp_port}{path}"
+            for path in self.stream_paths or ["/"]
+        ]
+
+
+@dataclass
+class MediaStream:
+    """Поток камеры, передаваемый по соединению агента"""
+    channel: int  # Канал медиа кадров
+    name: str
+    processor: "StreamProcessor"
+    buffer: GopRingBuffer
+    pacer: Optional[MediaPacer] = None
+    retrying: bool = False  # Буфер уже отправляется другой задачей
+    
+    # Метрики потока
+    frames_sent: Counter = field(default_factory=Counter)
+    bytes_sent: Counter = field(default_factory=Counter)
+    frames_buffered: Counter = field(default_factory=Counter)
+    packets_lost: Counter = field(default_factory=Counter)
+    frame_bytes: Histogram = field(default_factory=lambda: Histogram(SIZE_BUCKETS))
 
 
 class CameraAgent:
@@ -81,22 +179,118 @@ class CameraAgent:
         self.last_heartbeat = None
         self.connection = None
         self.stream_processor = None
-        self.buffer = []
+        self.streams: List[MediaStream] = []
+        self.backoff = DecorrelatedJitterBackoff(
+            config.reconnect_interval, config.reconnect_max_interval
+        )
+        
+        # Выбор потока камеры по состоянию канала
+        initial = MAIN_STREAM
+        if config.stream_quality == "low" and len(config.camera_rtsp_urls) > 1:
+            initial = SUBSTREAM
+        self.selector = AdaptiveStreamSelector(initial=initial)
+        self._sending_since: Optional[float] = None  # Получение отправляемого кадра
+        
+        # Разделение соединения между потоками; состояние сохраняется
+        # между переподключениями
+        self.scheduler = StreamScheduler(config.max_upload_rate, config.pacing_burst)
+        
+        # Раздача потоков камеры клиентам туннеля
+        self.relay: Optional[RtspRelay] = None
+        if config.rtsp_relay:
+            self.relay = RtspRelay(
+                f"rtsp://{config.camera_ip}:{config.camera_rtsp_port}",
+                config.camera_username, config.camera_password,
+                client_queue_bytes=config.relay_queue_bytes
+            )
+        
+        # Хранилище кадров на время обрыва; открывается при запуске
+        self.spool: Optional[SegmentSpool] = None
+        
+        # Смена адреса или шлюза: соединение переносится, не дожидаясь таймаута
+        self.network: Optional[AddressMonitor] = None
+        if config.network_monitor:
+            self.network = AddressMonitor(self._on_network_change, config.network_debounce)
+        self._network_changed: Optional[asyncio.Event] = None
+        
+        # Фоновые задачи агента: без копий при переподключениях,
+        # с перезапуском после ошибки и отменой при остановке
+        self.tasks = TaskSupervisor()
+        
+        # Этапы запуска; время готовности каждого - в метриках
+        self.startup = StartupStages(*STARTUP_STAGES)
         
         # Настройка логирования
         self._setup_logging()
         
-        # Статистика
-        self.stats = {
-            "bytes_sent": 0,
-            "bytes_received": 0,
-            "packets_lost": 0,
-            "reconnections": 0,
-            "uptime": 0
-        }
+        # Метрики
+        self.metrics = MetricsRegistry()
+        self._init_metrics()
+        self.metrics_server: Optional[MetricsServer] = None
+        self._reported_metrics: Dict[str, float] = {}  # Отправлено в heartbeat
         
         self.logger.info(f"Camera Agent {config.agent_id} инициализирован")
     
+    def _init_metrics(self):
+        """Регистрация метрик агента"""
+        metrics = self.metrics
+        self.reconnections = metrics.counter(
+            "agent_reconnections_total", "Переподключения к облачному серверу")
+        self.heartbeats_skipped = metrics.counter(
+            "agent_heartbeats_skipped_total", "Heartbeat не отправлен: живость подтверждена медиа")
+        self.send_seconds = metrics.histogram(
+            "agent_send_seconds", "Время отправки кадра")
+        self.reconnect_seconds = metrics.histogram(
+            "agent_reconnect_seconds", "Длительность переподключения", buckets=DURATION_BUCKETS)
+        metrics.gauge("agent_uptime_seconds", "Время работы агента",
+                      function=lambda: time.time() - self.start_time if self.start_time else 0)
+        metrics.gauge("agent_connected", "Соединение с облачным сервером установлено",
+                      function=lambda: int(self.status == AgentStatus.CONNECTED))
+        self.spool_frames_written = metrics.counter(
+            "agent_spool_frames_written_total", "Кадров записано в хранилище во время обрыва")
+        self.spool_frames_sent = metrics.counter(
+            "agent_spool_frames_sent_total", "Кадров отправлено из хранилища")
+        self.migrations = metrics.counter(
+            "agent_migrations_total", "Переносы соединения после смены адреса или шлюза")
+        for stage in STARTUP_STAGES:
+            metrics.gauge("agent_startup_seconds", "Время от начала запуска до готовности этапа",
+                          {"stage": stage},
+                          function=lambda stage=stage: self.startup.ready_at.get(stage, 0))
+        self.loop_lag = LoopLagProbe(metrics.histogram(
+            "agent_loop_lag_seconds", "Задержка планирования цикла событий", buckets=LAG_BUCKETS))
+        metrics.gauge("agent_relay_clients", "Клиенты туннеля, получающие поток ретранслятора",
+                      function=lambda: self.relay.client_count if self.relay else 0)
+        metrics.gauge("agent_spool_bytes", "Занято в хранилище на карте памяти",
+                      function=lambda: self.spool.bytes_used if self.spool is not None else 0)
+    
+    def _register_stream_metrics(self, stream: "MediaStream"):
+        """Регистрация метрик потока"""
+        metrics = self.metrics
+        labels = {"stream": stream.name}
+        metrics.register("agent_frames_sent_total", "Отправлено кадров",
+                         stream.frames_sent, labels)
+        metrics.register("agent_bytes_sent_total", "Отправлено байт",
+                         stream.bytes_sent, labels)
+        metrics.register("agent_frames_buffered_total", "Кадров помещено в буфер",
+                         stream.frames_buffered, labels)
+        metrics.register("agent_packets_lost_total", "Неудачных отправок кадра",
+                         stream.packets_lost, labels)
+        metrics.register("agent_frame_bytes", "Размер кадра", stream.frame_bytes, labels)
+        metrics.gauge("agent_queue_depth", "Кадров в очереди между камерой и отправкой",
+                      labels, function=lambda: stream.processor.queue_depth)
+        metrics.gauge("agent_buffer_bytes", "Занято в буфере на время обрыва",
+                      labels, function=lambda: stream.buffer.bytes_used)
+        metrics.register("agent_scheduler_wait_seconds", "Ожидание права на отправку",
+                         self.scheduler.wait_histogram(stream.channel), labels)
+        if stream.pacer:
+            metrics.register("agent_pacing_delay_seconds", "Задержка сглаживания кадра",
+                             stream.pacer.delay_histogram, labels)
+    
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Текущие значения метрик"""
+        return self.metrics.snapshot()
+    
     def _setup_logging(self):
         """Настройка логирования"""
         logging.basicConfig(
@@ -107,26 +301,62 @@ class CameraAgent:
         self.logger = logging.getLogger(f"camera_agent_{self.config.agent_id}")
     
     async def start(self):
-        """Запуск агента"""
+        """Запуск агента
+        
+        Камера и облачный сервер запускаются одновременно: пока идут
+        DNS, TLS и регистрация, сессия с камерой уже открыта и первый GOP
+        копится в буфере потока; он уходит сразу после подключения.
+        """
         try:
             self.logger.info("Запуск Camera Agent...")
             self.status = AgentStatus.STARTING
             self.start_time = time.time()
+            self.startup.begin()
+            self.tasks.supervise("loop_lag", self.loop_lag.run)
+            
+            if not platform_specific:
+                # Общая инициализация
+                self.logger.warning("Платформо-специфичные компоненты не найдены")
             
-            # Инициализация платформо-специфичных компонентов
-            await self._init_platform()
+            if self.config.metrics_port:
+                self.metrics_server = MetricsServer(
+                    self.metrics, self.config.metrics_host, self.config.metrics_port
+                )
+                await self.metrics_server.start()
             
-            # Подключение к облачному серверу
-            await self._connect_to_cloud()
+            if self.config.spool_dir:
+                # Сегменты прошлого запуска отправляются после подключения
+                self.spool = SegmentSpool(self.config.spool_dir, self.config.spool_max_bytes)
+                self.scheduler.add_stream(SPOOL_CHANNEL, "spool", self.config.spool_weight)
+                self.tasks.supervise("spool_sync", self._spool_sync_loop)
             
-            # Запуск стриминга
-            await self._start_streaming()
+            self._network_changed = asyncio.Event()
+            if self.network:
+                address, gateway = await self.network.start()
+                if address:
+                    self.logger.info(f"Адрес {address}, шлюз {gateway}")
+            
+            stages = [
+                asyncio.ensure_future(self.startup.run("camera", self._start_camera())),
+                asyncio.ensure_future(self.startup.run("cloud", self._start_cloud()))
+            ]
+            try:
+                await asyncio.gather(*stages)
+            except Exception:
+                for stage in stages:
+                    stage.cancel()
+                raise
             
             # Запуск мониторинга
-            asyncio.create_task(self._monitoring_loop())
+            self.tasks.supervise("monitoring", self._monitoring_loop)
             
             self.status = AgentStatus.CONNECTED
-            self.logger.info("Camera Agent запущен успешно")
+            self._start_spool_drain()
+            # Кадры, полученные во время подключения
+            await self._retry_buffered_data()
+            self.logger.info("Camera Agent запущен успешно: " + ", ".join(
+                f"{stage} {seconds:.3f} с" for stage, seconds in self.startup.ready_at.items()
+            ))
             
         except Exception as e:
             self.status = AgentStatus.ERROR
@@ -140,48 +370,95 @@ class CameraAgent:
             self.status = AgentStatus.STOPPED
             
             # Остановка стриминга
-            if self.stream_processor:
-                await self.stream_processor.stop()
+            for stream in self.streams:
+                await stream.processor.stop()
+            
+            if self.relay:
+                await self.relay.close()
+            
+            # Отмена циклов отправки, мониторинга, переноса соединения
+            await self.tasks.close()
+            
+            if self.spool is not None:
+                await self.spool.close()
+            
+            if self.network:
+                self.network.close()
             
             # Отключение от облачного сервера
             if self.connection:
                 await self.connection.close()
             
+            if self.metrics_server:
+                await self.metrics_server.stop()
+            
             self.logger.info("Camera Agent остановлен")
             
         except Exception as e:
             self.logger.error(f"Ошибка остановки агента: {e}")
     
-    async def _init_platform(self):
-        """Инициализация платформо-специфичных компонентов"""
+    async def _start_camera(self):
+        """Этап запуска: интерфейс камеры платформы и потоки камеры"""
         if platform_specific:
-            # Инициализация для конкретной платформы камеры
-            await platform_specific.init_camera_interface()
-            await platform_specific.init_network_stack()
-        else:
-            # Общая инициализация
-            self.logger.warning("Платформо-специфичные компоненты не найдены")
+            await self.startup.run("camera_platform", platform_specific.init_camera_interface(
+                self.config.camera_username, self.config.camera_password,
+                self.config.camera_rtsp_urls
+            ))
+        await self._start_streaming()
+        
+        # Описания остальных потоков (подпотока) - для переключения без DESCRIBE;
+        # открытые потоки уже в кэше и повторно не запрашиваются
+        self.tasks.spawn("sdp_probe", lambda: sdp_cache.probe(
+            self.config.camera_rtsp_urls, self.config.camera_username,
+            self.config.camera_password
+        ))
+    
+    async def _start_cloud(self):
+        """Этап запуска: сетевой стек платформы и подключение к серверу"""
+        if platform_specific:
+            await self.startup.run("network_platform", platform_specific.init_network_stack())
+        await self._connect_to_cloud()
     
-    async def _connect_to_cloud(self):
-        """Подключение к облачному серверу"""
+    async def _connect_to_cloud(self, previous: Optional["TunnelConnection"] = None):
+        """Подключение к облачному серверу
+
+        Если передано прежнее соединение с сессией, сначала выполняется
+        возобновление сессии без полной регистрации.
+        """
         try:
-            self.logger.info(f"Подключение к облачному серверу: {self.config.cloud_server_url}")
-            self.status = AgentStatus.CONNECTING
+            self.logger.info(f"Подключение к облачному серверу: {self.config.tunnel_server_url}")
+            if previous is None:
+                self.status = AgentStatus.CONNECTING
             
             # Создание соединения с облачным сервером
-            self.connection = CloudConnection(
-                url=self.config.cloud_server_url,
-                token=self.config.cloud_server_token,
-                agent_id=self.config.agent_id
+            self.connection = TunnelConnection(
+                url=self.config.tunnel_server_url,
+                token=self.config.tunnel_server_token,
+                agent_id=self.config.agent_id,
+                tunnel_port=self.config.tunnel_port,
+                tunnel_ports=self.config.tunnel_ports or [self.config.camera_rtsp_port],
+                timeout=self.config.connection_timeout,
+                heartbeat_interval=self.config.heartbeat_interval,
+                coalesce_bytes=self.config.coalesce_bytes,
+                coalesce_delay=self.config.coalesce_delay,
+                scheduler=self.scheduler,
+                send_buffer=self.config.socket_send_buffer,
+                handlers={self.config.camera_rtsp_port: self.relay.serve} if self.relay else None
             )
             
-            # Регистрация агента на сервере
-            await self.connection.register()
-            
-            self.logger.info("Подключение к облачному серверу установлено")
+            # Возобновление сессии либо регистрация и открытие туннеля
+            if previous and previous.session_token and await self.connection.resume(previous):
+                self.logger.info("Сессия на облачном сервере возобновлена")
+            else:
+                await self.connection.register()
+                await self.connection.establish_tunnel()
+                # Новая сессия на сервере: следующий heartbeat несет полные значения
+                self._reported_metrics = {}
+                self.logger.info("Подключение к облачному серверу установлено")
             
         except Exception as e:
-            self.status = AgentStatus.ERROR
+            if self.connection:
+                await self.connection.close()
             self.logger.error(f"Ошибка подключения к облачному серверу: {e}")
             raise
     
@@ -190,20 +467,29 @@ class CameraAgent:
         try:
             self.logger.info("Запуск стриминга с камеры...")
             
-            # Создание процессора потока
-            self.stream_processor = StreamProcessor(
-                camera_url=self.config.camera_rtsp_url,
-                camera_username=self.config.camera_username,
-                camera_password=self.config.camera_password,
-                quality=self.config.stream_quality,
-                buffer_size=self.config.buffer_size
-            )
+            urls = self.config.camera_rtsp_urls
+            if self.config.concurrent_streams and len(urls) > 1:
+                # Каждый поток камеры - отдельный канал соединения
+                weights = self.config.stream_weights or [1, 4]
+                for index, url in enumerate(urls):
+                    weight = weights[index] if index < len(weights) else 1
+                    self._add_stream(index, url, [url], weight)
+            else:
+                # Один канал; поток камеры выбирается по состоянию канала
+                self._add_stream(0, urls[self.selector.current], urls, 1,
+                                 on_input=self.selector.record_input)
+            self.stream_processor = self.streams[0].processor
             
-            # Запуск обработки потока
-            await self.stream_processor.start()
+            # Запуск обработки потоков
+            await asyncio.gather(*[stream.processor.start() for stream in self.streams])
             
-            # Запуск отправки потока на сервер
-            asyncio.create_task(self._stream_to_cloud())
+            # Запуск отправки потоков на сервер
+            for stream in self.streams:
+                self.tasks.supervise(f"stream_{stream.name}",
+                                     lambda stream=stream: self._stream_to_cloud(stream))
+            
+            if len(self.streams) == 1 and self.config.adaptive_quality and len(urls) > 1:
+                self.tasks.supervise("adaptive", self._adaptive_loop)
             
             self.logger.info("Стриминг запущен")
             
@@ -211,90 +497,274 @@ class CameraAgent:
             self.logger.error(f"Ошибка запуска стриминга: {e}")
             raise
     
-    async def _stream_to_cloud(self):
+    def _add_stream(self, channel: int, url: str, urls: List[str], weight: float,
+                    on_input: Optional[Callable[[int], None]] = None):
+        """Создание процессора и состояния отправки потока"""
+        names = ["main", "sub"]
+        name = names[channel] if channel < len(names) else f"stream{channel}"
+        
+        processor = StreamProcessor(
+            camera_url=url,
+            camera_username=self.config.camera_username,
+            camera_password=self.config.camera_password,
+            quality=self.config.stream_quality,
+            buffer_size=self.config.buffer_size,
+            camera_urls=urls,
+            on_input=on_input
+        )
+        stream = MediaStream(
+            channel=channel,
+            name=name,
+            processor=processor,
+            buffer=GopRingBuffer(self.config.buffer_size),
+            pacer=MediaPacer() if self.config.pacing_enabled else None
+        )
+        self.streams.append(stream)
+        self.scheduler.add_stream(channel, name, weight)
+        self._register_stream_metrics(stream)
+    
+    async def _stream_to_cloud(self, stream: MediaStream):
         """Отправка потока на облачный сервер"""
         try:
-            while self.status == AgentStatus.CONNECTED:
-                # Получение данных потока
-                stream_data = await self.stream_processor.get_stream_data()
+            # Цикл просыпается только при поступлении кадра; пока идет
+            # отправка, очередь процессора заполняется и чтение с камеры
+            # приостанавливается
+            async for unit in stream.processor:
+                if self.status == AgentStatus.STOPPED:
+                    break
+                self.startup.mark("first_frame")
                 
-                if stream_data:
-                    # Отправка на облачный сервер с буферизацией
-                    await self._send_to_cloud(stream_data)
+                if self.status != AgentStatus.CONNECTED:
+                    # Накопление на время переподключения
+                    self._buffer_unit(stream, unit)
+                    continue
                 
-                await asyncio.sleep(0.04)  # 25 FPS
+                # Отправка на облачный сервер с буферизацией
+                await self._send_to_cloud(stream, unit)
                 
-        except Exception as e:
-            self.logger.error(f"Ошибка отправки потока: {e}")
-            await self._handle_connection_error()
+        except Exception:
+            # Переподключение - отдельной задачей; цикл потока перезапустит супервизор
+            self._request_reconnect()
+            raise
     
-    async def _send_to_cloud(self, data: bytes):
-        """Отправка данных на облачный сервер с буферизацией"""
+    async def _send_to_cloud(self, stream: MediaStream, unit: AccessUnit):
+        """Отправка кадра на облачный сервер с буферизацией"""
+        if stream.buffer:
+            # Сначала отправляется накопленное, чтобы сохранить порядок кадров
+            self._buffer_unit(stream, unit)
+            await self._retry_buffered_data(stream)
+            return
+        
         try:
             # Отправка через соединение
-            success = await self.connection.send_stream_data(data)
+            self._sending_since = unit.received_at
+            success = await self._send_unit(stream, unit)
             
             if success:
-                self.stats["bytes_sent"] += len(data)
+                self._on_unit_sent(stream, unit)
             else:
                 # Добавление в буфер для повторной отправки
-                self.buffer.append(data)
-                self.stats["packets_lost"] += 1
+                self._buffer_unit(stream, unit)
+                stream.packets_lost.inc()
+                
+                if not self.connection.is_connected():
+                    # Обрыв замечен при отправке - не ждать цикла мониторинга
+                    self._request_reconnect()
+                    return
                 
                 # Попытка повторной отправки буфера
-                await self._retry_buffered_data()
+                await self._retry_buffered_data(stream)
                 
         except Exception as e:
             self.logger.error(f"Ошибка отправки данных: {e}")
-            self.buffer.append(data)
+            self._buffer_unit(stream, unit)
+        finally:
+            self._sending_since = None
     
-    async def _retry_buffered_data(self):
-        """Повторная отправка данных из буфера"""
-        while self.buffer and self.status == AgentStatus.CONNECTED:
-            data = self.buffer.pop(0)
-            try:
-                success = await self.connection.send_stream_data(data)
-                if success:
-                    self.stats["bytes_sent"] += len(data)
-                else:
-                    # Возврат в буфер если не удалось отправить
-                    self.buffer.insert(0, data)
+    async def _send_unit(self, stream: MediaStream, unit: AccessUnit) -> bool:
+        started = time.monotonic()
+        success = await self.connection.send_stream_data(unit, stream.channel, stream.pacer)
+        self.send_seconds.observe(time.monotonic() - started)
+        return success
+    
+    def _buffer_unit(self, stream: MediaStream, unit: AccessUnit):
+        if unit.keyframe and self.status in (AgentStatus.STARTING, AgentStatus.CONNECTING):
+            # До первого подключения нужен только последний GOP
+            stream.buffer.clear()
+        if self.spool is not None and self.status == AgentStatus.RECONNECTING:
+            # Обрыв может длиться часы - кадры уходят на карту памяти
+            if self.spool.append(stream.channel, unit):
+                self.spool_frames_written.inc()
+                return
+        stream.buffer.push(unit, sync=unit.keyframe)
+        stream.frames_buffered.inc()
+    
+    def _on_unit_sent(self, stream: MediaStream, unit: AccessUnit):
+        """Учет отправленного кадра"""
+        size = len(unit)
+        self.startup.mark("first_sent")
+        stream.frames_sent.inc()
+        stream.bytes_sent.inc(size)
+        stream.frame_bytes.observe(size)
+        self.selector.record_sent(size, time.monotonic() - unit.received_at)
+    
+    async def _retry_buffered_data(self, stream: Optional[MediaStream] = None):
+        """Повторная отправка данных из буфера; без stream - всех потоков"""
+        if stream is None:
+            await asyncio.gather(*[self._retry_buffered_data(s) for s in self.streams])
+            return
+        if stream.retrying:
+            return  # Новые кадры отправит уже идущий цикл, без повторов
+        
+        stream.retrying = True
+        try:
+            while stream.buffer and self.status == AgentStatus.CONNECTED:
+                # Элемент извлекается только после успешной отправки
+                unit = stream.buffer.peek()
+                try:
+                    success = await self._send_unit(stream, unit)
+                    if success:
+                        stream.buffer.pop()
+                        self._on_unit_sent(stream, unit)
+                    else:
+                        break
+                except Exception as e:
+                    self.logger.error(f"Ошибка повторной отправки: {e}")
                     break
-            except Exception as e:
-                self.logger.error(f"Ошибка повторной отправки: {e}")
-                self.buffer.insert(0, data)
+        finally:
+            stream.retrying = False
+    
+    def _start_spool_drain(self):
+        """Запуск фоновой отправки накопленного в хранилище"""
+        if self.spool is None or self.tasks.running("spool"):
+            return
+        if self.spool:
+            self.tasks.spawn("spool", self._drain_spool)
+    
+    async def _drain_spool(self):
+        """Отправка хранилища с ограничением скорости
+        
+        Живое видео идет своим каналом планировщика; накопленное получает
+        малую долю канала и не быстрее spool_drain_rate. Кадр удаляется из
+        хранилища только после успешной отправки.
+        """
+        spool = self.spool
+        # Записанное во время обрыва становится доступно для чтения;
+        # усечение сегмента и запись индекса идут вне цикла событий
+        await spool.seal()
+        bucket = TokenBucket(self.config.spool_drain_rate, self.config.pacing_burst)
+        self.logger.info(f"Отправка накопленного в хранилище: {spool.bytes_used} байт")
+        
+        while self.status == AgentStatus.CONNECTED:
+            record = spool.read()
+            if record is None:
                 break
+            delay = bucket.reserve(len(record.unit), time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            try:
+                success = await self.connection.send_stream_data(
+                    record.unit, record.channel, spooled=True
+                )
+            except Exception as e:
+                self.logger.error(f"Ошибка отправки из хранилища: {e}")
+                success = False
+            if not success:
+                # Повтор после переподключения
+                spool.rewind()
+                return
+            spool.commit()
+            self.spool_frames_sent.inc()
+        
+        if not spool:
+            self.logger.info("Хранилище отправлено")
+    
+    async def _spool_sync_loop(self):
+        """Сброс записанного в хранилище на карту
+        
+        Отдельная задача: сброс идет раз в интервал, а не по кадру, и не
+        зависит от того, где обнаружен обрыв и чем занят мониторинг.
+        """
+        while self.status != AgentStatus.STOPPED:
+            await asyncio.sleep(self.config.spool_sync_interval)
+            await self.spool.sync()
+    
+    async def _adaptive_loop(self):
+        """Переключение основной поток/подпоток по оценке канала"""
+        while self.status != AgentStatus.STOPPED:
+            await asyncio.sleep(self.selector.window)
+            if self.status != AgentStatus.CONNECTED:
+                continue
+            
+            sending_since = self._sending_since
+            pending = time.monotonic() - sending_since if sending_since else 0.0
+            target = self.selector.decide(pending)
+            if target is None:
+                continue
+            
+            self.logger.info(
+                f"Переключение на {'основной поток' if target == MAIN_STREAM else 'подпоток'}: "
+                f"{self.selector.get_stats()}"
+            )
+            if await self.stream_processor.switch_stream(target):
+                self.selector.switched(target)
+            else:
+                self.selector.switch_failed()
     
     async def _monitoring_loop(self):
         """Основной цикл мониторинга"""
         while self.status in [AgentStatus.CONNECTED, AgentStatus.RECONNECTING]:
+            if self.status == AgentStatus.RECONNECTING:
+                # Переподключение выполняется в другой задаче
+                await asyncio.sleep(self.config.heartbeat_interval)
+                continue
+            
             try:
-                # Отправка heartbeat
-                await self._send_heartbeat()
+                # Отправка heartbeat, если живость не подтверждена потоком
+                if self._heartbeat_due():
+                    await self._send_heartbeat()
+                else:
+                    self.heartbeats_skipped.inc()
                 
                 # Проверка соединения
                 await self._check_connection()
                 
-                # Обновление статистики
-                self._update_stats()
-                
                 await asyncio.sleep(self.config.heartbeat_interval)
                 
             except Exception as e:
                 self.logger.error(f"Ошибка в цикле мониторинга: {e}")
-                await self._handle_connection_error()
+                self._request_reconnect()
+                await asyncio.sleep(self.config.heartbeat_interval)
+    
+    def _heartbeat_due(self) -> bool:
+        """Нужен ли heartbeat
+        
+        Подтверждения медиа кадров от сервера уже доказывают живость
+        соединения в обе стороны; heartbeat со статистикой при этом
+        отправляется не реже stats_interval.
+        """
+        if not self.connection.acked_within(self.config.heartbeat_interval):
+            return True
+        if self.last_heartbeat is None:
+            return True
+        return time.time() - self.last_heartbeat >= self.config.stats_interval
     
     async def _send_heartbeat(self):
         """Отправка heartbeat на сервер"""
         try:
+            # Только изменения метрик с прошлого heartbeat; база сдвигается
+            # после успешной отправки, чтобы потерянные приращения ушли позже
+            snapshot = self.metrics.snapshot()
             heartbeat_data = {
                 "agent_id": self.config.agent_id,
                 "status": self.status.value,
                 "timestamp": time.time(),
-                "stats": self.stats
+                "stats_delta": self.metrics.delta(snapshot, self._reported_metrics)
             }
             
             await self.connection.send_heartbeat(heartbeat_data)
+            self._reported_metrics = snapshot
             self.last_heartbeat = time.time()
             
         except Exception as e:
@@ -304,41 +774,133 @@ class CameraAgent:
     async def _check_connection(self):
         """Проверка состояния соединения"""
         if not self.connection or not self.connection.is_connected():
-            await self._handle_connection_error()
+            self._request_reconnect()
+        elif self.connection.idle_time() > self.config.heartbeat_interval * 3:
+            # Ни подтверждений медиа, ни ответов на heartbeat
+            self.logger.warning("Сервер не отвечает")
+            self._request_reconnect()
+    
+    def _request_reconnect(self):
+        """Запуск переподключения задачей "reconnect"
+        
+        Вызывающий цикл не ждет переподключения; пока оно идет, повторные
+        запросы из мониторинга и циклов потоков ничего не запускают.
+        """
+        if self.status != AgentStatus.CONNECTED or self.tasks.running("reconnect"):
+            return
+        self.tasks.spawn("reconnect", self._handle_connection_error)
     
     async def _handle_connection_error(self):
         """Обработка ошибок соединения"""
+        if self.status != AgentStatus.CONNECTED:
+            return  # Переподключение уже выполняется, либо запуск еще не завершен
+        if self.tasks.running("migration"):
+            return  # Соединение переносится; при неудаче переподключится
+        
         self.logger.warning("Ошибка соединения, переподключение...")
         self.status = AgentStatus.RECONNECTING
-        self.stats["reconnections"] += 1
+        self.reconnections.inc()
+        started = time.monotonic()
         
-        # Ожидание перед переподключением
-        await asyncio.sleep(self.config.reconnect_interval)
+        previous = self.connection
+        if previous:
+            await previous.close()
         
-        try:
-            # Переподключение к облачному серверу
-            await self._connect_to_cloud()
+        while self.status == AgentStatus.RECONNECTING:
+            # Ожидание перед переподключением с учетом подсказки сервера
+            # из последней попытки
+            retry_after = self.connection.retry_after if self.connection else None
+            delay = self.backoff.next_delay(retry_after)
+            self.logger.info(f"Переподключение через {delay:.1f} с")
+            try:
+                # Появление адреса или шлюза прерывает ожидание
+                await asyncio.wait_for(self._network_changed.wait(), delay)
+                self.logger.info("Сеть изменилась, переподключение без ожидания")
+            except asyncio.TimeoutError:
+                pass
+            self._network_changed.clear()
+            
+            try:
+                # Переподключение к облачному серверу
+                await self._connect_to_cloud(previous)
+            except Exception as e:
+                self.logger.error(f"Ошибка переподключения: {e}")
+                continue
+            
+            self.backoff.reset()
             self.status = AgentStatus.CONNECTED
+            self.reconnect_seconds.observe(time.monotonic() - started)
             self.logger.info("Переподключение успешно")
-            
-        except Exception as e:
-            self.logger.error(f"Ошибка переподключения: {e}")
-            self.status = AgentStatus.ERROR
+            self._start_spool_drain()
+            await self._retry_buffered_data()
+    
+    def _on_network_change(self, previous: NetworkState, current: NetworkState):
+        """Смена адреса или шлюза по событию rtnetlink"""
+        address, gateway = current
+        if address:
+            for stream in self.streams:
+                stream.processor.camera_ip = address
+        
+        if self.status == AgentStatus.RECONNECTING:
+            if address:
+                self._network_changed.set()
+        elif self.status == AgentStatus.CONNECTED and address:
+            self.tasks.spawn("migration", lambda: self._migrate_connection(previous[0]))
     
-    def _update_stats(self):
-        """Обновление статистики"""
-        if self.start_time:
-            self.stats["uptime"] = time.time() - self.start_time
+    async def _migrate_connection(self, previous_address: Optional[str]):
+        """Перенос соединения на новый адрес
+        
+        Соединение через пропавший адрес или шлюз молчит до таймаута;
+        вместо ожидания сразу открывается новое соединение, которое
+        возобновляет сессию. Пока оно открывается, кадры копятся в буфере
+        потока; прежнее соединение закрывается после возобновления.
+        """
+        previous = self.connection
+        self.logger.info(f"Перенос соединения: адрес {previous_address} -> {self.network.state[0]}")
+        self.migrations.inc()
+        started = time.monotonic()
+        
+        try:
+            await self._connect_to_cloud(previous)
+        except Exception as e:
+            # Обычное переподключение с сохраненной сессией
+            self.logger.error(f"Ошибка переноса соединения: {e}")
+            self.connection = previous
+            await self._handle_connection_error()
+            return
+        if previous:
+            await previous.close()
+        
+        self.reconnect_seconds.observe(time.monotonic() - started)
+        self.logger.info("Соединение перенесено")
+        self._start_spool_drain()
+        await self._retry_buffered_data()
     
     def get_status(self) -> Dict[str, Any]:
         """Получение статуса агента"""
         return {
             "agent_id": self.config.agent_id,
             "status": self.status.value,
-            "uptime": self.stats["uptime"],
+            "uptime": time.time() - self.start_time if self.start_time else 0,
             "stats": self.stats,
             "last_heartbeat": self.last_heartbeat,
-            "buffer_size": len(self.buffer)
+            "buffer_size": sum(len(stream.buffer) for stream in self.streams),
+            "buffer": {stream.name: stream.buffer.get_stats() for stream in self.streams},
+            "send": self.connection.coalescer.stats if self.connection else {},
+            "uplink": self.selector.get_stats(),
+            "pacing": {
+                stream.name: stream.pacer.get_stats()
+                for stream in self.streams if stream.pacer
+            },
+            "scheduler": self.scheduler.get_stats(),
+            "spool": self.spool.get_stats() if self.spool is not None else {},
+            "relay": self.relay.get_stats() if self.relay else {},
+            "sdp_cache": sdp_cache.get_stats(),
+            "startup": self.startup.get_stats(),
+            "tasks": self.tasks.get_stats(),
+            "loop_lag": self.loop_lag.get_stats(),
+            "network": dict(self.network.stats, address=self.network.state[0],
+                            gateway=self.network.state[1]) if self.network else {}
         }
 
 
@@ -377,59 +939,377 @@ class P2PConnection:
 
 
 class TunnelConnection:
-    """Класс для создания туннеля с сервером"""
+    """Класс для создания туннеля с сервером
+
+    Одно WebSocket соединение несет управляющие JSON сообщения, двоичные
+    медиа кадры и кадры мультиплексора, в котором каждый TCP поток
+    туннеля - отдельный канал со своим управлением потоком.
+    """
     
-    def __init__(self, url: str, token: str, agent_id: str):
+    def __init__(self, url: str, token: str, agent_id: str,
+                 tunnel_port: int = 8554, tunnel_ports: Optional[list] = None,
+                 timeout: float = 30, heartbeat_interval: float = 30,
+                 coalesce_bytes: int = 16 * 1024,
+                 coalesce_delay: float = 0.005, unacked_frames: int = 256,
+                 scheduler: Optional[StreamScheduler] = None,
+                 send_buffer: Optional[int] = None,
+                 handlers: Optional[Dict[int, ChannelHandler]] = None):
         self.url = url
         self.token = token
         self.agent_id = agent_id
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval  # Срок агента на сервере - три интервала
         self.connected = False
         self.websocket = None
-        self.tunnel_port = None  # Порт туннеля на сервере
+        self.tunnel_port = tunnel_port  # Порт туннеля на сервере
+        self.tunnel_ports = tunnel_ports or []  # Локальные порты камеры
+        self.mux = TunnelMultiplexer(self._send_frame, allowed_ports=self.tunnel_ports,
+                                     handlers=handlers)
+        self.coalescer = SendCoalescer(self._send_message, coalesce_bytes, coalesce_delay)
+        self.scheduler = scheduler or StreamScheduler()
+        self.send_buffer = send_buffer
+        self.media_sequence = 0
+        
+        # Сессия для возобновления после обрыва
+        self.session_token: Optional[str] = None
+        self.retry_after: Optional[float] = None  # Подсказка сервера, секунды
+        self.acked_sequence = -1  # Последний подтвержденный сервером кадр
+        self.last_received = time.monotonic()  # Последнее сообщение сервера
+        self.last_acked: Optional[float] = None  # Последнее подтверждение медиа
+        self._unacked: Deque[Tuple[int, bytes]] = deque(maxlen=unacked_frames)
+        
+        self._receive_task: Optional[asyncio.Task] = None
+        self._registered: Optional[asyncio.Future] = None
+    
+    async def _open(self):
+        """Подключение к туннельному серверу и запуск приема"""
+        if websockets is None:
+            raise RuntimeError("Для туннеля требуется пакет websockets")
+        
+        try:
+            self.websocket = await asyncio.wait_for(
+                websockets.connect(f"{self.url.rstrip('/')}/{self.agent_id}", max_size=None),
+                self.timeout
+            )
+        except Exception as e:
+            # Перегруженный сервер отвечает 503 с заголовком Retry-After
+            self.retry_after = _parse_retry_after(getattr(e, "response", None))
+            raise
+        
+        if self.send_buffer:
+            # Короткая очередь ядра: медиа копится в планировщике, где
+            # управляющие сообщения могут его обогнать
+            sock = self.websocket.transport.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        
+        self.last_received = time.monotonic()
+        self._registered = asyncio.get_running_loop().create_future()
+        self._receive_task = asyncio.ensure_future(self._receive_loop())
     
     async def register(self):
         """Регистрация агента и создание туннеля"""
-        # Подключение к туннельному серверу
-        # Запрос на создание туннеля
-        # Получение порта туннеля от сервера
+        await self._open()
+        
+        # Запрос на регистрацию и получение порта туннеля от сервера
+        await self._send_control("register", {
+            "agent_id": self.agent_id,
+            "token": self.token,
+            "heartbeat_interval": self.heartbeat_interval
+        })
+        data = await asyncio.wait_for(self._registered, self.timeout)
+        self.tunnel_port = data.get("tunnel_port", self.tunnel_port)
+        self.session_token = data.get("session_token")
         self.connected = True
-        self.tunnel_port = 8554  # Получаем от сервера
+    
+    async def resume(self, previous: "TunnelConnection") -> bool:
+        """Возобновление сессии прежнего соединения
+        
+        Сервер сохраняет туннель и поток, нумерация медиа кадров
+        продолжается, неподтвержденные кадры отправляются повторно.
+        Возвращает False, если сервер отказал в возобновлении.
+        """
+        await self._open()
+        
+        await self._send_control("resume", {
+            "agent_id": self.agent_id,
+            "token": self.token,
+            "session_token": previous.session_token,
+            "sequence": previous.acked_sequence,
+            "heartbeat_interval": self.heartbeat_interval
+        })
+        data = await asyncio.wait_for(self._registered, self.timeout)
+        if not data.get("resumed"):
+            await self.close()
+            return False
+        
+        self.tunnel_port = data.get("tunnel_port", previous.tunnel_port)
+        self.session_token = data.get("session_token", previous.session_token)
+        self.acked_sequence = data.get("acked_sequence", previous.acked_sequence)
+        self.media_sequence = previous.media_sequence
+        self.connected = True
+        
+        # Повторная отправка того, что сервер не успел получить
+        for sequence, frame in previous._unacked:
+            if sequence > self.acked_sequence:
+                self._unacked.append((sequence, frame))
+                await self._send_frame(frame)
+        await self.coalescer.flush()
+        return True
     
     async def establish_tunnel(self) -> bool:
         """Создание туннеля до камеры"""
-        # Создание TCP туннеля от сервера до локальной камеры
-        # Камера становится доступна как 127.0.0.1:tunnel_port на сервере
+        # Сервер открывает каналы к перечисленным портам, камера становится
+        # доступна как 127.0.0.1:tunnel_port на сервере
+        await self._send_control("tunnel_ready", {
+            "tunnel_port": self.tunnel_port,
+            "ports": self.tunnel_ports
+        })
+        return True
+    
+    async def send_stream_data(self, unit: AccessUnit, channel: int = 0,
+                               pacer: Optional[MediaPacer] = None,
+                               spooled: bool = False) -> bool:
+        """Отправка кадра двоичным медиа кадром в канале потока
+        
+        spooled - кадр из хранилища: отмечается флагом и делит соединение
+        как отдельный поток планировщика SPOOL_CHANNEL.
+        """
+        if not self.connected:
+            return False
+        
+        flags = FLAG_SPOOLED if spooled else 0
+        lane = SPOOL_CHANNEL if spooled else channel
+        if unit.keyframe:
+            flags |= FLAG_KEYFRAME
+        if unit.parameter_sets:
+            flags |= FLAG_PARAMETER_SETS
+        
+        async def send_chunk(chunk, start: bool, end: bool):
+            chunk_flags = flags
+            if start:
+                chunk_flags |= FLAG_AU_START
+            if end:
+                chunk_flags |= FLAG_AU_END
+            # Потоки делят соединение по весам; нумерация кадров общая,
+            # поэтому номер выдается под правом на отправку
+            async with self.scheduler.slot(lane, len(chunk)):
+                frame = pack_media_frame(channel, self.media_sequence, unit.timestamp,
+                                         chunk, chunk_flags)
+                # Конец кадра видео сразу отправляет накопленные кадры
+                await self._send_frame(frame, end_of_unit=end)
+                self._unacked.append((self.media_sequence, frame))
+                self.media_sequence += 1
+        
+        try:
+            if pacer:
+                # Крупный кадр уходит фрагментами в пределах своего интервала
+                await pacer.pace(unit.data, unit.timestamp, send_chunk)
+            else:
+                await send_chunk(unit.data, True, True)
+        except websockets.exceptions.ConnectionClosed:
+            return False
+        
         return True
     
     async def send_heartbeat(self, data: Dict[str, Any]):
         """Отправка heartbeat через туннель"""
-        # Отправка статуса через туннельное соединение
-        pass
+        await self._send_control("heartbeat", data)
+    
+    async def send_status(self, data: Dict[str, Any]):
+        """Отправка обновления статуса"""
+        await self._send_control("status_update", data)
     
     def is_connected(self) -> bool:
         """Проверка соединения"""
         return self.connected
     
+    def acked_within(self, seconds: float) -> bool:
+        """Сервер подтверждал медиа кадры за последние seconds секунд"""
+        return self.last_acked is not None and time.monotonic() - self.last_acked < seconds
+    
+    def idle_time(self) -> float:
+        """Время с последнего сообщения сервера"""
+        return time.monotonic() - self.last_received
+    
     async def close(self):
         """Закрытие соединения"""
         self.connected = False
+        self.mux.close()
+        self.coalescer.close()
+        if self._receive_task:
+            self._receive_task.cancel()
+        if self.websocket:
+            await self.websocket.close()
+    
+    async def _send_control(self, message_type: str, data: Dict[str, Any]):
+        """Отправка управляющего сообщения вне очереди медиа"""
+        message = json.dumps({"type": message_type, "data": data})
+        async with self.scheduler.control_slot():
+            await self.websocket.send(message)
+    
+    async def _send_frame(self, frame: bytes, end_of_unit: bool = False):
+        """Отправка двоичного кадра через объединитель записей"""
+        await self.coalescer.send(frame, end_of_unit)
+    
+    async def _send_message(self, message: bytes):
+        """Запись сообщения в WebSocket"""
+        await self.websocket.send(message)
+    
+    async def _receive_loop(self):
+        """Прием сообщений сервера"""
+        try:
+            async for message in self.websocket:
+                self.last_received = time.monotonic()
+                if isinstance(message, bytes):
+                    self.mux.feed_frame(message)
+                else:
+                    self._handle_control(json.loads(message))
+        except websockets.exceptions.ConnectionClosed as e:
+            logging.warning(f"[TUNNEL] Соединение закрыто: {e}")
+        finally:
+            self.connected = False
+            self.mux.close()
+            if self._registered and not self._registered.done():
+                self._registered.set_exception(ConnectionError("Соединение закрыто"))
+    
+    def _handle_control(self, message: Dict[str, Any]):
+        """Обработка управляющего сообщения сервера"""
+        message_type = message.get("type")
+        data = message.get("data", {})
+        
+        if message_type == "registration_confirmed":
+            if not self._registered.done():
+                self._registered.set_result(data)
+        elif message_type in ("resume_confirmed", "resume_rejected"):
+            if not self._registered.done():
+                self._registered.set_result(
+                    dict(data, resumed=message_type == "resume_confirmed")
+                )
+        elif message_type == "media_ack":
+            self.last_acked = time.monotonic()
+            self._acknowledge(data.get("sequence", -1))
+        elif message_type == "heartbeat_ack":
+            pass  # Живость учтена в цикле приема
+        elif message_type == "retry_after":
+            # Сервер просит не переподключаться раньше указанного срока
+            self.retry_after = data.get("seconds")
+        elif message_type == "command":
+            logging.info(f"[TUNNEL] Команда от сервера: {data}")
+        else:
+            logging.debug(f"[TUNNEL] Неизвестное сообщение: {message_type}")
+    
+    def _acknowledge(self, sequence: int):
+        """Освобождение подтвержденных сервером кадров"""
+        self.acked_sequence = max(self.acked_sequence, sequence)
+        unacked = self._unacked
+        while unacked and unacked[0][0] <= self.acked_sequence:
+            unacked.popleft()
+
+
+def _parse_retry_after(response) -> Optional[float]:
+    """Значение Retry-After из ответа на рукопожатие WebSocket"""
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class _CameraSession:
+    """RTSP сессия одного потока камеры со сборщиком кадров"""
+    
+    def __init__(self, url: str, username: str, password: str,
+                 on_access_unit: Optional[Callable[[AccessUnit], None]]):
+        self.url = url
+        self.on_access_unit = on_access_unit  # None отключает выдачу кадров
+        self.rtsp = RtspClient(
+            url=url,
+            username=username,
+            password=password,
+            on_packet=self._on_packet
+        )
+        self.depacketizer: Optional[Depacketizer] = None
+    
+    async def connect(self) -> SessionDescription:
+        # Описание из кэша избавляет от DESCRIBE при каждом открытии сессии
+        description = await self.rtsp.connect(sdp_cache.description(self.url))
+        sdp_cache.put(self.url, description)
+        self._create_depacketizer()
+        return description
+    
+    def _create_depacketizer(self):
+        """Сборщик кадров под кодек сессии"""
+        if self.depacketizer is None:
+            description = self.rtsp.description
+            self.depacketizer = create_depacketizer(
+                description.codec, description.fmtp, self._deliver
+            )
+    
+    def _deliver(self, unit: AccessUnit):
+        if self.on_access_unit:
+            self.on_access_unit(unit)
+    
+    def _on_packet(self, channel: int, packet: memoryview):
+        """Передача RTP пакета видеодорожки в сборщик кадров"""
+        if channel != 0:
+            return  # RTCP
+        
+        if self.depacketizer is None:
+            # Первые пакеты могут прийти вместе с ответом на PLAY
+            self._create_depacketizer()
+        
+        marker, sequence, timestamp, payload = parse_rtp_header(packet)
+        self.depacketizer.push(payload, timestamp, sequence, marker)
 
 
 class StreamProcessor:
     """Класс для обработки потока с камеры"""
     
     def __init__(self, camera_url: str, camera_username: str, 
-                 camera_password: str, quality: str, buffer_size: int):
+                 camera_password: str, quality: str, buffer_size: int,
+                 queue_size: int = 32, camera_urls: Optional[List[str]] = None,
+                 on_input: Optional[Callable[[int], None]] = None):
+        self.camera_urls = camera_urls or [camera_url]  # Основной поток, подпоток
         self.camera_url = camera_url
         self.camera_username = camera_username
         self.camera_password = camera_password
         self.quality = quality
         self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self.on_input = on_input
         self.running = False
         self.camera_ip = self._detect_camera_ip()
+        
+        self.reconnect_delay = 5
+        self.switch_timeout = 10  # Ожидание ключевого кадра нового потока
+        self.description: Optional[SessionDescription] = None
+        
+        # Очередь кадров между чтением с камеры и отправкой
+        self._queue: Optional[asyncio.Queue] = None
+        self._paused = False
+        self._session: Optional[_CameraSession] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        self._switching = False
+    
+    @property
+    def stream_index(self) -> int:
+        """Индекс текущего потока в camera_urls"""
+        return self.camera_urls.index(self.camera_url)
     
     def _detect_camera_ip(self) -> str:
-        """Автоматическое определение IP камеры"""
+        """Автоматическое определение IP камеры
+        
+        Адрес берется из таблицы маршрутов ядра (rtnetlink): без пакетов
+        наружу, в том числе в изолированной сети. Вне Linux - по адресу
+        исходящего UDP сокета.
+        """
+        local_ip = detect_primary_address()
+        if local_ip:
+            logging.info(f"[STREAM] Обнаружен IP камеры: {local_ip}")
+            return local_ip
         try:
             # Получение IP через socket
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
@@ -443,18 +1323,146 @@ class StreamProcessor:
     
     async def start(self):
         """Запуск обработки потока"""
+        self._queue = asyncio.Queue()
         self.running = True
-        # TODO: Реализация подключения к камере и получения потока
+        
+        await self._connect_camera()
+        self._watch_task = asyncio.ensure_future(self._watch_camera())
     
-    async def get_stream_data(self) -> Optional[bytes]:
-        """Получение данных потока"""
-        # TODO: Реализация получения данных от камеры
-        return None
+    async def _connect_camera(self):
+        """Открытие RTSP сессии с камерой"""
+        self._session = _CameraSession(
+            self.camera_url, self.camera_username, self.camera_password, self._publish
+        )
+        self._paused = False
+        self.description = await self._session.connect()
+    
+    async def _watch_camera(self):
+        """Переподключение к камере при обрыве RTSP сессии"""
+        while self.running:
+            session = self._session
+            await session.rtsp.closed
+            if not self.running:
+                return
+            if session is not self._session:
+                continue  # Сессия закрыта при переключении потока
+            
+            logging.warning("[STREAM] RTSP сессия закрыта, переподключение...")
+            while self.running:
+                try:
+                    await self._connect_camera()
+                    break
+                except (OSError, RtspError, asyncio.TimeoutError) as e:
+                    logging.warning(f"[STREAM] Ошибка подключения к камере: {e}")
+                    await asyncio.sleep(self.reconnect_delay)
+    
+    async def switch_stream(self, index: int) -> bool:
+        """Переключение на другой поток камеры на границе ключевого кадра
+        
+        Новая сессия открывается параллельно текущей; кадры старой сессии
+        идут до первого ключевого кадра новой, после чего старая
+        закрывается. Возвращает True, если переключение выполнено.
+        """
+        if index >= len(self.camera_urls) or index == self.stream_index or self._switching:
+            return False
+        
+        self._switching = True
+        url = self.camera_urls[index]
+        switched = asyncio.get_running_loop().create_future()
+        
+        def on_access_unit(unit: AccessUnit):
+            if session is not self._session:
+                if switched.done() or not unit.keyframe:
+                    return
+                # Первый ключевой кадр нового потока - точка переключения
+                self._commit_switch(session)
+                switched.set_result(True)
+            self._publish(unit)
+        
+        session = _CameraSession(url, self.camera_username, self.camera_password, on_access_unit)
+        try:
+            description = await session.connect()
+            await asyncio.wait_for(asyncio.shield(switched), self.switch_timeout)
+            self.description = description
+            logging.info(f"[STREAM] Переключение на поток {url}")
+            return True
+        except (OSError, RtspError, asyncio.TimeoutError) as e:
+            logging.warning(f"[STREAM] Ошибка переключения потока: {e}")
+            if session is not self._session:
+                switched.cancel()
+                await session.rtsp.close()
+            return False
+        finally:
+            self._switching = False
+    
+    def _commit_switch(self, session: _CameraSession):
+        """Замена текущей сессии новой"""
+        previous = self._session
+        previous.on_access_unit = None  # Кадры старого потока больше не нужны
+        self._session = session
+        self.camera_url = session.url
+        if self._paused:
+            session.rtsp.pause_reading()
+        asyncio.ensure_future(previous.rtsp.close())
+    
+    @property
+    def queue_depth(self) -> int:
+        """Кадров в очереди на отправку"""
+        return self._queue.qsize() if self._queue else 0
+    
+    def _publish(self, unit: AccessUnit):
+        """Передача кадра отправителю
+
+        При достижении верхней границы очереди чтение сокета камеры
+        приостанавливается, поэтому медленная отправка не приводит к
+        накоплению данных.
+        """
+        if not self.running:
+            return
+        
+        unit.received_at = time.monotonic()
+        if self.on_input:
+            self.on_input(len(unit))
+        
+        self._queue.put_nowait(unit)
+        if not self._paused and self._queue.qsize() >= self.queue_size:
+            self._paused = True
+            self._session.rtsp.pause_reading()
+    
+    async def get_stream_data(self) -> Optional[AccessUnit]:
+        """Ожидание следующего кадра; None после остановки потока"""
+        if self._queue is None:
+            return None
+        data = await self._queue.get()
+        
+        if self._paused and self._queue.qsize() <= self.queue_size // 2:
+            self._paused = False
+            self._session.rtsp.resume_reading()
+        return data
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self) -> AccessUnit:
+        data = await self.get_stream_data()
+        if data is None:
+            raise StopAsyncIteration
+        return data
     
     async def stop(self):
         """Остановка обработки потока"""
         self.running = False
-        # TODO: Реализация остановки потока
+        
+        if self._watch_task:
+            self._watch_task.cancel()
+        if self._session:
+            await self._session.rtsp.close()
+        
+        if self._queue is not None:
+            # Пробуждение отправителя
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
 
 
 # Точка входа для агента
@@ -464,9 +1472,9 @@ async def main():
     # Загрузка конфигурации
     config = AgentConfig(
         agent_id=str(uuid.uuid4()),
-        cloud_server_url="wss://cloud.example.com/agent",
-        cloud_server_token="your_token_here",
-        camera_rtsp_url="rtsp://localhost:554/stream1",
+        tunnel_server_url="wss://cloud.example.com/agent",
+        tunnel_server_token="your_token_here",
+        stream_paths=["/stream1"],
         camera_username="admin",
         camera_password="password"
     )
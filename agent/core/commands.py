@@ -0,0 +1,114 @@
+"""
+Асинхронное выполнение команд платформы
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import shlex
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+Command = Union[str, Sequence[str]]
+
+
+@dataclass
+class CommandResult:
+    """Результат команды"""
+    command: str
+    returncode: int  # -1 - не запустилась или прервана по таймауту
+    stdout: bytes = b""
+    stderr: bytes = b""
+    duration: float = 0.0
+    timed_out: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+class CommandRunner:
+    """Запуск команд без блокировки цикла событий
+
+    Команды запускаются через create_subprocess_exec без оболочки;
+    независимые команды run_all выполняются одновременно, но не больше
+    concurrency процессов сразу - у камеры мало памяти и ядер. Команда,
+    не завершившаяся за timeout, завершается принудительно.
+    """
+
+    def __init__(self, concurrency: int = 2, timeout: float = 10.0):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        # Создается в цикле событий: экземпляр платформы создается при импорте
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.stats = {"commands": 0, "failed": 0, "timed_out": 0}
+
+    async def run(self, command: Command, timeout: Optional[float] = None) -> CommandResult:
+        """Выполнение команды; строка разбивается по правилам shell"""
+        argv = shlex.split(command) if isinstance(command, str) else list(command)
+        name = " ".join(argv)
+        timeout = self.timeout if timeout is None else timeout
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            self.stats["commands"] += 1
+            started = time.monotonic()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+                )
+            except OSError as e:
+                self.stats["failed"] += 1
+                logger.warning(f"[PLATFORM] Команда {name} не запущена: {e}")
+                return CommandResult(name, -1, stderr=str(e).encode())
+
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                # Процесс мог завершиться сам после истечения таймаута
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
+                self.stats["timed_out"] += 1
+                logger.warning(f"[PLATFORM] Команда {name} прервана через {timeout} с")
+                return CommandResult(name, -1, duration=time.monotonic() - started,
+                                     timed_out=True)
+            except asyncio.CancelledError:
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()  # Процесс не переживает остановку агента
+                raise
+
+        result = CommandResult(name, process.returncode, stdout, stderr,
+                               time.monotonic() - started)
+        if not result.ok:
+            self.stats["failed"] += 1
+            logger.warning(f"[PLATFORM] Команда {name} завершилась с кодом {result.returncode}: "
+                           f"{stderr.decode(errors='replace').strip()}")
+        return result
+
+    async def run_all(self, commands: List[Command]) -> List[CommandResult]:
+        """Одновременное выполнение независимых команд"""
+        return list(await asyncio.gather(*[self.run(command) for command in commands]))
+
+
+def write_value(path: str, value: Union[str, int]) -> bool:
+    """Запись в файл procfs/sysfs вместо запуска echo, sysctl -w"""
+    try:
+        with open(path, "w") as f:
+            f.write(f"{value}\n")
+        return True
+    except OSError as e:
+        logger.warning(f"[PLATFORM] Не удалось записать {path}: {e}")
+        return False
+
+
+def apply_sysctl(settings: Dict[str, Union[str, int]]) -> Dict[str, bool]:
+    """Параметры ядра через /proc/sys: net.ipv4.tcp_keepalive_time -> файл"""
+    return {
+        name: write_value(os.path.join("/proc/sys", *name.split(".")), value)
+        for name, value in settings.items()
+    }
@@ -0,0 +1,242 @@
+"""
+Метрики агента
+"""
+import asyncio
+import bisect
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Границы корзин для задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Границы корзин для размеров, байты
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Границы корзин для длительности переподключения, секунды
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600)
+
+Labels = Optional[Dict[str, str]]
+
+
+class Counter:
+    """Монотонный счетчик
+
+    Агент однопоточный (asyncio), поэтому увеличение - обычное сложение
+    без блокировок.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Gauge:
+    """Текущее значение; может вычисляться функцией при чтении"""
+    __slots__ = ("value", "function")
+
+    def __init__(self, function: Optional[Callable[[], float]] = None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин
+
+    Значение попадает в первую корзину, граница которой не меньше его;
+    значения больше последней границы учитываются в корзине +Inf.
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = sorted(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Учет значения"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Накопительные счетчики корзин в формате le -> количество"""
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            buckets[f"{bound:g}"] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": buckets
+        }
+
+
+class MetricsRegistry:
+    """Реестр метрик
+
+    Метрики создаются один раз, на горячем пути остается только
+    сложение в счетчике или корзине. Реестр отдает метрики в текстовом
+    формате Prometheus и в виде приращений для heartbeat.
+    """
+
+    def __init__(self):
+        # Имя -> (тип, описание, [(метки, метрика)])
+        self._families: Dict[str, Tuple[str, str, List[Tuple[str, Any]]]] = {}
+
+    def counter(self, name: str, description: str, labels: Labels = None) -> Counter:
+        return self.register(name, description, Counter(), labels)
+
+    def gauge(self, name: str, description: str, labels: Labels = None,
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(name, description, Gauge(function), labels)
+
+    def histogram(self, name: str, description: str, labels: Labels = None,
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(name, description, Histogram(buckets), labels)
+
+    def register(self, name: str, description: str, metric: Any, labels: Labels = None):
+        """Регистрация готовой метрики, например гистограммы планировщика"""
+        kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+        family = self._families.setdefault(name, (kind, description, []))
+        family[2].append((_format_labels(labels), metric))
+        return metric
+
+    def snapshot(self) -> Dict[str, float]:
+        """Значения метрик: имя{метки} -> значение"""
+        values = {}
+        for name, (kind, _, series) in self._families.items():
+            for labels, metric in series:
+                if kind == "histogram":
+                    values[f"{name}_count{labels}"] = metric.count
+                    values[f"{name}_sum{labels}"] = metric.sum
+                elif kind == "gauge":
+                    values[f"{name}{labels}"] = metric.get()
+                else:
+                    values[f"{name}{labels}"] = metric.value
+        return values
+
+    def delta(self, snapshot: Dict[str, float],
+              baseline: Dict[str, float]) -> Dict[str, Dict[str, float]]:
+        """Изменения с baseline: приращения счетчиков и новые значения gauge"""
+        gauges = self._gauge_keys()
+        counters: Dict[str, float] = {}
+        changed: Dict[str, float] = {}
+        for key, value in snapshot.items():
+            previous = baseline.get(key)
+            if key in gauges:
+                if value != previous:
+                    changed[key] = value
+            elif value != (previous or 0):
+                counters[key] = value - (previous or 0)
+        return {"counters": counters, "gauges": changed}
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        lines = []
+        for name, (kind, description, series) in self._families.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series:
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.bounds, metric.counts):
+                        cumulative += count
+                        lines.append(
+                            f"{name}_bucket{_add_label(labels, 'le', f'{bound:g}')} {cumulative}"
+                        )
+                    lines.append(f"{name}_bucket{_add_label(labels, 'le', '+Inf')} {metric.count}")
+                    lines.append(f"{name}_sum{labels} {_format_value(metric.sum)}")
+                    lines.append(f"{name}_count{labels} {metric.count}")
+                elif kind == "gauge":
+                    lines.append(f"{name}{labels} {_format_value(metric.get())}")
+                else:
+                    lines.append(f"{name}{labels} {_format_value(metric.value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+    def _gauge_keys(self) -> set:
+        return {
+            f"{name}{labels}"
+            for name, (kind, _, series) in self._families.items() if kind == "gauge"
+            for labels, _ in series
+        }
+
+
+class MetricsServer:
+    """HTTP endpoint /metrics для сборщика Prometheus"""
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info(f"[METRICS] Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, path = request.split(b" ", 2)[:2]
+            if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError,
+                ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _format_value(value: float) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+def _add_label(labels: str, key: str, value: str) -> str:
+    label = f'{key}="{value}"'
+    return "{" + label + "}" if not labels else labels[:-1] + "," + label + "}"
@@ -0,0 +1,72 @@
+"""
+Этапы запуска агента и их длительность
+"""
+import time
+from enum import Enum
+from typing import Any, Awaitable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class StageState(Enum):
+    """Готовность этапа запуска"""
+    PENDING = "pending"
+    RUNNING = "running"
+    READY = "ready"
+    FAILED = "failed"
+
+
+class StartupStages:
+    """Состояния и время этапов запуска
+
+    Этапы выполняются одновременно; для каждого сохраняется время
+    готовности от начала запуска (ready_at) и собственная длительность.
+    События без длительности (первый кадр) отмечаются mark().
+    """
+
+    def __init__(self, *names: str):
+        self.started_at: Optional[float] = None
+        self.states: Dict[str, StageState] = {name: StageState.PENDING for name in names}
+        self.durations: Dict[str, float] = {}
+        self.ready_at: Dict[str, float] = {}
+
+    def begin(self):
+        """Начало запуска: отсчет времени всех этапов"""
+        self.started_at = time.monotonic()
+        for name in self.states:
+            self.states[name] = StageState.PENDING
+        self.durations.clear()
+        self.ready_at.clear()
+
+    async def run(self, name: str, awaitable: Awaitable[T]) -> T:
+        """Выполнение этапа с учетом состояния и длительности"""
+        self.states[name] = StageState.RUNNING
+        started = time.monotonic()
+        try:
+            result = await awaitable
+        except BaseException:
+            self.states[name] = StageState.FAILED
+            raise
+        self.durations[name] = time.monotonic() - started
+        self.mark(name)
+        return result
+
+    def mark(self, name: str):
+        """Этап готов; повторные отметки не учитываются"""
+        if name in self.ready_at or self.started_at is None:
+            return
+        self.states[name] = StageState.READY
+        self.ready_at[name] = time.monotonic() - self.started_at
+
+    def ready(self, name: str) -> bool:
+        return self.states.get(name) == StageState.READY
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "state": state.value,
+                "seconds": self.durations.get(name),
+                "ready_at": self.ready_at.get(name)
+            }
+            for name, state in self.states.items()
+        }
@@ -0,0 +1,153 @@
+"""
+Фоновые задачи агента: учет, перезапуск, отмена
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from agent.core.metrics import Histogram
+from agent.networking.backoff import DecorrelatedJitterBackoff
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин задержки цикла событий, секунды
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+@dataclass
+class _Entry:
+    """Задача под наблюдением"""
+    task: asyncio.Task
+    restart: bool
+    backoff: DecorrelatedJitterBackoff
+    restarts: int = 0
+    failures: int = 0
+    last_error: str = ""
+
+
+class TaskSupervisor:
+    """Владелец фоновых задач агента
+
+    Задача регистрируется по имени; пока задача с этим именем работает,
+    повторный запуск возвращает ее же, поэтому переподключения не
+    плодят копии циклов. Исключение задачи записывается в журнал; задача
+    с restart=True запускается заново через задержку decorrelated
+    jitter, задержка сбрасывается после stable секунд работы. close()
+    отменяет все задачи и дожидается их завершения.
+    """
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0,
+                 stable: float = 60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable = stable
+        self._entries: Dict[str, _Entry] = {}
+
+    def spawn(self, name: str, factory: Callable[[], Awaitable[Any]],
+              restart: bool = False) -> asyncio.Task:
+        """Запуск задачи factory(); работающая задача с тем же именем не дублируется"""
+        entry = self._entries.get(name)
+        if entry and not entry.task.done():
+            return entry.task
+        backoff = entry.backoff if entry else DecorrelatedJitterBackoff(
+            self.base_delay, self.max_delay
+        )
+        task = asyncio.ensure_future(self._run(name, factory))
+        self._entries[name] = _Entry(task, restart, backoff,
+                                     entry.restarts if entry else 0,
+                                     entry.failures if entry else 0,
+                                     entry.last_error if entry else "")
+        return task
+
+    def supervise(self, name: str, factory: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        """Задача с перезапуском после исключения"""
+        return self.spawn(name, factory, restart=True)
+
+    def running(self, name: str) -> bool:
+        """Работает ли задача name, кроме текущей (задача проверяет не себя)"""
+        entry = self._entries.get(name)
+        return (entry is not None and not entry.task.done()
+                and entry.task is not asyncio.current_task())
+
+    async def cancel(self, name: str):
+        entry = self._entries.get(name)
+        if entry and not entry.task.done() and entry.task is not asyncio.current_task():
+            entry.task.cancel()
+            await asyncio.gather(entry.task, return_exceptions=True)
+
+    async def close(self):
+        """Отмена всех задач, кроме вызывающей"""
+        current = asyncio.current_task()
+        tasks = [entry.task for entry in self._entries.values()
+                 if not entry.task.done() and entry.task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "running": not entry.task.done(),
+                "restarts": entry.restarts,
+                "failures": entry.failures,
+                "last_error": entry.last_error
+            }
+            for name, entry in self._entries.items()
+        }
+
+    async def _run(self, name: str, factory: Callable[[], Awaitable[Any]]):
+        while True:
+            started = time.monotonic()
+            try:
+                return await factory()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                entry = self._entries[name]
+                entry.failures += 1
+                entry.last_error = repr(e)
+                logger.exception(f"[TASKS] Задача {name} завершилась с ошибкой")
+                if not entry.restart:
+                    return None
+                if time.monotonic() - started >= self.stable:
+                    entry.backoff.reset()
+                delay = entry.backoff.next_delay()
+
+            logger.info(f"[TASKS] Перезапуск задачи {name} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            entry.restarts += 1
+
+
+class LoopLagProbe:
+    """Задержка планирования цикла событий
+
+    Каждые interval секунд засыпает и измеряет, насколько позже
+    запрошенного проснулся: это время, на которое цикл был занят
+    другим кодом (синхронный вызов, тяжелый разбор, блокирующий ввод).
+    Задержки больше warn_threshold записываются в журнал.
+    """
+
+    def __init__(self, histogram: Optional[Histogram] = None, interval: float = 0.25,
+                 warn_threshold: float = 0.5):
+        self.histogram = histogram or Histogram(LAG_BUCKETS)
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.last = 0.0
+        self.max = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.histogram.observe(lag)
+            self.last = lag
+            self.max = max(self.max, lag)
+            if lag >= self.warn_threshold:
+                logger.warning(f"[TASKS] Цикл событий был занят {lag * 1000:.0f} мс")
+
+    def get_stats(self) -> Dict[str, float]:
+        return {"last": self.last, "max": self.max}
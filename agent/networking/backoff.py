@@ -0,0 +1,31 @@
+"""
+Экспоненциальная задержка переподключения со случайным разбросом
+"""
+import random
+from typing import Optional
+
+
+class DecorrelatedJitterBackoff:
+    """Задержка по схеме decorrelated jitter
+
+    Каждая следующая задержка выбирается случайно между base и утроенной
+    предыдущей (не больше cap), поэтому камеры, потерявшие сервер
+    одновременно, переподключаются вразнобой, а не волнами.
+    """
+
+    def __init__(self, base: float, cap: float):
+        self.base = base
+        self.cap = cap
+        self._delay = base
+
+    def next_delay(self, retry_after: Optional[float] = None) -> float:
+        """Следующая задержка с учетом подсказки сервера"""
+        self._delay = min(self.cap, random.uniform(self.base, self._delay * 3))
+        if retry_after is not None:
+            # Сервер просит подождать - не раньше указанного срока
+            return max(self._delay, retry_after)
+        return self._delay
+
+    def reset(self):
+        """Сброс после успешного подключения"""
+        self._delay = self.base
@@ -0,0 +1,103 @@
+"""
+Объединение мелких кадров в одну запись транспорта
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+from agent.networking.framing import pack_batch
+
+logger = logging.getLogger(__name__)
+
+MessageSender = Callable[[bytes], Awaitable[None]]
+
+
+class SendCoalescer:
+    """Пакетная отправка кадров
+
+    Кадры накапливаются и уходят одним сообщением, когда набран порог по
+    размеру, пришел кадр с признаком конца кадра видео или истекла
+    максимальная задержка с момента первого накопленного кадра.
+    """
+
+    def __init__(self, send_message: MessageSender, max_bytes: int = 16 * 1024,
+                 max_delay: float = 0.005):
+        self.send_message = send_message
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._lock = asyncio.Lock()
+
+        self.stats = {
+            "writes": 0,
+            "frames": 0,
+            "packets_per_write": 0.0,
+            "max_packets_per_write": 0,
+            "flush_size": 0,
+            "flush_marker": 0,
+            "flush_delay": 0,
+            "send_errors": 0
+        }
+
+    async def send(self, frame: bytes, end_of_unit: bool = False):
+        """Постановка кадра в очередь отправки"""
+        self._pending.append(frame)
+        self._pending_bytes += len(frame)
+
+        if end_of_unit:
+            await self.flush("marker")
+        elif self._pending_bytes >= self.max_bytes:
+            await self.flush("size")
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._on_timer
+            )
+
+    async def flush(self, reason: str = "marker"):
+        """Отправка накопленных кадров одним сообщением"""
+        # Снимок очереди берется под блокировкой, чтобы сообщения уходили
+        # в порядке постановки кадров
+        async with self._lock:
+            if not self._pending:
+                return
+
+            frames = self._pending
+            self._pending = []
+            self._pending_bytes = 0
+            self._cancel_timer()
+
+            message = frames[0] if len(frames) == 1 else pack_batch(frames)
+            await self.send_message(message)
+
+            stats = self.stats
+            stats["writes"] += 1
+            stats["frames"] += len(frames)
+            stats["packets_per_write"] = stats["frames"] / stats["writes"]
+            stats["max_packets_per_write"] = max(stats["max_packets_per_write"], len(frames))
+            stats[f"flush_{reason}"] += 1
+
+    def close(self):
+        """Отмена таймера и сброс очереди"""
+        self._cancel_timer()
+        self._pending = []
+        self._pending_bytes = 0
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self._flush_delayed())
+
+    async def _flush_delayed(self):
+        try:
+            await self.flush("delay")
+        except Exception as e:
+            # Ошибку соединения обработает цикл приема
+            self.stats["send_errors"] += 1
+            logger.debug(f"[SEND] Ошибка отложенной отправки: {e}")
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
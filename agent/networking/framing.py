@@ -0,0 +1,56 @@
+"""
+Двоичные кадры соединения агента с сервером
+"""
+import struct
+from typing import List
+
+# Общий заголовок кадра: тип, флаги, канал
+HEADER = struct.Struct("!BBH")
+
+# Медиа кадр: общий заголовок + последовательность и RTP timestamp,
+# затем кадр видео без какой-либо обертки
+MEDIA = 0x01
+MEDIA_HEADER = struct.Struct("!BBHII")
+
+# Пакет из нескольких кадров в одном сообщении: общий заголовок, затем
+# для каждого кадра длина (!I) и сам кадр
+BATCH = 0x02
+LENGTH = struct.Struct("!I")
+
+# Флаги медиа кадра
+FLAG_KEYFRAME = 0x01
+FLAG_PARAMETER_SETS = 0x02
+FLAG_AU_START = 0x04
+FLAG_AU_END = 0x08
+FLAG_SPOOLED = 0x10  # Кадр из хранилища, записанный во время обрыва
+
+# Кадры туннеля
+TUNNEL_OPEN = 0x10    # Открытие канала, полезная нагрузка: порт (!H)
+TUNNEL_DATA = 0x11    # Данные канала
+TUNNEL_WINDOW = 0x12  # Выдача кредита отправителю, полезная нагрузка: байты (!I)
+TUNNEL_FIN = 0x13     # Полузакрытие: отправитель больше не пишет в канал
+TUNNEL_RST = 0x14     # Аварийное закрытие канала
+
+PORT = struct.Struct("!H")
+CREDIT = struct.Struct("!I")
+
+
+def pack_frame(frame_type: int, channel: int, payload: bytes = b"", flags: int = 0) -> bytes:
+    """Сборка кадра из заголовка и полезной нагрузки"""
+    return HEADER.pack(frame_type, flags, channel) + payload
+
+
+def pack_media_frame(channel: int, sequence: int, timestamp: int,
+                     payload: bytes, flags: int = 0) -> bytes:
+    """Сборка медиа кадра"""
+    return MEDIA_HEADER.pack(MEDIA, flags, channel, sequence & 0xFFFFFFFF,
+                             timestamp & 0xFFFFFFFF) + payload
+
+
+def pack_batch(frames: List[bytes]) -> bytes:
+    """Объединение кадров в один пакет"""
+    parts = [HEADER.pack(BATCH, 0, 0)]
+    for frame in frames:
+        parts.append(LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return b"".join(parts)
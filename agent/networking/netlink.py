@@ -0,0 +1,312 @@
+"""
+Отслеживание адресов и маршрутов через rtnetlink
+"""
+import asyncio
+import errno
+import logging
+import socket
+import struct
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Заголовки сообщений (linux/netlink.h, linux/rtnetlink.h)
+NLMSGHDR = struct.Struct("=IHHII")   # длина, тип, флаги, номер, pid
+IFADDRMSG = struct.Struct("=BBBBI")  # семейство, префикс, флаги, область, интерфейс
+RTMSG = struct.Struct("=BBBBBBBBI")  # семейство, dst_len, src_len, tos, таблица, протокол, область, тип, флаги
+RTATTR = struct.Struct("=HH")        # длина, тип
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_PREFSRC = 7
+RTA_TABLE = 15
+
+RT_TABLE_MAIN = 254
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+NETLINK_GROUPS = RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE
+
+# (основной адрес, шлюз по умолчанию)
+NetworkState = Tuple[Optional[str], Optional[str]]
+
+
+class RouteTable:
+    """Адреса интерфейсов и маршруты по умолчанию из сообщений rtnetlink"""
+
+    def __init__(self):
+        self.addresses: Dict[Tuple[int, str], int] = {}  # (интерфейс, адрес) -> семейство
+        # (семейство, интерфейс, метрика) -> (шлюз, адрес источника)
+        self.default_routes: Dict[Tuple[int, int, int], Tuple[Optional[str], Optional[str]]] = {}
+
+    def apply(self, message_type: int, payload: memoryview) -> bool:
+        """Учет сообщения; True, если это сообщение об адресе или маршруте"""
+        if message_type in (RTM_NEWADDR, RTM_DELADDR):
+            self._apply_address(message_type == RTM_NEWADDR, payload)
+        elif message_type in (RTM_NEWROUTE, RTM_DELROUTE):
+            self._apply_route(message_type == RTM_NEWROUTE, payload)
+        else:
+            return False
+        return True
+
+    def state(self) -> NetworkState:
+        """Основной адрес (IPv4 предпочтительнее) и шлюз по умолчанию
+
+        Из нескольких маршрутов по умолчанию ядро выбирает маршрут с
+        наименьшей метрикой; так же и здесь.
+        """
+        for family in (socket.AF_INET, socket.AF_INET6):
+            routes = [(priority, index, route) for (route_family, index, priority), route
+                      in self.default_routes.items() if route_family == family]
+            for _, index, (gateway, source) in sorted(routes):
+                address = source or self._address_on(index, family)
+                if address:
+                    return address, gateway
+        for family in (socket.AF_INET, socket.AF_INET6):
+            addresses = sorted(address for (_, address), address_family
+                               in self.addresses.items() if address_family == family)
+            if addresses:
+                return addresses[0], None
+        return None, None
+
+    def _address_on(self, index: int, family: int) -> Optional[str]:
+        for (address_index, address), address_family in sorted(self.addresses.items()):
+            if address_index == index and address_family == family:
+                return address
+        return None
+
+    def _apply_address(self, added: bool, payload: memoryview):
+        family, _, _, scope, index = IFADDRMSG.unpack_from(payload)
+        if scope != RT_SCOPE_UNIVERSE or family not in (socket.AF_INET, socket.AF_INET6):
+            return  # Адреса loopback и link-local не ведут наружу
+        attributes = dict(_attributes(payload, IFADDRMSG.size))
+        raw = attributes.get(IFA_LOCAL) or attributes.get(IFA_ADDRESS)
+        if raw is None:
+            return
+        key = (index, socket.inet_ntop(family, raw))
+        if added:
+            self.addresses[key] = family
+        else:
+            self.addresses.pop(key, None)
+
+    def _apply_route(self, added: bool, payload: memoryview):
+        family, dst_len, _, _, table, _, _, route_type, _ = RTMSG.unpack_from(payload)
+        if dst_len != 0 or route_type != RTN_UNICAST:
+            return  # Нужен только маршрут по умолчанию
+        attributes = dict(_attributes(payload, RTMSG.size))
+        if RTA_TABLE in attributes:
+            (table,) = struct.unpack("=I", attributes[RTA_TABLE])
+        if table != RT_TABLE_MAIN or RTA_OIF not in attributes:
+            return
+        (index,) = struct.unpack("=I", attributes[RTA_OIF])
+        priority = 0
+        if RTA_PRIORITY in attributes:
+            (priority,) = struct.unpack("=I", attributes[RTA_PRIORITY])
+        key = (family, index, priority)
+        if added:
+            gateway = attributes.get(RTA_GATEWAY)
+            source = attributes.get(RTA_PREFSRC)
+            self.default_routes[key] = (
+                socket.inet_ntop(family, gateway) if gateway else None,
+                socket.inet_ntop(family, source) if source else None
+            )
+        else:
+            self.default_routes.pop(key, None)
+
+
+class AddressMonitor:
+    """Подписка на изменения адресов и маршрутов (rtnetlink)
+
+    Сообщения ядра приходят в сокет, который читает цикл событий;
+    опрос не нужен. После пачки изменений (обновление аренды DHCP
+    удаляет и добавляет адрес) выжидается debounce секунд, и если
+    основной адрес или шлюз изменились, вызывается on_change(старое,
+    новое состояние).
+    """
+
+    def __init__(self, on_change: Callable[[NetworkState, NetworkState], None],
+                 debounce: float = 1.0):
+        self.on_change = on_change
+        self.debounce = debounce
+        self.table = RouteTable()
+        self.state: NetworkState = (None, None)
+        self.stats = {"events": 0, "changes": 0, "resyncs": 0}
+        self._socket: Optional[socket.socket] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._resync_task: Optional[asyncio.Task] = None
+
+    @property
+    def available(self) -> bool:
+        return self._socket is not None
+
+    async def start(self) -> NetworkState:
+        """Подписка и начальное состояние; без rtnetlink - (None, None)"""
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, NETLINK_GROUPS))
+            sock.setblocking(False)
+        except (AttributeError, OSError) as e:
+            # Не Linux или нет прав - остается переподключение по таймауту
+            logger.warning(f"[NETLINK] Отслеживание адресов недоступно: {e}")
+            return self.state
+
+        self._socket = sock
+        # Подписка раньше снимка: изменение между ними не теряется
+        if not await self._resync():
+            self.close()
+            return self.state
+        self.state = self.table.state()
+        return self.state
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._resync_task:
+            self._resync_task.cancel()
+            self._resync_task = None
+        if self._socket:
+            asyncio.get_running_loop().remove_reader(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # Очередь сокета переполнена - события потеряны
+                    self.stats["resyncs"] += 1
+                    self._resync_task = asyncio.ensure_future(self._recover())
+                    return
+                logger.error(f"[NETLINK] Ошибка чтения: {e}")
+                return
+            for message_type, payload in _messages(data):
+                if self.table.apply(message_type, payload):
+                    self.stats["events"] += 1
+        self._schedule_settle()
+
+    def _schedule_settle(self):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.debounce, self._settle)
+
+    async def _recover(self):
+        if await self._resync():
+            self._schedule_settle()
+        self._resync_task = None
+
+    def _settle(self):
+        self._timer = None
+        state = self.table.state()
+        if state == self.state:
+            return
+        previous, self.state = self.state, state
+        self.stats["changes"] += 1
+        logger.info(f"[NETLINK] Сеть изменилась: {previous} -> {state}")
+        self.on_change(previous, state)
+
+    async def _resync(self) -> bool:
+        """Снимок адресов и маршрутов в исполнителе
+
+        Пока идет снимок, сокет подписки не читается: накопившиеся в нем
+        события применяются к снимку по порядку, как и при старте.
+        """
+        loop = asyncio.get_running_loop()
+        fd = self._socket.fileno()
+        loop.remove_reader(fd)
+        try:
+            messages = await loop.run_in_executor(None, dump)
+        except OSError as e:
+            logger.warning(f"[NETLINK] Снимок таблицы маршрутов не удался: {e}")
+            return False
+        else:
+            table = RouteTable()
+            for message_type, payload in messages:
+                table.apply(message_type, payload)
+            self.table = table
+            return True
+        finally:
+            # Подписка продолжает читаться и после неудачного снимка
+            if self._socket is not None:
+                loop.add_reader(fd, self._on_readable)
+
+
+def dump() -> List[Tuple[int, memoryview]]:
+    """Текущие адреса и маршруты (запросы RTM_GETADDR, RTM_GETROUTE)"""
+    messages = []
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+        sock.settimeout(1.0)
+        sock.bind((0, 0))
+        for sequence, (message_type, header) in enumerate((
+            (RTM_GETADDR, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)),
+            (RTM_GETROUTE, RTMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0, 0, 0)),
+        ), start=1):
+            sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(header), message_type,
+                                    NLM_F_REQUEST | NLM_F_DUMP, sequence, 0) + header)
+            done = False
+            while not done:
+                for reply_type, payload in _messages(sock.recv(65536)):
+                    if reply_type in (NLMSG_DONE, NLMSG_ERROR):
+                        done = True
+                    else:
+                        messages.append((reply_type, payload))
+    return messages
+
+
+def detect_primary_address() -> Optional[str]:
+    """Основной адрес по таблице маршрутов ядра
+
+    В отличие от подключения UDP сокета к внешнему адресу, работает и в
+    изолированной сети; вне Linux возвращает None.
+    """
+    try:
+        table = RouteTable()
+        for message_type, payload in dump():
+            table.apply(message_type, payload)
+        return table.state()[0]
+    except (AttributeError, OSError) as e:
+        logger.debug(f"[NETLINK] Таблица маршрутов недоступна: {e}")
+        return None
+
+
+def _messages(data: bytes) -> Iterator[Tuple[int, memoryview]]:
+    view = memoryview(data)
+    offset = 0
+    while offset + NLMSGHDR.size <= len(view):
+        length, message_type, _, _, _ = NLMSGHDR.unpack_from(view, offset)
+        if length < NLMSGHDR.size or offset + length > len(view):
+            return
+        yield message_type, view[offset + NLMSGHDR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+def _attributes(payload: memoryview, offset: int) -> Iterator[Tuple[int, bytes]]:
+    while offset + RTATTR.size <= len(payload):
+        length, attribute_type = RTATTR.unpack_from(payload, offset)
+        if length < RTATTR.size:
+            return
+        yield attribute_type, bytes(payload[offset + RTATTR.size:offset + length])
+        offset += (length + 3) & ~3
@@ -0,0 +1,69 @@
+"""
+Сглаживание отправки кадров видео по времени
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from agent.core.metrics import Histogram
+
+ChunkSender = Callable[[memoryview, bool, bool], Awaitable[None]]
+
+
+class MediaPacer:
+    """Равномерная отправка кадра в пределах его интервала
+
+    Кадр больше chunk_size делится на фрагменты, которые распределяются
+    по интервалу кадра, вычисленному из разницы RTP timestamp соседних
+    кадров. Общую скорость ограничивает StreamScheduler. Ключевой кадр
+    H.265 4MP в 10-20 раз больше P-кадра и, отправленный разом,
+    переполняет буфер модема.
+    """
+
+    def __init__(self, chunk_size: int = 16 * 1024, clock_rate: int = 90000,
+                 default_interval: float = 0.04, max_interval: float = 1.0):
+        self.chunk_size = chunk_size
+        self.clock_rate = clock_rate
+        self.interval = default_interval
+        self.max_interval = max_interval
+        self.delay_histogram = Histogram()
+        self._last_timestamp = None
+
+    async def pace(self, data: bytes, timestamp: int, send_chunk: ChunkSender) -> float:
+        """Отправка кадра фрагментами; возвращает суммарное ожидание"""
+        self._update_interval(timestamp)
+
+        view = memoryview(data)
+        size = len(view)
+        chunks = max(1, -(-size // self.chunk_size))
+        spacing = self.interval / chunks
+
+        started = time.monotonic()
+        waited = 0.0
+        for index in range(chunks):
+            chunk = view[index * self.chunk_size:(index + 1) * self.chunk_size]
+            # Фрагмент не раньше своей доли интервала
+            delay = started + index * spacing - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                waited += delay
+            await send_chunk(chunk, index == 0, index == chunks - 1)
+
+        self.delay_histogram.observe(waited)
+        return waited
+
+    def get_stats(self) -> dict:
+        """Гистограмма задержки сглаживания"""
+        return {
+            "interval": round(self.interval, 4),
+            "delay": self.delay_histogram.get_stats()
+        }
+
+    def _update_interval(self, timestamp: int):
+        """Интервал кадра по RTP timestamp"""
+        if self._last_timestamp is not None:
+            delta = ((timestamp - self._last_timestamp) & 0xFFFFFFFF) / self.clock_rate
+            # Скачок timestamp (переключение потока) или повтор - старое значение
+            if 0 < delta <= self.max_interval:
+                self.interval = delta
+        self._last_timestamp = timestamp
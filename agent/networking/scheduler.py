@@ -0,0 +1,176 @@
+"""
+Взвешенное разделение соединения между потоками
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Deque, Dict, List
+
+from agent.core.metrics import Histogram
+
+
+class TokenBucket:
+    """Ограничение скорости с допустимым всплеском burst байт"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate  # Байт/с, 0 - без ограничения
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def reserve(self, nbytes: int, now: float) -> float:
+        """Списание nbytes; возвращает время ожидания до их отправки"""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # Баланс может уйти в минус, если фрагмент больше остатка
+        self.tokens -= nbytes
+        return max(0.0, -self.tokens / self.rate)
+
+
+class _StreamState:
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.finish_tag = 0.0
+        self.waiting = 0
+        self.wait_histogram = Histogram()
+        self.stats = {"fragments": 0, "bytes": 0}
+
+
+class StreamScheduler:
+    """Очередь отправки нескольких потоков по одному соединению
+
+    Фрагменты получают право на отправку по одному в порядке
+    виртуального времени начала (start-time fair queueing): поток с весом
+    4 получает вчетверо большую долю канала, а кадр живого подпотока ждет
+    не весь ключевой кадр основного потока, а только текущий фрагмент.
+    Общая скорость ограничена корзиной токенов.
+
+    Управляющие сообщения (heartbeat, статус, ответы на команды) идут по
+    отдельной полосе со строгим приоритетом: следующее право на отправку
+    всегда получает управляющее сообщение, корзина токенов к ним не
+    применяется, а фрагмент, ожидающий токенов, их не задерживает.
+    """
+
+    def __init__(self, max_rate: float = 0, burst: int = 64 * 1024):
+        self.bucket = TokenBucket(max_rate, burst)
+        self._streams: Dict[int, _StreamState] = {}
+        self._queue: List[Any] = []  # (start_tag, порядок, future)
+        self._control: Deque[asyncio.Future] = deque()
+        self.control_stats = {"messages": 0, "waited": 0}
+        self._order = itertools.count()
+        self._virtual_time = 0.0
+        self._busy = False
+        self._throttled = False  # Владелец права ждет токенов и не пишет
+
+    def add_stream(self, channel: int, name: str, weight: float = 1.0):
+        """Регистрация потока с весом"""
+        self._streams[channel] = _StreamState(name, weight)
+
+    def wait_histogram(self, channel: int) -> Histogram:
+        """Гистограмма ожидания права на отправку потока"""
+        return self._streams[channel].wait_histogram
+
+    @asynccontextmanager
+    async def slot(self, channel: int, nbytes: int):
+        """Право на отправку фрагмента nbytes байт потока channel"""
+        state = self._streams.get(channel)
+        if state is None:
+            state = self._streams[channel] = _StreamState(f"channel{channel}", 1.0)
+
+        start_tag = max(self._virtual_time, state.finish_tag)
+        state.finish_tag = start_tag + nbytes / state.weight
+        started = time.monotonic()
+
+        state.waiting += 1
+        try:
+            await self._acquire(lambda waiter: heapq.heappush(
+                self._queue, (start_tag, next(self._order), waiter)
+            ))
+        finally:
+            state.waiting -= 1
+
+        try:
+            self._virtual_time = start_tag
+            delay = self.bucket.reserve(nbytes, time.monotonic())
+            if delay > 0:
+                self._throttled = True
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self._throttled = False
+
+            state.wait_histogram.observe(time.monotonic() - started)
+            state.stats["fragments"] += 1
+            state.stats["bytes"] += nbytes
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def control_slot(self):
+        """Право на отправку управляющего сообщения вне очереди медиа"""
+        self.control_stats["messages"] += 1
+        if self._throttled:
+            # Соединение свободно, фрагмент медиа только ждет токенов
+            yield
+            return
+
+        if self._busy:
+            self.control_stats["waited"] += 1
+        await self._acquire(self._control.append)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, enqueue: Callable[[asyncio.Future], None]):
+        """Ожидание права на отправку; enqueue ставит ожидание в очередь"""
+        if not self._busy:
+            self._busy = True
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        enqueue(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # Право уже передано этой задаче
+            else:
+                waiter.cancel()
+            raise
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счетчики и гистограммы ожидания по потокам"""
+        stats: Dict[str, Any] = {
+            state.name: dict(
+                state.stats,
+                weight=state.weight,
+                waiting=state.waiting,
+                wait=state.wait_histogram.get_stats()
+            )
+            for state in self._streams.values()
+        }
+        stats["control"] = dict(self.control_stats)
+        return stats
+
+    def _release(self):
+        """Передача права управляющему сообщению, иначе следующему по
+        виртуальному времени фрагменту"""
+        while self._control:
+            waiter = self._control.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        while self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._busy = False
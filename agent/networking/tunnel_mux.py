@@ -0,0 +1,282 @@
+"""
+Мультиплексирование TCP соединений через одно соединение агента
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from agent.networking.framing import (
+    CREDIT, HEADER, PORT, TUNNEL_DATA, TUNNEL_FIN, TUNNEL_OPEN, TUNNEL_RST,
+    TUNNEL_WINDOW, pack_frame
+)
+
+logger = logging.getLogger(__name__)
+
+FrameSender = Callable[[bytes], Awaitable[None]]
+
+# Обработчик входящего канала вместо подключения к локальному порту
+ChannelHandler = Callable[["TunnelChannel"], Awaitable[None]]
+
+
+class TunnelChannel:
+    """Логический TCP поток внутри туннеля
+
+    Отправитель пишет не больше выданного получателем кредита, поэтому
+    медленный потребитель одного канала не задерживает остальные каналы.
+    Кредит возвращается по мере чтения данных из канала.
+    """
+
+    def __init__(self, mux: "TunnelMultiplexer", channel_id: int, port: int):
+        self.mux = mux
+        self.id = channel_id
+        self.port = port
+
+        self._send_credit = mux.window
+        self._credit_event = asyncio.Event()
+        self._credit_event.set()
+
+        self._received = collections.deque()
+        self._data_event = asyncio.Event()
+        self._consumed = 0
+
+        self.local_closed = False   # Мы отправили FIN
+        self.remote_closed = False  # Получен FIN
+        self.reset = False
+
+    async def read(self) -> bytes:
+        """Чтение очередного блока данных; b"" - конец потока"""
+        while not self._received:
+            if self.remote_closed or self.reset:
+                return b""
+            self._data_event.clear()
+            await self._data_event.wait()
+
+        data = self._received.popleft()
+        self._consumed += len(data)
+        if self._consumed >= self.mux.window // 2 and not self.reset:
+            # Возврат кредита пачкой, а не на каждый блок
+            credit, self._consumed = self._consumed, 0
+            await self.mux._send(pack_frame(TUNNEL_WINDOW, self.id, CREDIT.pack(credit)))
+        return data
+
+    async def write(self, data: bytes):
+        """Отправка данных с ожиданием кредита"""
+        view = memoryview(data)
+        while view:
+            while self._send_credit <= 0:
+                if self.reset:
+                    raise ConnectionResetError(f"Канал {self.id} сброшен")
+                self._credit_event.clear()
+                await self._credit_event.wait()
+            if self.reset or self.local_closed:
+                raise ConnectionResetError(f"Канал {self.id} закрыт")
+
+            size = min(self._send_credit, len(view), self.mux.max_frame)
+            self._send_credit -= size
+            await self.mux._send(pack_frame(TUNNEL_DATA, self.id, view[:size]))
+            self.mux.stats["bytes_sent"] += size
+            view = view[size:]
+
+    async def write_eof(self):
+        """Полузакрытие: больше не пишем, но продолжаем читать"""
+        if not self.local_closed and not self.reset:
+            self.local_closed = True
+            await self.mux._send(pack_frame(TUNNEL_FIN, self.id))
+            self.mux._release_if_done(self)
+
+    async def abort(self):
+        """Аварийное закрытие канала"""
+        if not self.reset:
+            self._on_reset()
+            await self.mux._send(pack_frame(TUNNEL_RST, self.id))
+
+    def _on_data(self, data: memoryview):
+        self._received.append(data)
+        self._data_event.set()
+
+    def _on_credit(self, credit: int):
+        self._send_credit += credit
+        self._credit_event.set()
+
+    def _on_fin(self):
+        self.remote_closed = True
+        self._data_event.set()
+        self.mux._release_if_done(self)
+
+    def _on_reset(self):
+        self.reset = True
+        self._data_event.set()
+        self._credit_event.set()
+        self.mux.channels.pop(self.id, None)
+
+
+async def pipe(channel: TunnelChannel, reader: asyncio.StreamReader,
+               writer: asyncio.StreamWriter):
+    """Связывание канала туннеля с локальным TCP соединением"""
+
+    async def upstream():
+        # Локальный сокет -> канал
+        while True:
+            data = await reader.read(channel.mux.max_frame)
+            if not data:
+                await channel.write_eof()
+                return
+            await channel.write(data)
+
+    async def downstream():
+        # Канал -> локальный сокет; кредит возвращается после drain
+        while True:
+            data = await channel.read()
+            if not data:
+                if writer.can_write_eof():
+                    writer.write_eof()
+                return
+            writer.write(data)
+            await writer.drain()
+
+    tasks = [asyncio.ensure_future(upstream()), asyncio.ensure_future(downstream())]
+    try:
+        await asyncio.gather(*tasks)
+    except (ConnectionError, OSError) as e:
+        # Обрыв сокета или туннеля (в том числе при возврате кредита):
+        # закрываются обе стороны канала
+        logger.debug(f"[TUNNEL] Канал {channel.id} прерван: {e}")
+        with contextlib.suppress(ConnectionError):
+            await channel.abort()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+
+class TunnelMultiplexer:
+    """Мультиплексор каналов поверх потока кадров
+
+    Транспорт не фиксирован: кадры отправляются через send_frame, а
+    принятые кадры передаются в feed_frame (одно сообщение WebSocket -
+    один кадр). Каналы открывает сторона сервера; сторона агента
+    подключается к локальному порту камеры из списка разрешенных либо
+    передает канал обработчику порта из handlers.
+    """
+
+    def __init__(self, send_frame: FrameSender, initiator: bool = False,
+                 allowed_ports: Optional[List[int]] = None,
+                 local_host: str = "127.0.0.1",
+                 window: int = 256 * 1024, max_frame: int = 16 * 1024,
+                 handlers: Optional[Dict[int, ChannelHandler]] = None):
+        self.send_frame = send_frame
+        self.allowed_ports = allowed_ports or []
+        self.handlers = handlers or {}
+        self.local_host = local_host
+        self.window = window
+        self.max_frame = max_frame
+        self.channels: Dict[int, TunnelChannel] = {}
+
+        # Нечетные идентификаторы у инициатора, четные у другой стороны
+        self._next_id = 1 if initiator else 2
+        self._send_lock = asyncio.Lock()
+        self._tasks = set()
+
+        self.stats = {
+            "channels_opened": 0,
+            "channels_rejected": 0,
+            "bytes_sent": 0,
+            "bytes_received": 0
+        }
+
+    async def open_channel(self, port: int) -> TunnelChannel:
+        """Открытие канала до порта на другой стороне"""
+        channel_id = self._next_id
+        self._next_id += 2
+        if self._next_id > 0xFFFF:
+            self._next_id -= 0xFFFE
+
+        channel = TunnelChannel(self, channel_id, port)
+        self.channels[channel_id] = channel
+        self.stats["channels_opened"] += 1
+        await self._send(pack_frame(TUNNEL_OPEN, channel_id, PORT.pack(port)))
+        return channel
+
+    def feed_frame(self, frame: bytes):
+        """Обработка принятого кадра туннеля"""
+        frame_type, _, channel_id = HEADER.unpack_from(frame)
+        payload = memoryview(frame)[HEADER.size:]
+        channel = self.channels.get(channel_id)
+
+        if frame_type == TUNNEL_OPEN:
+            self._accept(channel_id, PORT.unpack(payload)[0])
+        elif channel is None:
+            return  # Канал уже закрыт
+        elif frame_type == TUNNEL_DATA:
+            self.stats["bytes_received"] += len(payload)
+            channel._on_data(payload)
+        elif frame_type == TUNNEL_WINDOW:
+            channel._on_credit(CREDIT.unpack(payload)[0])
+        elif frame_type == TUNNEL_FIN:
+            channel._on_fin()
+        elif frame_type == TUNNEL_RST:
+            channel._on_reset()
+
+    def close(self):
+        """Сброс всех каналов при потере соединения"""
+        for channel in list(self.channels.values()):
+            channel._on_reset()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def _accept(self, channel_id: int, port: int):
+        """Входящий канал: регистрация до прихода первых данных"""
+        channel = TunnelChannel(self, channel_id, port)
+        if port not in self.allowed_ports:
+            logger.warning(f"[TUNNEL] Порт {port} не разрешен для туннеля")
+            self.stats["channels_rejected"] += 1
+            self._spawn(channel.abort())
+            return
+
+        self.channels[channel_id] = channel
+        handler = self.handlers.get(port)
+        if handler:
+            self.stats["channels_opened"] += 1
+            self._spawn(handler(channel))
+        else:
+            self._spawn(self._connect_local(channel))
+
+    async def _connect_local(self, channel: TunnelChannel):
+        """Подключение канала к локальному порту"""
+        try:
+            reader, writer = await asyncio.open_connection(self.local_host, channel.port)
+        except OSError as e:
+            logger.warning(f"[TUNNEL] Ошибка подключения к {self.local_host}:{channel.port}: {e}")
+            self.stats["channels_rejected"] += 1
+            await channel.abort()
+            return
+
+        self.stats["channels_opened"] += 1
+        await pipe(channel, reader, writer)
+
+    async def _send(self, frame: bytes):
+        """Отправка кадра; ошибка транспорта - ConnectionResetError
+
+        Транспорт у сторон разный (websockets у агента, Starlette у
+        сервера), каналы видят одну ошибку обрыва.
+        """
+        # Блокировка выдает доступ к транспорту каналам по очереди
+        async with self._send_lock:
+            try:
+                await self.send_frame(frame)
+            except (ConnectionError, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                raise ConnectionResetError(f"Туннель закрыт: {e!r}") from e
+
+    def _release_if_done(self, channel: TunnelChannel):
+        if channel.local_closed and channel.remote_closed:
+            self.channels.pop(channel.id, None)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
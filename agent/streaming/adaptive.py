@@ -0,0 +1,164 @@
+"""
+Выбор между основным потоком и подпотоком по состоянию канала
+"""
+import time
+from typing import Optional
+
+MAIN_STREAM = 0
+SUBSTREAM = 1
+
+
+class AdaptiveStreamSelector:
+    """Адаптивное переключение основной поток / подпоток
+
+    По отправленным кадрам оцениваются полезная пропускная способность
+    (goodput) и задержка в очереди отправки. Переход на подпоток - при
+    устойчивом росте задержки или отставании goodput от битрейта потока;
+    возврат на основной поток - пробный, после долгого периода без
+    перегрузки. Неудачная проба удваивает срок до следующей.
+    """
+
+    def __init__(self, high_delay: float = 1.0, low_delay: float = 0.2,
+                 down_hold: float = 3.0, up_hold: float = 30.0,
+                 max_up_hold: float = 600.0, goodput_ratio: float = 0.8,
+                 window: float = 1.0, alpha: float = 0.3,
+                 initial: int = MAIN_STREAM):
+        self.high_delay = high_delay
+        self.low_delay = low_delay
+        self.down_hold = down_hold
+        self.base_up_hold = up_hold
+        self.up_hold = up_hold
+        self.max_up_hold = max_up_hold
+        self.goodput_ratio = goodput_ratio
+        self.window = window
+        self.alpha = alpha
+
+        self.current = initial
+        self.goodput = 0.0      # Байт/с, сглаженное
+        self.input_rate = 0.0   # Байт/с, битрейт текущего потока
+        self.queue_delay = 0.0  # Секунды, сглаженное
+
+        now = time.monotonic()
+        self._window_start = now
+        self._window_sent = 0
+        self._window_input = 0
+        self._window_delay = 0.0
+        self._congested_since: Optional[float] = None
+        self._clear_since: Optional[float] = now
+        self._switched_at = now
+
+        self.stats = {
+            "switches_down": 0,
+            "switches_up": 0,
+            "failed_probes": 0
+        }
+
+    def record_input(self, nbytes: int):
+        """Кадр получен с камеры"""
+        self._window_input += nbytes
+
+    def record_sent(self, nbytes: int, queue_delay: float):
+        """Кадр отправлен; queue_delay - время от получения с камеры"""
+        self._window_sent += nbytes
+        self._window_delay = max(self._window_delay, queue_delay)
+
+    def decide(self, pending_delay: float = 0.0,
+               now: Optional[float] = None) -> Optional[int]:
+        """Поток, на который нужно переключиться, или None
+
+        pending_delay - возраст кадра, отправка которого еще не завершилась:
+        при полной остановке канала отправленных кадров нет, но задержка
+        растет.
+        """
+        now = time.monotonic() if now is None else now
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return None
+        self._close_window(now, elapsed, pending_delay)
+
+        congested = self.queue_delay > self.high_delay or (
+            self.input_rate > 0 and self.goodput < self.input_rate * self.goodput_ratio
+        )
+        clear = self.queue_delay < self.low_delay and not congested
+
+        if congested:
+            self._clear_since = None
+            if self._congested_since is None:
+                self._congested_since = now
+        else:
+            self._congested_since = None
+            if clear and self._clear_since is None:
+                self._clear_since = now
+            elif not clear:
+                self._clear_since = None
+
+        if self.current == MAIN_STREAM:
+            if self._congested_since is not None and now - self._congested_since >= self.down_hold:
+                if now - self._switched_at < self.up_hold:
+                    # Проба основного потока не удалась
+                    self.stats["failed_probes"] += 1
+                    self.up_hold = min(self.up_hold * 2, self.max_up_hold)
+                return SUBSTREAM
+        elif self._clear_since is not None and now - self._clear_since >= self.up_hold:
+            return MAIN_STREAM
+        return None
+
+    def switched(self, index: int, now: Optional[float] = None):
+        """Переключение выполнено"""
+        now = time.monotonic() if now is None else now
+        if index == MAIN_STREAM:
+            self.stats["switches_up"] += 1
+        else:
+            self.stats["switches_down"] += 1
+        self.current = index
+        self._switched_at = now
+        self._congested_since = None
+        self._clear_since = now
+
+        # Битрейт нового потока измеряется заново
+        self.input_rate = 0.0
+        self.goodput = 0.0
+        self._reset_window(now)
+
+    def switch_failed(self, now: Optional[float] = None):
+        """Переключение не удалось - повтор не раньше следующего срока"""
+        now = time.monotonic() if now is None else now
+        self._congested_since = None
+        self._clear_since = now
+
+    def get_stats(self) -> dict:
+        """Состояние оценки канала"""
+        return dict(
+            self.stats,
+            current="main" if self.current == MAIN_STREAM else "sub",
+            goodput=round(self.goodput),
+            input_rate=round(self.input_rate),
+            queue_delay=round(self.queue_delay, 3),
+            up_hold=self.up_hold
+        )
+
+    def _close_window(self, now: float, elapsed: float, pending_delay: float):
+        goodput = self._window_sent / elapsed
+        input_rate = self._window_input / elapsed
+        delay = max(self._window_delay, pending_delay)
+
+        if self.input_rate == 0.0:
+            self.goodput, self.input_rate, self.queue_delay = goodput, input_rate, delay
+        else:
+            alpha = self.alpha
+            self.goodput += alpha * (goodput - self.goodput)
+            self.input_rate += alpha * (input_rate - self.input_rate)
+            self.queue_delay += alpha * (delay - self.queue_delay)
+
+        if self.current == MAIN_STREAM and self.up_hold > self.base_up_hold \
+                and now - self._switched_at >= self.max_up_hold:
+            # Основной поток стабилен - срок пробы возвращается к исходному
+            self.up_hold = self.base_up_hold
+
+        self._reset_window(now)
+
+    def _reset_window(self, now: float):
+        self._window_start = now
+        self._window_sent = 0
+        self._window_input = 0
+        self._window_delay = 0.0
@@ -0,0 +1,283 @@
+"""
+Сборка кадров (access unit) H.264/H.265 из полезной нагрузки RTP
+"""
+import base64
+import binascii
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from agent.streaming.rtsp_client import RtspError
+
+logger = logging.getLogger(__name__)
+
+START_CODE = b"\x00\x00\x00\x01"
+
+
+@dataclass
+class AccessUnit:
+    """Кадр видеопотока в формате Annex-B"""
+    data: bytearray
+    timestamp: int  # RTP timestamp
+    keyframe: bool
+    parameter_sets: bool  # Кадр содержит SPS/PPS (и VPS для H.265)
+    received_at: float = 0.0  # time.monotonic() получения с камеры
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+AccessUnitHandler = Callable[[AccessUnit], None]
+
+
+class Depacketizer(ABC):
+    """Инкрементальная сборка кадров из RTP пакетов
+
+    Кадр собирается в одном bytearray, полезная нагрузка пакета копируется
+    в него один раз. Граница кадра - бит marker или смена RTP timestamp.
+    При потере пакета кадр отбрасывается вместе с зависимыми кадрами до
+    следующего ключевого.
+    """
+
+    codec = ""
+    # Размер заголовка NAL
+    header_size = 1
+
+    def __init__(self, on_access_unit: AccessUnitHandler,
+                 parameter_sets: Optional[List[bytes]] = None):
+        self.on_access_unit = on_access_unit
+        # Параметры из SDP для ключевых кадров без SPS/PPS в потоке
+        self.parameter_sets = parameter_sets or []
+
+        self._data = bytearray()
+        self._timestamp: Optional[int] = None
+        self._sequence: Optional[int] = None
+        self._keyframe = False
+        self._has_parameter_sets = False
+        self._in_fragment = False
+        self._broken = False
+        self._wait_keyframe = True
+
+        self.stats = {
+            "access_units": 0,
+            "keyframes": 0,
+            "dropped_access_units": 0,
+            "lost_packets": 0
+        }
+
+    def push(self, payload: memoryview, timestamp: int, sequence: int, marker: bool):
+        """Обработка полезной нагрузки очередного RTP пакета"""
+        lost = self._sequence is not None and sequence != (self._sequence + 1) & 0xFFFF
+        if lost:
+            # Неизвестно, какому кадру принадлежали потерянные пакеты
+            self.stats["lost_packets"] += (sequence - self._sequence - 1) & 0xFFFF
+            self._broken = True
+
+        if self._timestamp is not None and timestamp != self._timestamp:
+            # Пакет с marker потерян или не выставлен камерой
+            self._finish()
+            self._broken = lost
+
+        self._sequence = sequence
+        self._timestamp = timestamp
+
+        if len(payload) < self.header_size:
+            self._broken = True
+        elif not self._broken:
+            self._depacketize(payload)
+
+        if marker:
+            self._finish()
+
+    def reset(self):
+        """Сброс состояния (новая RTSP сессия)"""
+        self._data = bytearray()
+        self._timestamp = None
+        self._sequence = None
+        self._keyframe = False
+        self._has_parameter_sets = False
+        self._in_fragment = False
+        self._broken = False
+        self._wait_keyframe = True
+
+    @abstractmethod
+    def _depacketize(self, payload: memoryview):
+        """Разбор полезной нагрузки пакета по схеме упаковки кодека"""
+
+    @abstractmethod
+    def _classify(self, nal_type: int):
+        """Учет типа NAL: ключевой кадр, параметры"""
+
+    def _begin_nal(self, nal_type: int):
+        """Начало NAL: стартовый код и учет типа"""
+        self._classify(nal_type)
+        if self._keyframe and not self._has_parameter_sets and self.parameter_sets:
+            # Ключевой кадр без параметров в потоке - подставляем из SDP
+            for parameter_set in self.parameter_sets:
+                self._data += START_CODE
+                self._data += parameter_set
+            self._has_parameter_sets = True
+        self._data += START_CODE
+
+    def _append_aggregate(self, payload: memoryview, offset: int):
+        """Разбор агрегированного пакета (STAP-A / AP): [размер, NAL]..."""
+        end = len(payload)
+        while offset + 2 <= end:
+            size = (payload[offset] << 8) | payload[offset + 1]
+            offset += 2
+            if size < self.header_size or offset + size > end:
+                self._broken = True
+                return
+            self._begin_nal(self._nal_type(payload, offset))
+            self._data += payload[offset:offset + size]
+            offset += size
+
+    @abstractmethod
+    def _nal_type(self, payload: memoryview, offset: int) -> int:
+        """Тип NAL по его заголовку"""
+
+    def _finish(self):
+        data = self._data
+        if data and not self._broken and (self._keyframe or not self._wait_keyframe):
+            self._wait_keyframe = False
+            self.stats["access_units"] += 1
+            if self._keyframe:
+                self.stats["keyframes"] += 1
+            self._data = bytearray()
+            self.on_access_unit(AccessUnit(
+                data=data,
+                timestamp=self._timestamp,
+                keyframe=self._keyframe,
+                parameter_sets=self._has_parameter_sets
+            ))
+        else:
+            if data or self._broken:
+                self.stats["dropped_access_units"] += 1
+            if self._broken:
+                self._wait_keyframe = True
+            del data[:]
+
+        self._timestamp = None
+        self._keyframe = False
+        self._has_parameter_sets = False
+        self._in_fragment = False
+        self._broken = False
+
+
+class H264Depacketizer(Depacketizer):
+    """RFC 6184: single NAL, STAP-A, FU-A"""
+
+    codec = "H264"
+    header_size = 1
+
+    def _nal_type(self, payload: memoryview, offset: int) -> int:
+        return payload[offset] & 0x1F
+
+    def _classify(self, nal_type: int):
+        if nal_type == 5:
+            self._keyframe = True
+        elif nal_type in (7, 8):
+            self._has_parameter_sets = True
+
+    def _depacketize(self, payload: memoryview):
+        nal_type = payload[0] & 0x1F
+
+        if 1 <= nal_type <= 23:
+            self._begin_nal(nal_type)
+            self._data += payload
+        elif nal_type == 24:  # STAP-A
+            self._append_aggregate(payload, 1)
+        elif nal_type == 28:  # FU-A
+            if len(payload) < 2:
+                self._broken = True
+                return
+            fu_header = payload[1]
+            if fu_header & 0x80:
+                self._begin_nal(fu_header & 0x1F)
+                self._data.append((payload[0] & 0xE0) | (fu_header & 0x1F))
+                self._in_fragment = True
+            elif not self._in_fragment:
+                self._broken = True
+                return
+            self._data += payload[2:]
+            if fu_header & 0x40:
+                self._in_fragment = False
+        else:
+            # STAP-B, MTAP, FU-B не используются в режиме non-interleaved
+            self._broken = True
+
+
+class H265Depacketizer(Depacketizer):
+    """RFC 7798: single NAL, AP, FU (без DONL)"""
+
+    codec = "H265"
+    header_size = 2
+
+    def _nal_type(self, payload: memoryview, offset: int) -> int:
+        return (payload[offset] >> 1) & 0x3F
+
+    def _classify(self, nal_type: int):
+        if 16 <= nal_type <= 21:  # IRAP: BLA, IDR, CRA
+            self._keyframe = True
+        elif nal_type in (32, 33, 34):
+            self._has_parameter_sets = True
+
+    def _depacketize(self, payload: memoryview):
+        nal_type = (payload[0] >> 1) & 0x3F
+
+        if nal_type < 48:
+            self._begin_nal(nal_type)
+            self._data += payload
+        elif nal_type == 48:  # AP
+            self._append_aggregate(payload, 2)
+        elif nal_type == 49:  # FU
+            if len(payload) < 3:
+                self._broken = True
+                return
+            fu_header = payload[2]
+            if fu_header & 0x80:
+                fu_type = fu_header & 0x3F
+                self._begin_nal(fu_type)
+                self._data.append((payload[0] & 0x81) | (fu_type << 1))
+                self._data.append(payload[1])
+                self._in_fragment = True
+            elif not self._in_fragment:
+                self._broken = True
+                return
+            self._data += payload[3:]
+            if fu_header & 0x40:
+                self._in_fragment = False
+        else:
+            # PACI и зарезервированные типы
+            self._broken = True
+
+
+def decode_parameter_sets(values: List[str]) -> List[bytes]:
+    result = []
+    for value in values:
+        for item in value.split(","):
+            if item:
+                try:
+                    result.append(base64.b64decode(item))
+                except (binascii.Error, ValueError):
+                    logger.warning(f"[STREAM] Некорректный параметр в SDP: {item}")
+    return result
+
+
+def create_depacketizer(codec: str, fmtp: Dict[str, str],
+                        on_access_unit: AccessUnitHandler) -> Depacketizer:
+    """Создание сборщика кадров для кодека из SDP"""
+    codec = codec.upper()
+
+    if codec == "H264":
+        parameter_sets = decode_parameter_sets([fmtp.get("sprop-parameter-sets", "")])
+        return H264Depacketizer(on_access_unit, parameter_sets)
+
+    if codec in ("H265", "HEVC"):
+        parameter_sets = decode_parameter_sets([
+            fmtp.get("sprop-vps", ""), fmtp.get("sprop-sps", ""), fmtp.get("sprop-pps", "")
+        ])
+        return H265Depacketizer(on_access_unit, parameter_sets)
+
+    raise RtspError(f"Неподдерживаемый кодек: {codec}")
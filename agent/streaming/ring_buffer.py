@@ -0,0 +1,147 @@
+"""
+Кольцевой буфер с бюджетом по байтам для очереди повторной отправки
+"""
+from typing import Any, Dict, Optional
+
+
+class GopRingBuffer:
+    """Кольцевой буфер фиксированной ёмкости с вытеснением целых GOP
+
+    Элементы хранятся в заранее выделенном массиве слотов, поэтому
+    добавление и извлечение выполняются за O(1). При переполнении по числу
+    элементов или по байтам вытесняется самая старая GOP целиком: от
+    головы очереди до следующей точки синхронизации (ключевого кадра).
+    """
+
+    def __init__(self, max_bytes: int, capacity: int = 4096):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes должен быть положительным")
+        if capacity <= 0:
+            raise ValueError("capacity должен быть положительным")
+
+        self.max_bytes = max_bytes
+        self.capacity = capacity
+
+        self._data = [None] * capacity
+        self._sync = [False] * capacity
+        self._head = 0
+        self._count = 0
+        self._bytes = 0
+
+        # После вытеснения GOP, к которой относится хвост очереди,
+        # её оставшиеся кадры бесполезны до следующего ключевого кадра
+        self._skip_until_sync = False
+
+        self.stats = {
+            "enqueued": 0,
+            "dequeued": 0,
+            "dropped_items": 0,
+            "dropped_bytes": 0,
+            "dropped_gops": 0,
+            "rejected": 0
+        }
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __bool__(self) -> bool:
+        return self._count > 0
+
+    @property
+    def bytes_used(self) -> int:
+        """Объём данных в буфере"""
+        return self._bytes
+
+    def push(self, data: bytes, sync: bool = True) -> bool:
+        """Добавление элемента в конец буфера
+
+        Args:
+            data: Данные для повторной отправки
+            sync: Элемент начинает новую GOP (ключевой кадр). Для
+                непрозрачных данных каждый элемент считается отдельной GOP
+
+        Returns:
+            False, если элемент был отброшен
+        """
+        size = len(data)
+
+        if not sync and self._skip_until_sync:
+            self._drop(size)
+            return False
+
+        if size > self.max_bytes:
+            # Элемент не поместится даже в пустой буфер
+            self.stats["rejected"] += 1
+            self._drop(size)
+            self._skip_until_sync = True
+            return False
+
+        while self._count and (self._count == self.capacity or
+                               self._bytes + size > self.max_bytes):
+            self._evict_gop()
+
+        if not sync and self._skip_until_sync:
+            # Вытеснена GOP, которой принадлежит этот кадр
+            self._drop(size)
+            return False
+
+        self._skip_until_sync = False
+        index = (self._head + self._count) % self.capacity
+        self._data[index] = data
+        self._sync[index] = sync
+        self._count += 1
+        self._bytes += size
+        self.stats["enqueued"] += 1
+        return True
+
+    def peek(self) -> Optional[bytes]:
+        """Первый элемент без извлечения"""
+        if not self._count:
+            return None
+        return self._data[self._head]
+
+    def pop(self) -> Optional[bytes]:
+        """Извлечение первого элемента"""
+        if not self._count:
+            return None
+        data = self._pop_head()
+        self.stats["dequeued"] += 1
+        return data
+
+    def clear(self):
+        """Очистка буфера без учёта в счётчиках потерь"""
+        while self._count:
+            self._pop_head()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Заполненность буфера и счётчики потерь"""
+        return {
+            "items": self._count,
+            "capacity": self.capacity,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "occupancy": self._bytes / self.max_bytes,
+            **self.stats
+        }
+
+    def _pop_head(self) -> bytes:
+        data = self._data[self._head]
+        self._data[self._head] = None
+        self._head = (self._head + 1) % self.capacity
+        self._count -= 1
+        self._bytes -= len(data)
+        return data
+
+    def _evict_gop(self):
+        """Вытеснение самой старой GOP целиком"""
+        self._drop(len(self._pop_head()))
+        while self._count and not self._sync[self._head]:
+            self._drop(len(self._pop_head()))
+        self.stats["dropped_gops"] += 1
+
+        if not self._count:
+            self._skip_until_sync = True
+
+    def _drop(self, size: int):
+        self.stats["dropped_items"] += 1
+        self.stats["dropped_bytes"] += size
@@ -0,0 +1,473 @@
+"""
+Асинхронный RTSP клиент с приемом RTP поверх TCP (interleaved)
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import re
+import struct
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Обработчик interleaved пакета: (канал, пакет). Представление действительно
+# только до возврата из обработчика - данные нужно скопировать, если они
+# требуются позже
+PacketHandler = Callable[[int, memoryview], None]
+
+_AUTH_PARAM = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]*))')
+
+
+class RtspError(Exception):
+    """Ошибка RTSP сессии"""
+
+
+@dataclass
+class RtspResponse:
+    """Ответ RTSP сервера"""
+    status: int
+    reason: str
+    headers: Dict[str, str]
+    body: bytes = b""
+    auth_challenges: List[str] = field(default_factory=list)
+
+
+@dataclass
+class SessionDescription:
+    """Параметры видеодорожки из SDP"""
+    codec: str
+    payload_type: int
+    clock_rate: int
+    control: str
+    fmtp: Dict[str, str]
+    sdp: str
+    base: str = ""  # Content-Base ответа DESCRIBE: база URL дорожек
+
+
+def parse_rtp_header(packet: memoryview) -> Tuple[bool, int, int, memoryview]:
+    """Разбор заголовка RTP
+
+    Returns:
+        (marker, sequence, timestamp, полезная нагрузка без копирования)
+    """
+    if len(packet) < 12:
+        raise RtspError("Слишком короткий RTP пакет")
+
+    first = packet[0]
+    marker = bool(packet[1] & 0x80)
+    sequence, timestamp = struct.unpack_from("!HI", packet, 2)
+
+    offset = 12 + (first & 0x0F) * 4
+    if first & 0x10:
+        # Расширение заголовка: 2 байта профиля, 2 байта длины в словах
+        (ext_words,) = struct.unpack_from("!H", packet, offset + 2)
+        offset += 4 + ext_words * 4
+
+    end = len(packet)
+    if first & 0x20:
+        # Заполнение: последний байт содержит его длину
+        end -= packet[end - 1]
+
+    if offset > end:
+        raise RtspError("Некорректный RTP заголовок")
+
+    return marker, sequence, timestamp, packet[offset:end]
+
+
+def parse_sdp(sdp: str) -> SessionDescription:
+    """Поиск первой видеодорожки в SDP"""
+    media = None
+    codec = ""
+    payload_type = -1
+    clock_rate = 90000
+    control = ""
+    fmtp: Dict[str, str] = {}
+
+    for line in sdp.splitlines():
+        line = line.strip()
+        if line.startswith("m="):
+            if media == "video":
+                break
+            parts = line[2:].split()
+            media = parts[0]
+            if media == "video" and len(parts) > 3:
+                payload_type = int(parts[3])
+        elif media != "video":
+            continue
+        elif line.startswith("a=rtpmap:"):
+            pt, _, encoding = line[9:].partition(" ")
+            if int(pt) == payload_type:
+                name, _, rate = encoding.partition("/")
+                codec = name.upper()
+                clock_rate = int(rate.split("/")[0] or clock_rate)
+        elif line.startswith("a=fmtp:"):
+            pt, _, params = line[7:].partition(" ")
+            if int(pt) == payload_type:
+                for param in params.split(";"):
+                    key, _, value = param.strip().partition("=")
+                    if key:
+                        fmtp[key.lower()] = value
+        elif line.startswith("a=control:"):
+            control = line[10:]
+
+    if media != "video" or payload_type < 0:
+        raise RtspError("В SDP нет видеодорожки")
+
+    return SessionDescription(
+        codec=codec,
+        payload_type=payload_type,
+        clock_rate=clock_rate,
+        control=control,
+        fmtp=fmtp,
+        sdp=sdp
+    )
+
+
+class _RtspProtocol(asyncio.BufferedProtocol):
+    """Разбор RTSP ответов и interleaved кадров в одном буфере приема
+
+    Сокет пишет данные напрямую в заранее выделенный bytearray, пакеты
+    передаются обработчику как memoryview без копирования.
+    """
+
+    def __init__(self, client: "RtspClient", buffer_size: int):
+        # Максимальный interleaved кадр - 4 байта заголовка + 65535 байт
+        self._buffer = bytearray(max(buffer_size, 65539 + 4096))
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._client = client
+        self._transport: Optional[asyncio.Transport] = None
+        # Закрытие этого соединения: у каждой попытки подключения свое,
+        # потеря прежнего соединения не завершает новую сессию
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self._client._transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        if self._client._transport is self._transport:
+            self._client._connection_lost(exc)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._end == len(self._buffer) or self._start > len(self._buffer) // 2:
+            # Перенос неразобранного хвоста в начало буфера
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        try:
+            self._parse()
+        except RtspError as e:
+            logger.error(f"[RTSP] Ошибка разбора потока: {e}")
+            self._client._transport.close()
+
+    def _parse(self):
+        buffer = self._buffer
+        while self._start < self._end:
+            start = self._start
+            available = self._end - start
+
+            if buffer[start] == 0x24:  # '$'
+                if available < 4:
+                    return
+                channel = buffer[start + 1]
+                length = (buffer[start + 2] << 8) | buffer[start + 3]
+                if available < 4 + length:
+                    return
+                self._start = start + 4 + length
+                self._client._on_packet(channel, self._view[start + 4:self._start])
+                continue
+
+            header_end = buffer.find(b"\r\n\r\n", start, self._end)
+            if header_end < 0:
+                if available > 8192:
+                    raise RtspError("Слишком длинный заголовок ответа")
+                return
+
+            response = _parse_response(bytes(buffer[start:header_end]))
+            length = int(response.headers.get("content-length", 0))
+            body_start = header_end + 4
+            if self._end - body_start < length:
+                return
+            response.body = bytes(buffer[body_start:body_start + length])
+            self._start = body_start + length
+            self._client._on_response(response)
+
+        self._start = self._end = 0
+
+
+def _parse_response(header: bytes) -> RtspResponse:
+    lines = header.decode("utf-8", "replace").split("\r\n")
+    parts = lines[0].split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("RTSP/"):
+        raise RtspError(f"Некорректная строка статуса: {lines[0]!r}")
+
+    headers: Dict[str, str] = {}
+    challenges: List[str] = []
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        name = name.strip().lower()
+        value = value.strip()
+        if name == "www-authenticate":
+            challenges.append(value)
+        headers[name] = value
+
+    return RtspResponse(
+        status=int(parts[1]),
+        reason=parts[2] if len(parts) > 2 else "",
+        headers=headers,
+        auth_challenges=challenges
+    )
+
+
+class RtspClient:
+    """RTSP клиент: OPTIONS/DESCRIBE/SETUP/PLAY и прием RTP поверх TCP"""
+
+    def __init__(self, url: str, username: str, password: str,
+                 on_packet: PacketHandler, buffer_size: int = 256 * 1024,
+                 timeout: float = 10.0):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.session_id: Optional[str] = None
+        self.session_timeout = 60
+        self.description: Optional[SessionDescription] = None
+        self.closed: Optional[asyncio.Future] = None
+
+        self._on_packet = on_packet
+        self._transport: Optional[asyncio.Transport] = None
+        self._cseq = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._auth: Optional[Dict[str, str]] = None
+        self._nonce_count = 0
+        self._keepalive_task: Optional[asyncio.Task] = None
+
+    async def connect(self, cached: Optional[SessionDescription] = None) -> SessionDescription:
+        """Установка соединения и запуск воспроизведения
+
+        cached - описание потока, полученное ранее: DESCRIBE пропускается.
+        Если камера отклоняет SETUP по нему, описание запрашивается заново.
+        """
+        await self._open()
+        try:
+            await self.request("OPTIONS", self.url)
+
+            if cached:
+                self.description = cached
+                try:
+                    response = await self._setup()
+                except RtspError as e:
+                    # Камера могла и закрыть соединение - сессия открывается заново
+                    logger.info(f"[RTSP] Сохраненное описание {self.url} устарело: {e}")
+                    self._transport.close()
+                    # Прежнее соединение закрывается до открытия нового
+                    await self.closed
+                    return await self.connect()
+            else:
+                self.description = await self._describe()
+                response = await self._setup()
+
+            session = response.headers.get("session", "")
+            self.session_id, _, params = session.partition(";")
+            match = re.search(r"timeout=(\d+)", params)
+            if match:
+                self.session_timeout = int(match.group(1))
+
+            await self.request("PLAY", self.description.base, {"Range": "npt=0.000-"})
+        except BaseException:
+            self._transport.close()
+            raise
+
+        self._keepalive_task = asyncio.ensure_future(self._keepalive())
+        logger.info(f"[RTSP] Воспроизведение {self.url}: {self.description.codec}")
+        return self.description
+
+    async def describe(self) -> SessionDescription:
+        """Проверка потока: OPTIONS и DESCRIBE без воспроизведения"""
+        await self._open()
+        try:
+            await self.request("OPTIONS", self.url)
+            self.description = await self._describe()
+        finally:
+            self._transport.close()
+        return self.description
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        parts = urlsplit(self.url)
+        _, protocol = await asyncio.wait_for(
+            loop.create_connection(
+                lambda: _RtspProtocol(self, self.buffer_size),
+                parts.hostname, parts.port or 554
+            ),
+            self.timeout
+        )
+        self.closed = protocol.closed
+
+    async def _describe(self) -> SessionDescription:
+        response = await self.request("DESCRIBE", self.url, {"Accept": "application/sdp"})
+        description = parse_sdp(response.body.decode("utf-8", "replace"))
+        description.base = response.headers.get("content-base", self.url)
+        return description
+
+    async def _setup(self) -> RtspResponse:
+        return await self.request(
+            "SETUP", self._control_url(self.description.base, self.description.control),
+            {"Transport": "RTP/AVP/TCP;unicast;interleaved=0-1"}
+        )
+
+    async def request(self, method: str, url: str,
+                      headers: Optional[Dict[str, str]] = None) -> RtspResponse:
+        """Отправка RTSP запроса с повтором после запроса авторизации"""
+        response = await self._send_request(method, url, headers)
+
+        if response.status == 401 and response.auth_challenges:
+            self._auth = self._select_challenge(response.auth_challenges)
+            response = await self._send_request(method, url, headers)
+
+        if response.status != 200:
+            raise RtspError(f"{method} {url}: {response.status} {response.reason}")
+        return response
+
+    def pause_reading(self):
+        """Приостановка чтения сокета (обратное давление)"""
+        if self._transport and not self._transport.is_closing():
+            self._transport.pause_reading()
+
+    def resume_reading(self):
+        """Возобновление чтения сокета"""
+        if self._transport and not self._transport.is_closing():
+            self._transport.resume_reading()
+
+    async def close(self):
+        """Завершение сессии"""
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+
+        if self._transport and not self._transport.is_closing():
+            if self.session_id:
+                try:
+                    await asyncio.wait_for(self._send_request("TEARDOWN", self.url), 2)
+                except Exception:
+                    pass
+            self._transport.close()
+
+    async def _send_request(self, method: str, url: str,
+                            headers: Optional[Dict[str, str]] = None) -> RtspResponse:
+        if self._transport is None or self._transport.is_closing():
+            raise RtspError("Соединение закрыто")
+
+        self._cseq += 1
+        cseq = self._cseq
+        lines = [f"{method} {url} RTSP/1.0", f"CSeq: {cseq}",
+                 "User-Agent: camera-agent"]
+        if self.session_id:
+            lines.append(f"Session: {self.session_id}")
+        if self._auth:
+            lines.append(f"Authorization: {self._authorization(method, url)}")
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[cseq] = future
+        self._transport.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(cseq, None)
+
+    def _on_response(self, response: RtspResponse):
+        cseq = int(response.headers.get("cseq", -1))
+        future = self._pending.get(cseq)
+        if future and not future.done():
+            future.set_result(response)
+
+    def _connection_lost(self, exc: Optional[Exception]):
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(RtspError("Соединение закрыто"))
+
+    async def _keepalive(self):
+        """Поддержание сессии до истечения таймаута сервера"""
+        while True:
+            await asyncio.sleep(max(self.session_timeout / 2, 1))
+            try:
+                await self._send_request("OPTIONS", self.url)
+            except RtspError:
+                return
+            except asyncio.TimeoutError:
+                logger.warning("[RTSP] Нет ответа на keepalive")
+
+    @staticmethod
+    def _control_url(base: str, control: str) -> str:
+        if not control or control == "*":
+            return base
+        if control.startswith("rtsp://"):
+            return control
+        return base.rstrip("/") + "/" + control
+
+    @staticmethod
+    def _select_challenge(challenges: List[str]) -> Dict[str, str]:
+        """Выбор схемы авторизации (Digest предпочтительнее Basic)"""
+        for challenge in sorted(challenges, key=lambda c: not c.lower().startswith("digest")):
+            scheme, _, params = challenge.partition(" ")
+            auth = parse_auth_params(params)
+            auth["scheme"] = scheme.lower()
+            return auth
+        raise RtspError("Пустой запрос авторизации")
+
+    def _authorization(self, method: str, uri: str) -> str:
+        if self._auth["scheme"] == "basic":
+            token = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+            return f"Basic {token}"
+
+        realm = self._auth.get("realm", "")
+        nonce = self._auth.get("nonce", "")
+        ha1 = md5_hex(f"{self.username}:{realm}:{self.password}")
+        ha2 = md5_hex(f"{method}:{uri}")
+
+        fields = [f'username="{self.username}"', f'realm="{realm}"',
+                  f'nonce="{nonce}"', f'uri="{uri}"']
+        if "auth" in self._auth.get("qop", "").split(","):
+            self._nonce_count += 1
+            nc = f"{self._nonce_count:08x}"
+            cnonce = os.urandom(8).hex()
+            response = md5_hex(f"{ha1}:{nonce}:{nc}:{cnonce}:auth:{ha2}")
+            fields += ["qop=auth", f"nc={nc}", f'cnonce="{cnonce}"']
+        else:
+            response = md5_hex(f"{ha1}:{nonce}:{ha2}")
+
+        fields.append(f'response="{response}"')
+        if "opaque" in self._auth:
+            fields.append(f'opaque="{self._auth["opaque"]}"')
+        return "Digest " + ", ".join(fields)
+
+
+def md5_hex(value: str) -> str:
+    """MD5 для Digest авторизации (RFC 2617)"""
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def parse_auth_params(params: str) -> Dict[str, str]:
+    """Параметры WWW-Authenticate/Authorization; имена в нижнем регистре"""
+    return {
+        match.group(1).lower(): match.group(2) if match.group(2) is not None else match.group(3)
+        for match in _AUTH_PARAM.finditer(params)
+    }
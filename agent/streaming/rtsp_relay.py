@@ -0,0 +1,507 @@
+"""
+Раздача одной RTSP сессии камеры нескольким клиентам туннеля
+"""
+import asyncio
+import base64
+import binascii
+import collections
+import hmac
+import logging
+import os
+import re
+import struct
+from typing import Deque, Dict, Optional, Set
+
+from agent.networking.tunnel_mux import TunnelChannel
+from agent.streaming.rtsp_client import (
+    RtspClient, RtspError, SessionDescription, md5_hex, parse_auth_params, parse_rtp_header
+)
+from agent.streaming.sdp_cache import sdp_cache
+
+logger = logging.getLogger(__name__)
+
+# Заголовок interleaved кадра: '$', канал, длина
+INTERLEAVED = struct.Struct("!BBH")
+
+# Дорожка видео в SDP, который отдает ретранслятор
+TRACK_CONTROL = "video"
+
+PUBLIC_METHODS = "OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER, SET_PARAMETER"
+
+# Область Digest авторизации клиентов ретранслятора
+REALM = "camera-agent"
+
+_URL_PREFIX = re.compile(r"^rtsp://[^/]*", re.IGNORECASE)
+
+
+def starts_keyframe(codec: str, payload: memoryview) -> bool:
+    """Начинает ли RTP пакет ключевой кадр или его параметры (SPS/VPS)"""
+    if not payload:
+        return False
+    if codec == "H264":
+        nal_type = payload[0] & 0x1F
+        if nal_type == 24 and len(payload) > 3:  # STAP-A
+            nal_type = payload[3] & 0x1F
+        elif nal_type == 28 and len(payload) > 1:  # FU-A
+            if not payload[1] & 0x80:
+                return False
+            nal_type = payload[1] & 0x1F
+        return nal_type in (5, 7)
+
+    nal_type = (payload[0] >> 1) & 0x3F
+    if nal_type == 48 and len(payload) > 4:  # AP
+        nal_type = (payload[4] >> 1) & 0x3F
+    elif nal_type == 49 and len(payload) > 2:  # FU
+        if not payload[2] & 0x80:
+            return False
+        nal_type = payload[2] & 0x3F
+    return 16 <= nal_type <= 21 or nal_type == 32
+
+
+def relay_sdp(sdp: str) -> str:
+    """SDP камеры только с видеодорожкой и собственным control"""
+    lines = []
+    media = None
+    for line in sdp.splitlines():
+        line = line.strip()
+        if line.startswith("m="):
+            if media == "video":
+                break
+            media = line[2:].split(" ", 1)[0]
+        if media is None:
+            if line.startswith("a=control:"):
+                line = "a=control:*"
+        elif media != "video":
+            continue
+        elif line.startswith("a=control:"):
+            line = f"a=control:{TRACK_CONTROL}"
+        if line:
+            lines.append(line)
+    return "\r\n".join(lines) + "\r\n"
+
+
+class _RelayClient:
+    """Клиент ретранслятора со своей ограниченной очередью
+
+    Пакеты в очередях всех клиентов - один и тот же объект bytes. При
+    переполнении очередь медленного клиента очищается, и он получает
+    поток снова с начала следующего ключевого кадра. Ответы RTSP
+    (keepalive после PLAY) идут отдельной очередью: сброс медиа их не
+    теряет, и они отправляются раньше ожидающих пакетов.
+    """
+
+    def __init__(self, channel: TunnelChannel, max_bytes: int):
+        self.channel = channel
+        self.max_bytes = max_bytes
+        self.queue: Deque[bytes] = collections.deque()
+        self.queued_bytes = 0
+        self.control: Deque[bytes] = collections.deque()
+        self.wait_keyframe = True  # Вход в поток - с ключевого кадра
+        self.closed = False
+        self.dropped = 0
+        self._event = asyncio.Event()
+
+    def offer(self, frame: bytes, keyframe: bool) -> int:
+        """Постановка кадра в очередь; возвращает число отброшенных"""
+        if self.wait_keyframe:
+            if not keyframe:
+                self.dropped += 1
+                return 1
+            self.wait_keyframe = False
+
+        dropped = 0
+        if self.queued_bytes + len(frame) > self.max_bytes:
+            # Клиент не успевает: прореживать пакеты внутри кадра бесполезно
+            dropped = len(self.queue) + 1
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.wait_keyframe = True
+            self.dropped += dropped
+            return dropped
+
+        self.queue.append(frame)
+        self.queued_bytes += len(frame)
+        self._event.set()
+        return dropped
+
+    def send(self, data: bytes):
+        """Ответ RTSP: своя очередь вне ограничения медиа"""
+        self.control.append(data)
+        self._event.set()
+
+    def close(self):
+        self.closed = True
+        self._event.set()
+
+    async def write_loop(self):
+        """Отправка очереди в канал туннеля; ожидание кредита канала -
+        обратное давление медленного клиента"""
+        while not self.closed:
+            if self.control:
+                # Между целыми пакетами ответ не разрывает interleaved кадр
+                await self.channel.write(self.control.popleft())
+                continue
+            if not self.queue:
+                self._event.clear()
+                await self._event.wait()
+                continue
+            frame = self.queue.popleft()
+            self.queued_bytes -= len(frame)
+            await self.channel.write(frame)
+
+
+class _Upstream:
+    """Сессия с камерой для одного пути потока"""
+
+    def __init__(self, relay: "RtspRelay", path: str):
+        self.relay = relay
+        self.path = path
+        self.clients: Set[_RelayClient] = set()
+        self.rtsp = RtspClient(
+            url=relay.camera_url + path,
+            username=relay.username,
+            password=relay.password,
+            on_packet=self._on_packet
+        )
+        self.description: Optional[SessionDescription] = None
+        self.sdp = ""
+        self.users = 0  # Соединения клиентов, запросившие поток
+        self._ready: Optional[asyncio.Future] = None
+        self._linger: Optional[asyncio.TimerHandle] = None
+
+    async def open(self) -> str:
+        """SDP потока; сессия с камерой открывается первым клиентом"""
+        if self._ready is None:
+            self._ready = asyncio.ensure_future(self._connect())
+        await asyncio.shield(self._ready)
+        return self.sdp
+
+    async def _connect(self):
+        try:
+            self.description = await self.rtsp.connect(sdp_cache.description(self.rtsp.url))
+        except BaseException:
+            # Следующий клиент попробует открыть сессию заново
+            self.relay._remove_upstream(self)
+            raise
+        sdp_cache.put(self.rtsp.url, self.description)
+        self.sdp = relay_sdp(self.description.sdp)
+        self.relay.stats["upstream_sessions"] += 1
+        asyncio.ensure_future(self._watch())
+
+    async def _watch(self):
+        """Закрытие клиентов при обрыве сессии с камерой"""
+        await self.rtsp.closed
+        logger.info(f"[RELAY] Сессия с камерой {self.path} закрыта")
+        self.relay._remove_upstream(self)
+        for client in list(self.clients):
+            client.close()
+        self.clients.clear()
+
+    def acquire(self):
+        self.users += 1
+        if self._linger:
+            self._linger.cancel()
+            self._linger = None
+
+    def release(self):
+        self.users -= 1
+        if self.users <= 0 and self._linger is None:
+            # Повторное подключение клиента не открывает новую сессию
+            self._linger = asyncio.get_running_loop().call_later(
+                self.relay.linger, self._close
+            )
+
+    def _close(self):
+        self._linger = None
+        self.relay._remove_upstream(self)
+        asyncio.ensure_future(self.rtsp.close())
+        if self._ready and not self._ready.done():
+            self._ready.cancel()
+
+    def _on_packet(self, channel: int, packet: memoryview):
+        """Раздача пакета: одна копия из буфера приема на всех клиентов"""
+        if not self.clients:
+            return
+        keyframe = False
+        if channel == 0 and self.description:
+            try:
+                keyframe = starts_keyframe(self.description.codec, parse_rtp_header(packet)[3])
+            except RtspError:
+                return
+        frame = INTERLEAVED.pack(0x24, channel, len(packet)) + packet
+        stats = self.relay.stats
+        for client in self.clients:
+            stats["packets_dropped"] += client.offer(frame, keyframe)
+        stats["packets_relayed"] += 1
+
+
+class RtspRelay:
+    """RTSP сервер на каналах туннеля поверх одной сессии с камерой
+
+    Удаленный клиент, открывший канал к RTSP порту камеры, обслуживается
+    агентом: на каждый путь потока открывается одна сессия с камерой, ее
+    RTP пакеты раздаются всем клиентам пути. Недорогие камеры
+    деградируют или отказывают уже при нескольких сессиях.
+
+    Поддерживается только TCP (interleaved), в SDP остается только
+    видеодорожка. Клиенты авторизуются учетными данными камеры.
+    """
+
+    def __init__(self, camera_url: str, username: str, password: str,
+                 client_queue_bytes: int = 2 * 1024 * 1024, linger: float = 10.0,
+                 session_timeout: int = 60):
+        self.camera_url = camera_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.client_queue_bytes = client_queue_bytes
+        self.linger = linger
+        self.session_timeout = session_timeout
+        self.upstreams: Dict[str, _Upstream] = {}
+
+        self.stats = {
+            "clients": 0,
+            "upstream_sessions": 0,
+            "packets_relayed": 0,
+            "packets_dropped": 0,
+            "auth_failures": 0
+        }
+
+    @property
+    def client_count(self) -> int:
+        return sum(len(upstream.clients) for upstream in self.upstreams.values())
+
+    async def serve(self, channel: TunnelChannel):
+        """Обслуживание RTSP клиента в канале туннеля"""
+        self.stats["clients"] += 1
+        connection = _RelayConnection(self, channel)
+        try:
+            await connection.run()
+        except (ConnectionError, RtspError) as e:
+            logger.debug(f"[RELAY] Канал {channel.id} закрыт: {e}")
+        finally:
+            connection.close()
+            if not channel.reset:
+                await channel.abort()
+
+    async def close(self):
+        """Закрытие всех сессий с камерой"""
+        for upstream in list(self.upstreams.values()):
+            for client in upstream.clients:
+                client.close()
+            await upstream.rtsp.close()
+        self.upstreams.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self.stats, active_clients=self.client_count,
+                    active_upstreams=len(self.upstreams))
+
+    def _upstream(self, path: str) -> _Upstream:
+        upstream = self.upstreams.get(path)
+        if upstream is None:
+            upstream = self.upstreams[path] = _Upstream(self, path)
+        return upstream
+
+    def _remove_upstream(self, upstream: _Upstream):
+        if self.upstreams.get(upstream.path) is upstream:
+            del self.upstreams[upstream.path]
+
+
+class _RelayConnection:
+    """RTSP соединение одного клиента"""
+
+    def __init__(self, relay: RtspRelay, channel: TunnelChannel):
+        self.relay = relay
+        self.channel = channel
+        self.session_id = os.urandom(8).hex()
+        self.nonce = os.urandom(16).hex()
+        self.upstream: Optional[_Upstream] = None
+        self.client: Optional[_RelayClient] = None
+        self._buffer = bytearray()
+        self._writer: Optional[asyncio.Task] = None
+
+    async def run(self):
+        while True:
+            request = await self._read_request()
+            if request is None:
+                return
+            method, url, headers = request
+            cseq = headers.get("cseq", "0")
+
+            if method not in ("OPTIONS", "GET_PARAMETER", "SET_PARAMETER") \
+                    and not self._authorized(method, headers.get("authorization", "")):
+                self.relay.stats["auth_failures"] += 1
+                await self._respond(cseq, 401, "Unauthorized", {
+                    "WWW-Authenticate": f'Digest realm="{REALM}", nonce="{self.nonce}"'
+                })
+                continue
+
+            handler = getattr(self, f"_on_{method.lower()}", None)
+            if handler is None:
+                await self._respond(cseq, 405, "Method Not Allowed", {"Allow": PUBLIC_METHODS})
+            elif method == "TEARDOWN":
+                await handler(cseq, url, headers)
+                return
+            else:
+                await handler(cseq, url, headers)
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            if self.upstream:
+                self.upstream.clients.discard(self.client)
+            self.client = None
+        if self._writer:
+            self._writer.cancel()
+        if self.upstream:
+            self.upstream.release()
+            self.upstream = None
+
+    async def _on_options(self, cseq: str, url: str, headers: Dict[str, str]):
+        await self._respond(cseq, 200, "OK", {"Public": PUBLIC_METHODS})
+
+    async def _on_get_parameter(self, cseq: str, url: str, headers: Dict[str, str]):
+        await self._respond(cseq, 200, "OK", {"Session": self.session_id})
+
+    _on_set_parameter = _on_get_parameter
+
+    async def _on_describe(self, cseq: str, url: str, headers: Dict[str, str]):
+        upstream = self._bind(url)
+        try:
+            sdp = await upstream.open()
+        except (OSError, RtspError, asyncio.TimeoutError) as e:
+            logger.warning(f"[RELAY] Поток {upstream.path} недоступен: {e}")
+            await self._respond(cseq, 404, "Not Found")
+            return
+        await self._respond(cseq, 200, "OK", {
+            "Content-Base": url.rstrip("/") + "/",
+            "Content-Type": "application/sdp"
+        }, sdp.encode())
+
+    async def _on_setup(self, cseq: str, url: str, headers: Dict[str, str]):
+        if "TCP" not in headers.get("transport", "").upper():
+            await self._respond(cseq, 461, "Unsupported Transport")
+            return
+        upstream = self._bind(url)
+        try:
+            await upstream.open()
+        except (OSError, RtspError, asyncio.TimeoutError):
+            await self._respond(cseq, 404, "Not Found")
+            return
+        # Каналы 0-1 как у сессии с камерой: заголовок пакета общий для всех
+        await self._respond(cseq, 200, "OK", {
+            "Transport": "RTP/AVP/TCP;unicast;interleaved=0-1",
+            "Session": f"{self.session_id};timeout={self.relay.session_timeout}"
+        })
+
+    async def _on_play(self, cseq: str, url: str, headers: Dict[str, str]):
+        if self.upstream is None or self.upstream.description is None:
+            await self._respond(cseq, 455, "Method Not Valid in This State")
+            return
+        await self._respond(cseq, 200, "OK", {
+            "Session": self.session_id,
+            "Range": "npt=0.000-"
+        })
+        if self.client is None:
+            self.client = _RelayClient(self.channel, self.relay.client_queue_bytes)
+            self.upstream.clients.add(self.client)
+            self._writer = asyncio.ensure_future(self._write_loop())
+
+    async def _on_teardown(self, cseq: str, url: str, headers: Dict[str, str]):
+        await self._respond(cseq, 200, "OK", {"Session": self.session_id})
+
+    async def _write_loop(self):
+        try:
+            await self.client.write_loop()
+        except ConnectionError:
+            return
+        # Сессия с камерой закрыта - клиент переподключится
+        await self.channel.abort()
+
+    def _bind(self, url: str) -> _Upstream:
+        """Сессия с камерой для пути из URL запроса"""
+        if self.upstream is None:
+            path = _URL_PREFIX.sub("", url) or "/"
+            if path.endswith("/" + TRACK_CONTROL):
+                path = path[:-len(TRACK_CONTROL) - 1] or "/"
+            self.upstream = self.relay._upstream(path.rstrip("/") or "/")
+            self.upstream.acquire()
+        return self.upstream
+
+    def _authorized(self, method: str, authorization: str) -> bool:
+        """Проверка учетных данных камеры (Basic или Digest)"""
+        scheme, _, params = authorization.partition(" ")
+        relay = self.relay
+        if scheme.lower() == "basic":
+            try:
+                credentials = base64.b64decode(params).decode()
+            except (binascii.Error, ValueError):
+                return False
+            return hmac.compare_digest(credentials.encode(),
+                                       f"{relay.username}:{relay.password}".encode())
+        if scheme.lower() != "digest":
+            return False
+
+        values = parse_auth_params(params)
+        if values.get("nonce") != self.nonce or values.get("username") != relay.username:
+            return False
+        # Область своя, а не присланная клиентом
+        ha1 = md5_hex(f"{relay.username}:{REALM}:{relay.password}")
+        ha2 = md5_hex(f"{method}:{values.get('uri', '')}")
+        if values.get("qop") == "auth":
+            expected = md5_hex(f"{ha1}:{self.nonce}:{values.get('nc', '')}:"
+                               f"{values.get('cnonce', '')}:auth:{ha2}")
+        else:
+            expected = md5_hex(f"{ha1}:{self.nonce}:{ha2}")
+        return hmac.compare_digest(values.get("response", "").encode(), expected.encode())
+
+    async def _read_request(self):
+        """Очередной запрос клиента: (метод, URL, заголовки) или None"""
+        buffer = self._buffer
+        while True:
+            if buffer[:1] == b"$":
+                # RTCP от клиента не передается камере
+                if len(buffer) >= 4:
+                    _, _, length = INTERLEAVED.unpack_from(buffer)
+                    if len(buffer) >= 4 + length:
+                        del buffer[:4 + length]
+                        continue
+            else:
+                end = buffer.find(b"\r\n\r\n")
+                if end >= 0:
+                    request = _parse_request(bytes(buffer[:end]))
+                    length = int(request[2].get("content-length", 0))
+                    if len(buffer) >= end + 4 + length:
+                        del buffer[:end + 4 + length]
+                        return request
+                elif len(buffer) > 8192:
+                    raise RtspError("Слишком длинный заголовок запроса")
+
+            data = await self.channel.read()
+            if not data:
+                return None
+            buffer += data
+
+    async def _respond(self, cseq: str, status: int, reason: str,
+                       headers: Optional[Dict[str, str]] = None, body: bytes = b""):
+        lines = [f"RTSP/1.0 {status} {reason}", f"CSeq: {cseq}", "Server: camera-agent"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        lines.append(f"Content-Length: {len(body)}")
+        response = ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+        if self.client:
+            # Ответ после PLAY идет через очередь, чтобы не разорвать пакет
+            self.client.send(response)
+        else:
+            await self.channel.write(response)
+
+
+def _parse_request(header: bytes):
+    lines = header.decode("utf-8", "replace").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3 or not parts[2].startswith("RTSP/"):
+        raise RtspError(f"Некорректная строка запроса: {lines[0]!r}")
+    headers: Dict[str, str] = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return parts[0].upper(), parts[1], headers
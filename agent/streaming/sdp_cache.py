@@ -0,0 +1,240 @@
+"""
+Кэш описаний потоков камеры (SDP, кодек, разрешение)
+"""
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from agent.streaming.depacketizer import decode_parameter_sets
+from agent.streaming.rtsp_client import RtspClient, RtspError, SessionDescription
+
+logger = logging.getLogger(__name__)
+
+_FRAMESIZE = re.compile(r"^a=(?:framesize:\d+\s+(\d+)-(\d+)|x-dimensions:\s*(\d+),\s*(\d+))",
+                        re.MULTILINE)
+
+
+@dataclass
+class StreamInfo:
+    """Описание потока камеры"""
+    url: str
+    description: SessionDescription
+    resolution: Optional[Tuple[int, int]]
+    probed_at: float  # time.monotonic() получения описания
+
+    @property
+    def codec(self) -> str:
+        return self.description.codec
+
+
+class SdpCache:
+    """Описания потоков камеры для открытия сессии без DESCRIBE
+
+    Описание записывается при проверке потоков и при каждой успешной
+    сессии; сессия с сохраненным описанием начинается сразу с SETUP, что
+    сокращает время до первого кадра после загрузки и переподключения.
+    Устаревшее описание (камера отклонила SETUP) заменяется новым.
+    """
+
+    def __init__(self, max_age: float = 24 * 3600):
+        self.max_age = max_age
+        self._entries: Dict[str, StreamInfo] = {}
+        self.stats = {"hits": 0, "misses": 0, "probes": 0, "probe_errors": 0}
+
+    def get(self, url: str) -> Optional[StreamInfo]:
+        info = self._entries.get(url)
+        if info is None or time.monotonic() - info.probed_at > self.max_age:
+            return None
+        return info
+
+    def description(self, url: str) -> Optional[SessionDescription]:
+        """Сохраненное описание потока для RtspClient.connect()"""
+        info = self.get(url)
+        self.stats["hits" if info else "misses"] += 1
+        return info.description if info else None
+
+    def put(self, url: str, description: SessionDescription) -> StreamInfo:
+        info = self._entries.get(url)
+        if info is None or info.description is not description:
+            info = StreamInfo(url, description, parse_resolution(description), 0.0)
+            self._entries[url] = info
+        info.probed_at = time.monotonic()
+        return info
+
+    def invalidate(self, url: str):
+        self._entries.pop(url, None)
+
+    async def probe(self, urls: List[str], username: str, password: str,
+                    timeout: float = 3.0, force: bool = False) -> Dict[str, Optional[StreamInfo]]:
+        """Одновременная проверка потоков (OPTIONS и DESCRIBE)
+
+        Возвращает описание каждого потока или None для недоступного.
+        Без force потоки с действующим описанием не запрашиваются.
+        """
+        results = await asyncio.gather(*[
+            self._probe(url, username, password, timeout, force) for url in urls
+        ])
+        return dict(zip(urls, results))
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self.stats, entries=len(self._entries))
+
+    async def _probe(self, url: str, username: str, password: str,
+                     timeout: float, force: bool) -> Optional[StreamInfo]:
+        info = None if force else self.get(url)
+        if info:
+            return info
+
+        self.stats["probes"] += 1
+        client = RtspClient(url, username, password, lambda channel, packet: None,
+                            buffer_size=0, timeout=timeout)
+        try:
+            description = await asyncio.wait_for(client.describe(), timeout * 2)
+        except (OSError, RtspError, asyncio.TimeoutError) as e:
+            self.stats["probe_errors"] += 1
+            logger.warning(f"[STREAM] Поток {url} недоступен: {e}")
+            return None
+        return self.put(url, description)
+
+
+def parse_resolution(description: SessionDescription) -> Optional[Tuple[int, int]]:
+    """Разрешение из атрибутов SDP либо из SPS в fmtp"""
+    match = _FRAMESIZE.search(description.sdp)
+    if match:
+        values = [int(value) for value in match.groups() if value is not None]
+        return values[0], values[1]
+
+    fmtp = description.fmtp
+    try:
+        if description.codec == "H264":
+            sps = [ps for ps in decode_parameter_sets([fmtp.get("sprop-parameter-sets", "")])
+                   if ps and ps[0] & 0x1F == 7]
+            return _h264_resolution(sps[0]) if sps else None
+        if description.codec in ("H265", "HEVC"):
+            sps = decode_parameter_sets([fmtp.get("sprop-sps", "")])
+            return _h265_resolution(sps[0]) if sps else None
+    except (IndexError, ValueError):
+        logger.debug(f"[STREAM] Не удалось разобрать SPS потока {description.codec}")
+    return None
+
+
+class _BitReader:
+    """Чтение SPS: биты и exp-Golomb коды"""
+
+    def __init__(self, nal: bytes):
+        # Удаление байтов защиты от эмуляции стартового кода (00 00 03)
+        self.data = re.sub(b"\x00\x00\x03", b"\x00\x00", nal)
+        self.position = 0
+
+    def bits(self, count: int) -> int:
+        value = 0
+        for _ in range(count):
+            byte = self.data[self.position >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.position & 7))) & 1)
+            self.position += 1
+        return value
+
+    def ue(self) -> int:
+        zeros = 0
+        while not self.bits(1):
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("Некорректный exp-Golomb код")
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def _h264_resolution(sps: bytes) -> Tuple[int, int]:
+    """Разрешение из SPS H.264 (ITU-T H.264, 7.3.2.1.1)"""
+    reader = _BitReader(sps)
+    reader.bits(8)  # Заголовок NAL
+    profile = reader.bits(8)
+    reader.bits(16)  # Ограничения профиля, уровень
+    reader.ue()  # seq_parameter_set_id
+
+    chroma_format = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format = reader.ue()
+        if chroma_format == 3:
+            reader.bits(1)
+        reader.ue()
+        reader.ue()
+        reader.bits(1)
+        if reader.bits(1):  # seq_scaling_matrix_present_flag
+            for index in range(12 if chroma_format == 3 else 8):
+                if reader.bits(1):
+                    last = next_scale = 8
+                    for _ in range(16 if index < 6 else 64):
+                        if next_scale:
+                            next_scale = (last + reader.se()) % 256
+                        last = next_scale or last
+
+    reader.ue()  # log2_max_frame_num_minus4
+    poc_type = reader.ue()
+    if poc_type == 0:
+        reader.ue()
+    elif poc_type == 1:
+        reader.bits(1)
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()  # max_num_ref_frames
+    reader.bits(1)
+    width = (reader.ue() + 1) * 16
+    height_units = reader.ue() + 1
+    frame_mbs_only = reader.bits(1)
+    height = (2 - frame_mbs_only) * height_units * 16
+    if not frame_mbs_only:
+        reader.bits(1)
+    reader.bits(1)
+    if reader.bits(1):  # frame_cropping_flag
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        crop_x = 2 if chroma_format in (1, 2) else 1
+        crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+        width -= (left + right) * crop_x
+        height -= (top + bottom) * crop_y
+    return width, height
+
+
+def _h265_resolution(sps: bytes) -> Tuple[int, int]:
+    """Разрешение из SPS H.265 (ITU-T H.265, 7.3.2.2)"""
+    reader = _BitReader(sps)
+    reader.bits(16)  # Заголовок NAL
+    reader.bits(4)  # sps_video_parameter_set_id
+    max_sub_layers = reader.bits(3)
+    reader.bits(1)
+
+    # profile_tier_level: общая часть 88 бит и general_level_idc
+    reader.bits(88)
+    reader.bits(8)
+    present = [(reader.bits(1), reader.bits(1)) for _ in range(max_sub_layers)]
+    if max_sub_layers:
+        reader.bits(2 * (8 - max_sub_layers))
+    for profile_present, level_present in present:
+        if profile_present:
+            reader.bits(88)
+        if level_present:
+            reader.bits(8)
+
+    reader.ue()  # sps_seq_parameter_set_id
+    chroma_format = reader.ue()
+    if chroma_format == 3:
+        reader.bits(1)
+    width = reader.ue()
+    height = reader.ue()
+    if reader.bits(1):  # conformance_window_flag
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        width -= (2 if chroma_format in (1, 2) else 1) * (left + right)
+        height -= (2 if chroma_format == 1 else 1) * (top + bottom)
+    return width, height
+
+
+# Общий кэш процесса: заполняется проверкой потоков платформы и агентом
+sdp_cache = SdpCache()
@@ -0,0 +1,412 @@
+"""
+Хранилище кадров на карте памяти на время обрыва соединения
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from agent.streaming.depacketizer import AccessUnit
+
+logger = logging.getLogger(__name__)
+
+# Запись: длина данных, флаги, канал, резерв, RTP timestamp, CRC32 данных;
+# затем данные. Нулевой заголовок - конец записанных данных сегмента.
+RECORD = struct.Struct("!IBBHII")
+
+RECORD_KEYFRAME = 0x01
+RECORD_PARAMETER_SETS = 0x02
+RECORD_PADDING = 0x80  # Заполнение до границы страницы, данные пропускаются
+
+# Индекс ключевых кадров закрытого сегмента: смещения записей
+INDEX_ENTRY = struct.Struct("!I")
+
+PAGE_SIZE = mmap.PAGESIZE
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+
+@dataclass
+class SpoolRecord:
+    """Кадр, прочитанный из хранилища"""
+    channel: int
+    unit: AccessUnit
+
+
+class _Segment:
+    def __init__(self, path: str, number: int):
+        self.path = path
+        self.number = number
+        self.size = 0  # Записано байт
+        self.keyframes = array("I")  # Смещения записей с ключевыми кадрами
+
+    @property
+    def index_path(self) -> str:
+        return self.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+class SegmentSpool:
+    """Хранилище кадров из сегментов только для дозаписи
+
+    Сегмент - файл фиксированного размера, отображенный в память. Записи
+    копятся в буфере и переносятся в сегмент блоками block_size по
+    выровненным смещениям, поэтому на флеш уходят целые страницы, а не
+    каждый кадр. К сегменту ведется индекс ключевых кадров: после
+    перезапуска и вытеснения самого старого сегмента (он удаляется
+    целиком) чтение начинается с ключевого кадра. Объем на карте
+    ограничен max_bytes, в памяти - буфером записи и отображением
+    текущего сегмента.
+
+    Чтение идет только из закрытых сегментов; seal() закрывает текущий
+    сегмент, например перед отправкой накопленного после восстановления
+    связи. Запись на карту (sync(), закрытие сегмента в seal() и при
+    переходе на новый сегмент) идет вне цикла событий и по одной
+    операции за раз.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 2 * 1024 ** 3,
+                 segment_size: int = 16 * 1024 * 1024, block_size: int = 64 * 1024):
+        if block_size % PAGE_SIZE or segment_size % block_size:
+            raise ValueError("block_size и segment_size должны быть кратны странице и блоку")
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.block_size = block_size
+
+        self._sealed: List[_Segment] = []
+        self._writer: Optional[_Segment] = None
+        self._write_map: Optional[mmap.mmap] = None
+        self._staging = bytearray()
+        self._next_number = 0
+        self._io_lock = asyncio.Lock()  # Операции с картой в исполнителе
+        self._sealing: Dict[asyncio.Task, _Segment] = {}  # Закрываемые сегменты
+
+        # Чтение: сегмент, позиция чтения и подтвержденная позиция
+        self._reader: Optional[_Segment] = None
+        self._read_map: Optional[mmap.mmap] = None
+        self._read_offset = 0
+        self._committed_offset = 0
+        # Разрыв перед следующим сегментом (вытеснение, перезапуск): чтение
+        # начинается с ключевого кадра
+        self._gap = True
+
+        self.stats = {
+            "records_written": 0,
+            "bytes_written": 0,
+            "records_read": 0,
+            "segments_evicted": 0,
+            "records_rejected": 0
+        }
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def __bool__(self) -> bool:
+        """Есть ли кадры для отправки"""
+        return bool(self._sealed) or bool(self._writer and (self._writer.size or self._staging))
+
+    @property
+    def bytes_used(self) -> int:
+        """Объем сегментов на карте"""
+        used = sum(segment.size for segment in self._sealed)
+        used += sum(segment.size for segment in self._sealing.values())
+        if self._writer:
+            used += self._writer.size + len(self._staging)
+        return used
+
+    def append(self, channel: int, unit: AccessUnit) -> bool:
+        """Запись кадра; False, если кадр не помещается в сегмент"""
+        size = RECORD.size + len(unit.data)
+        if size + RECORD.size > self.segment_size:
+            self.stats["records_rejected"] += 1
+            return False
+
+        if self._writer is None:
+            self._open_writer()
+        elif self._writer.size + len(self._staging) + size + PAGE_SIZE > self.segment_size:
+            # Запас в страницу оставлен под заполнение при сбросе;
+            # заполненный сегмент закрывается в фоне
+            self._seal_in_background()
+            self._open_writer()
+
+        flags = 0
+        if unit.keyframe:
+            flags |= RECORD_KEYFRAME
+            self._writer.keyframes.append(self._writer.size + len(self._staging))
+        if unit.parameter_sets:
+            flags |= RECORD_PARAMETER_SETS
+
+        self._staging += RECORD.pack(len(unit.data), flags, channel, 0,
+                                     unit.timestamp & 0xFFFFFFFF, zlib.crc32(unit.data))
+        self._staging += unit.data
+        self.stats["records_written"] += 1
+        self.stats["bytes_written"] += size
+
+        if len(self._staging) >= self.block_size:
+            self._write_blocks()
+        self._evict()
+        return True
+
+    def flush(self):
+        """Перенос буфера записи в сегмент с заполнением до страницы"""
+        if not self._staging:
+            return
+        pad = -(self._writer.size + len(self._staging)) % PAGE_SIZE
+        if pad:
+            if pad < RECORD.size:
+                pad += PAGE_SIZE
+            self._staging += RECORD.pack(pad - RECORD.size, RECORD_PADDING, 0, 0, 0, 0)
+            self._staging += bytes(pad - RECORD.size)
+        self._write(len(self._staging))
+
+    async def sync(self):
+        """Сброс страниц текущего сегмента на карту вне цикла событий"""
+        self.flush()
+        async with self._io_lock:
+            # Сегмент мог закрыться, пока шел предыдущий сброс
+            if self._write_map is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_map.flush)
+
+    async def seal(self):
+        """Закрытие текущего сегмента вне цикла событий: он становится
+        доступен для чтения"""
+        detached = self._detach_writer()
+        if detached is not None:
+            await self._seal_detached(*detached)
+        else:
+            # Сегменты, закрываемые после перехода на новый, тоже
+            # становятся доступны для чтения
+            await asyncio.gather(*self._sealing)
+
+    def _seal_in_background(self):
+        """Закрытие текущего сегмента задачей (переход на новый сегмент при записи)"""
+        detached = self._detach_writer()
+        if detached is None:
+            return
+        task = asyncio.ensure_future(self._seal_detached(*detached))
+        self._sealing[task] = detached[0]
+        task.add_done_callback(self._sealing.pop)
+
+    async def _seal_detached(self, writer: _Segment, write_map: mmap.mmap):
+        # Блокировка общая с sync(): отображение не закрывается во время сброса
+        async with self._io_lock:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._finish_segment, writer, write_map
+            )
+        if writer.size:
+            # Пока сегмент закрывался, мог закрыться и следующий
+            position = len(self._sealed)
+            while position and self._sealed[position - 1].number > writer.number:
+                position -= 1
+            self._sealed.insert(position, writer)
+
+    def _detach_writer(self) -> Optional[Tuple[_Segment, mmap.mmap]]:
+        """Перенос буфера записи и отсоединение текущего сегмента"""
+        if self._writer is None:
+            return None
+        self.flush()
+        detached = self._writer, self._write_map
+        self._writer = None
+        self._write_map = None
+        return detached
+
+    @staticmethod
+    def _finish_segment(writer: _Segment, write_map: mmap.mmap):
+        """Файлы закрытого сегмента: данные без хвоста и индекс"""
+        write_map.close()
+        if not writer.size:
+            os.unlink(writer.path)
+            return
+        with open(writer.path, "r+b") as f:
+            f.truncate(writer.size)  # Неиспользованный хвост сегмента
+        with open(writer.index_path, "wb") as f:
+            for offset in writer.keyframes:
+                f.write(INDEX_ENTRY.pack(offset))
+
+    def read(self) -> Optional[SpoolRecord]:
+        """Следующий кадр из закрытых сегментов или None"""
+        while True:
+            if self._reader is None and not self._open_reader():
+                return None
+
+            record = self._parse(self._read_map, self._read_offset)
+            if record is None:
+                # Сегмент прочитан; удаляется после подтверждения всего
+                if self._committed_offset < self._read_offset:
+                    return None
+                self._finish_reader()
+                continue
+
+            next_offset, record = record
+            self._read_offset = next_offset
+            if record is not None:
+                self.stats["records_read"] += 1
+                return record
+            self._committed_offset = next_offset  # Заполнение
+
+    def commit(self):
+        """Подтверждение отправки прочитанных кадров"""
+        self._committed_offset = self._read_offset
+
+    def rewind(self):
+        """Повтор кадров, отправка которых не подтверждена"""
+        self._read_offset = self._committed_offset
+
+    async def close(self):
+        """Закрытие хранилища с сохранением записанного"""
+        await self.seal()
+        await asyncio.gather(*self._sealing)
+        if self._read_map is not None:
+            self._read_map.close()
+            self._read_map = None
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self.stats, segments=len(self._sealed) + bool(self._writer),
+                    bytes_used=self.bytes_used)
+
+    def _open_writer(self):
+        number = self._next_number
+        self._next_number += 1
+        segment = _Segment(os.path.join(self.directory, f"{number:012d}{SEGMENT_SUFFIX}"), number)
+        fd = os.open(segment.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Файл разреженный: место на карте занимают только записанные страницы
+            os.ftruncate(fd, self.segment_size)
+            self._write_map = mmap.mmap(fd, self.segment_size)
+        finally:
+            os.close(fd)
+        self._writer = segment
+
+    def _write_blocks(self):
+        """Перенос буфера записи в сегмент до границы блока"""
+        # После flush() сегмент может заканчиваться внутри блока - первый
+        # перенос дополняет этот блок
+        end = (self._writer.size + len(self._staging)) // self.block_size * self.block_size
+        if end > self._writer.size:
+            self._write(end - self._writer.size)
+
+    def _write(self, length: int):
+        offset = self._writer.size
+        self._write_map[offset:offset + length] = self._staging[:length]
+        del self._staging[:length]
+        self._writer.size += length
+
+    def _evict(self):
+        """Удаление самых старых сегментов сверх max_bytes"""
+        while self._sealed and self.bytes_used > self.max_bytes:
+            segment = self._sealed[0]
+            if segment is self._reader:
+                self._close_reader()
+            self._sealed.pop(0)
+            self._remove(segment)
+            self._gap = True
+            self.stats["segments_evicted"] += 1
+            logger.warning(f"[SPOOL] Хранилище заполнено, удален сегмент {segment.number}")
+
+    def _open_reader(self) -> bool:
+        if not self._sealed:
+            # Следующая запись начнется после нового обрыва
+            self._gap = True
+            return False
+        segment = self._sealed[0]
+        with open(segment.path, "rb") as f:
+            self._read_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._reader = segment
+        start = 0
+        if self._gap:
+            # Кадры до первого ключевого кадра без предыдущих бесполезны
+            start = segment.keyframes[0] if segment.keyframes else segment.size
+            self._gap = not segment.keyframes
+        self._read_offset = self._committed_offset = start
+        return True
+
+    def _close_reader(self):
+        self._read_map.close()
+        self._read_map = None
+        self._reader = None
+
+    def _finish_reader(self):
+        segment = self._reader
+        self._close_reader()
+        self._sealed.remove(segment)
+        self._remove(segment)
+
+    @staticmethod
+    def _parse(view, offset: int, verify: bool = False):
+        """Запись по смещению: (следующее смещение, SpoolRecord или None
+        для заполнения) либо None в конце данных"""
+        if offset + RECORD.size > len(view):
+            return None
+        length, flags, channel, _, timestamp, crc = RECORD.unpack_from(view, offset)
+        if length == 0 and flags == 0:
+            return None
+        data_offset = offset + RECORD.size
+        next_offset = data_offset + length
+        if next_offset > len(view):
+            return None  # Оборванная запись
+        if flags & RECORD_PADDING:
+            return next_offset, None
+        if verify and zlib.crc32(view[data_offset:next_offset]) != crc:
+            return None  # Данные записи не дошли до карты
+        unit = AccessUnit(
+            data=bytearray(view[data_offset:next_offset]),
+            timestamp=timestamp,
+            keyframe=bool(flags & RECORD_KEYFRAME),
+            parameter_sets=bool(flags & RECORD_PARAMETER_SETS)
+        )
+        return next_offset, SpoolRecord(channel, unit)
+
+    def _load(self):
+        """Сегменты, оставшиеся после перезапуска, доступны для чтения"""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = _Segment(os.path.join(self.directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+            self._next_number = segment.number + 1
+            if os.path.exists(segment.index_path):
+                # Закрытый сегмент: размер файла равен объему данных
+                segment.size = os.path.getsize(segment.path)
+                with open(segment.index_path, "rb") as f:
+                    segment.keyframes.extend(
+                        offset for (offset,) in INDEX_ENTRY.iter_unpack(f.read())
+                    )
+            else:
+                self._recover(segment)
+            if segment.size:
+                self._sealed.append(segment)
+            else:
+                self._remove(segment)
+
+    def _recover(self, segment: _Segment):
+        """Поиск конца данных и восстановление индекса сегмента, который
+        записывался в момент сбоя"""
+        if os.path.getsize(segment.path) == 0:
+            return
+        with open(segment.path, "r+b") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                offset = 0
+                while True:
+                    parsed = self._parse(view, offset, verify=True)
+                    if parsed is None:
+                        break
+                    next_offset, record = parsed
+                    if record is not None and record.unit.keyframe:
+                        segment.keyframes.append(offset)
+                    offset = next_offset
+            f.truncate(offset)
+        with open(segment.index_path, "wb") as f:
+            for offset in segment.keyframes:
+                f.write(INDEX_ENTRY.pack(offset))
+        segment.size = offset
+
+    def _remove(self, segment: _Segment):
+        for path in (segment.path, segment.index_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
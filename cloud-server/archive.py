@@ -0,0 +1,150 @@
+"""
+Архив кадров, записанных агентами во время обрыва
+"""
+import asyncio
+import logging
+import os
+import struct
+from typing import BinaryIO, Dict, List, Optional
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# Запись архива: длина медиа кадра (!I), затем кадр как его прислал агент
+ARCHIVE_LENGTH = struct.Struct("!I")
+ARCHIVE_SUFFIX = ".media"
+
+
+class _AgentArchive:
+    """Файлы архива одного агента"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.pending = bytearray()  # Принятые кадры до записи
+        self.first_pending: Optional[int] = None  # Последовательность первого из них
+        self.lock = asyncio.Lock()  # Запись агента - по одной операции за раз
+        self.file: Optional[BinaryIO] = None
+        self.files: List[List[int]] = []  # [номер, размер] от старых к новым
+        self.loaded = False
+
+
+class MediaArchive:
+    """Кадры с флагом FLAG_SPOOLED на диске сервера
+
+    Агент удаляет кадр из своего хранилища после отправки, поэтому
+    сервер обязан его сохранить. append() копит кадры агента в памяти;
+    flush() перед подтверждением приема дописывает их в файл агента
+    вне цикла событий. Файлы агента - <directory>/<agent_id>/<номер>.media
+    размером около file_bytes; сверх max_bytes на агента удаляются
+    самые старые файлы.
+    """
+
+    def __init__(self, directory: str, file_bytes: int = 64 * 1024 * 1024,
+                 max_bytes: int = 1024 ** 3):
+        self.directory = directory
+        self.file_bytes = file_bytes
+        self.max_bytes = max_bytes
+        self._agents: Dict[str, _AgentArchive] = {}
+        self.stats = {"frames": 0, "bytes": 0, "errors": 0, "files_removed": 0}
+
+    def append(self, agent_id: str, sequence: int, header: bytes, data: memoryview):
+        """Кадр агента (заголовок и данные) до следующего flush()"""
+        archive = self._agents.get(agent_id)
+        if archive is None:
+            archive = self._agents[agent_id] = _AgentArchive(self.path(agent_id))
+        if archive.first_pending is None:
+            archive.first_pending = sequence
+        archive.pending += ARCHIVE_LENGTH.pack(len(header) + len(data))
+        archive.pending += header
+        archive.pending += data
+        self.stats["frames"] += 1
+        self.stats["bytes"] += len(header) + len(data)
+
+    async def flush(self, agent_id: str) -> Optional[int]:
+        """Запись накопленного вне цикла событий
+
+        Returns:
+            None - записано; иначе последовательность первого кадра,
+            который записать не удалось
+        """
+        archive = self._agents.get(agent_id)
+        if archive is None:
+            return None
+        async with archive.lock:
+            if not archive.pending:
+                return None
+            data, archive.pending = archive.pending, bytearray()
+            first, archive.first_pending = archive.first_pending, None
+            try:
+                removed = await asyncio.get_running_loop().run_in_executor(
+                    None, self._write, archive, data
+                )
+            except OSError as e:
+                self.stats["errors"] += 1
+                logger.error(f"Archive write for agent {agent_id} failed: {e}")
+                return first
+        self.stats["files_removed"] += removed
+        return None
+
+    async def close(self, agent_id: Optional[str] = None):
+        """Закрытие файла агента; без agent_id - всех агентов
+
+        Не записанное flush() отбрасывается: такие кадры не подтверждены.
+        """
+        agent_ids = [agent_id] if agent_id is not None else list(self._agents)
+        for key in agent_ids:
+            archive = self._agents.pop(key, None)
+            if archive is None:
+                continue
+            async with archive.lock:
+                if archive.file is not None:
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(None, archive.file.close)
+                    except OSError as e:
+                        logger.error(f"Archive close for agent {key} failed: {e}")
+
+    def path(self, agent_id: str) -> str:
+        """Каталог архива агента"""
+        # agent_id приходит из URL: в имени каталога без разделителей пути
+        return os.path.join(self.directory, quote(agent_id, safe=""))
+
+    def _write(self, archive: _AgentArchive, data: bytes) -> int:
+        """Запись в исполнителе: смена файла, запись, удаление старых файлов"""
+        if not archive.loaded:
+            self._load(archive)
+        if archive.file is None or archive.files[-1][1] >= self.file_bytes:
+            self._rotate(archive)
+        archive.file.write(data)
+        archive.file.flush()
+        archive.files[-1][1] += len(data)
+
+        removed = 0
+        total = sum(size for _, size in archive.files)
+        while total > self.max_bytes and len(archive.files) > 1:
+            number, size = archive.files.pop(0)
+            os.unlink(self._file_path(archive, number))
+            total -= size
+            removed += 1
+        return removed
+
+    def _load(self, archive: _AgentArchive):
+        """Файлы, оставшиеся от прежнего запуска сервера"""
+        os.makedirs(archive.directory, exist_ok=True)
+        for name in sorted(os.listdir(archive.directory)):
+            stem, suffix = os.path.splitext(name)
+            if suffix == ARCHIVE_SUFFIX and stem.isdigit():
+                size = os.path.getsize(os.path.join(archive.directory, name))
+                archive.files.append([int(stem), size])
+        archive.loaded = True
+
+    def _rotate(self, archive: _AgentArchive):
+        if archive.file is not None:
+            archive.file.close()
+            archive.file = None
+        number = archive.files[-1][0] + 1 if archive.files else 0
+        archive.file = open(self._file_path(archive, number), "ab")
+        archive.files.append([number, 0])
+
+    @staticmethod
+    def _file_path(archive: _AgentArchive, number: int) -> str:
+        return os.path.join(archive.directory, f"{number:012d}{ARCHIVE_SUFFIX}")
@@ -0,0 +1,213 @@
+"""
+Раздача медиа потоков агентов зрителям
+"""
+import asyncio
+import sys
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Кадр зрителю - медиа кадр агента с кадром видео целиком; формат общий с агентом
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agent.networking.framing import (  # noqa: E402
+    FLAG_AU_END, FLAG_AU_START, FLAG_KEYFRAME, MEDIA, MEDIA_HEADER
+)
+
+# Очередь зрителя по умолчанию: около двух секунд видео и не больше 8 МБ
+DEFAULT_MAX_UNITS = 64
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+@dataclass
+class MediaUnit:
+    """Кадр видео, готовый к отправке зрителям
+
+    frame - заголовок и данные одним буфером; все очереди ссылаются на
+    него, копий по числу зрителей нет.
+    """
+    channel: int
+    sequence: int
+    timestamp: int
+    keyframe: bool
+    frame: bytes
+
+    @property
+    def data(self) -> memoryview:
+        return memoryview(self.frame)[MEDIA_HEADER.size:]
+
+
+class Subscription:
+    """Ограниченная очередь кадров одного зрителя одного канала
+
+    Зритель получает кадры только своего канала (основной поток,
+    субпоток) и начинает с ключевого кадра этого канала. Если очередь переполнена
+    (зритель не успевает), накопленные кадры сбрасываются и зритель
+    ждет следующего ключевого кадра: память не растет, а картинка
+    продолжается с целого GOP, а не с разбитого кадра.
+    """
+
+    def __init__(self, agent_id: str, channel: int = 0, max_units: int = DEFAULT_MAX_UNITS,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.agent_id = agent_id
+        self.channel = channel
+        self.max_units = max_units
+        self.max_bytes = max_bytes
+        self.queue: Deque[MediaUnit] = deque()
+        self.queued_bytes = 0
+        self.waiting_keyframe = True
+        self.closed = False
+        self.delivered = 0
+        self.dropped = 0
+        self.skips = 0  # Сколько раз зритель отстал и ждал ключевого кадра
+        self._ready = asyncio.Event()
+
+    def offer(self, unit: MediaUnit):
+        """Кадр от потока; вызывается хабом"""
+        if self.closed:
+            return
+        if not self.waiting_keyframe and (
+                len(self.queue) >= self.max_units
+                or self.queued_bytes + len(unit.frame) > self.max_bytes):
+            self.dropped += len(self.queue)
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.skips += 1
+            self.waiting_keyframe = True
+        if self.waiting_keyframe:
+            if not unit.keyframe:
+                self.dropped += 1
+                return
+            self.waiting_keyframe = False
+        self.queue.append(unit)
+        self.queued_bytes += len(unit.frame)
+        self._ready.set()
+
+    async def get(self) -> Optional[MediaUnit]:
+        """Следующий кадр; None после close()"""
+        while not self.queue:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        unit = self.queue.popleft()
+        self.queued_bytes -= len(unit.frame)
+        self.delivered += 1
+        return unit
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self._ready.set()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "queued": len(self.queue),
+            "queued_bytes": self.queued_bytes,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "skips": self.skips
+        }
+
+
+class MediaHub:
+    """Раздача кадров агентов подписанным зрителям
+
+    Подписки, сборка фрагментов и нумерация кадров ведутся по каналу
+    агента: основной поток и субпоток - разные последовательности кадров
+    со своими GOP. Фрагменты кадра (FLAG_AU_START ... FLAG_AU_END)
+    собираются один раз в буфер кадра зрителю, и ссылка на него
+    кладется в очередь каждого подписчика канала. Публикация стоит одну
+    сборку и O(зрителей канала) добавлений в очереди; канал без зрителей
+    не собирается вовсе.
+    """
+
+    def __init__(self, max_units: int = DEFAULT_MAX_UNITS,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_units = max_units
+        self.max_bytes = max_bytes
+        # (agent_id, канал) -> подписки; dict вместо set сохраняет порядок подписки
+        self._subscribers: Dict[Tuple[str, int], Dict[Subscription, None]] = {}
+        # (agent_id, канал) -> (флаги, timestamp, фрагменты)
+        self._assembly: Dict[Tuple[str, int], Tuple[int, int, List[memoryview]]] = {}
+        self._sequences: Dict[Tuple[str, int], int] = {}
+        self._viewers: Dict[str, int] = {}  # agent_id -> зрители всех каналов
+        self.viewers = 0
+        self.published = 0
+
+    def subscribe(self, agent_id: str, channel: int = 0, max_units: Optional[int] = None,
+                  max_bytes: Optional[int] = None) -> Subscription:
+        subscription = Subscription(agent_id, channel, max_units or self.max_units,
+                                    max_bytes or self.max_bytes)
+        self._subscribers.setdefault((agent_id, channel), {})[subscription] = None
+        self._viewers[agent_id] = self._viewers.get(agent_id, 0) + 1
+        self.viewers += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.close()
+        key = (subscription.agent_id, subscription.channel)
+        subscribers = self._subscribers.get(key)
+        if subscribers is not None and subscription in subscribers:
+            del subscribers[subscription]
+            self.viewers -= 1
+            self._viewers[subscription.agent_id] -= 1
+            if not self._viewers[subscription.agent_id]:
+                del self._viewers[subscription.agent_id]
+            if not subscribers:
+                del self._subscribers[key]
+                self._assembly.pop(key, None)
+
+    def subscribers(self, agent_id: str, channel: Optional[int] = None) -> int:
+        """Зрители канала; без channel - всех каналов агента"""
+        if channel is None:
+            return self._viewers.get(agent_id, 0)
+        return len(self._subscribers.get((agent_id, channel), ()))
+
+    def publish(self, agent_id: str, data: memoryview, channel: int = 0,
+                timestamp: int = 0, flags: int = 0) -> Optional[MediaUnit]:
+        """Фрагмент кадра от агента; возвращает кадр, если он собран и разослан
+
+        Кадр без флагов начала и конца считается целым.
+        """
+        key = (agent_id, channel)
+        subscribers = self._subscribers.get(key)
+        if not subscribers:
+            return None
+
+        if flags & FLAG_AU_START or key not in self._assembly:
+            if not flags & (FLAG_AU_START | FLAG_AU_END):
+                return self._dispatch(key, subscribers, timestamp, flags, [data])
+            if not flags & FLAG_AU_START:
+                return None  # Начало кадра потеряно или подписка пришлась на середину
+            self._assembly[key] = (flags, timestamp, [])
+        first_flags, first_timestamp, chunks = self._assembly[key]
+        chunks.append(data)
+        if not flags & FLAG_AU_END:
+            return None
+        del self._assembly[key]
+        return self._dispatch(key, subscribers, first_timestamp, first_flags, chunks)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "streams": len(self._viewers),
+            "channels": len(self._subscribers),
+            "viewers": self.viewers,
+            "published": self.published
+        }
+
+    def _dispatch(self, key: Tuple[str, int], subscribers: Dict[Subscription, None],
+                  timestamp: int, flags: int, chunks: List[memoryview]) -> MediaUnit:
+        channel = key[1]
+        sequence = self._sequences.get(key, 0)
+        self._sequences[key] = sequence + 1
+        header = MEDIA_HEADER.pack(MEDIA, flags | FLAG_AU_START | FLAG_AU_END,
+                                   channel, sequence, timestamp)
+        unit = MediaUnit(channel, sequence, timestamp, bool(flags & FLAG_KEYFRAME),
+                         b"".join([header, *chunks]))
+        for subscription in subscribers:
+            subscription.offer(unit)
+        self.published += 1
+        return unit
@@ -0,0 +1,323 @@
+"""
+Реестр агентов и потоков облачного сервера
+"""
+import bisect
+import json
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+
+@dataclass
+class AgentInfo:
+    """Информация об агенте"""
+    agent_id: str
+    camera_model: str
+    status: str
+    connected_at: datetime
+    last_heartbeat: datetime
+    ip_address: str
+    stats: Dict[str, Any]
+
+
+@dataclass
+class StreamInfo:
+    """Информация о потоке"""
+    agent_id: str
+    stream_url: str
+    quality: str
+    active: bool
+    viewers_count: int
+
+
+class AgentRegistry:
+    """Агенты и потоки с вторичными индексами
+
+    Индексы по статусу, модели камеры и интервалу последней активности
+    (bucket_seconds) и счетчики статистики обновляются при каждом
+    изменении, поэтому статистика стоит O(1), а выборка - O(результата),
+    а не O(всех агентов). Поля, входящие в индексы (status, camera_model,
+    last_heartbeat, active, viewers_count), меняются только методами
+    реестра.
+
+    Сериализованный JSON записи хранится до ее изменения: чтение
+    неизменившихся записей не повторяет asdict и json.dumps. Прочие
+    изменения записи отмечаются touch(), stats - update_stats(). version
+    растет при любом изменении, версия записи - значение version при ее
+    последнем изменении; из них строятся ETag. Активность агента без
+    heartbeat (подтвержденные медиа кадры) отмечает seen(): она не входит
+    в запись и не меняет ни JSON, ни ETag.
+    """
+
+    def __init__(self, bucket_seconds: int = 60):
+        self.bucket_seconds = bucket_seconds
+        self.agents: Dict[str, AgentInfo] = {}
+        self.streams: Dict[str, StreamInfo] = {}
+        self._ids: List[str] = []  # agent_id по возрастанию: порядок страниц
+
+        # Значение -> агенты; dict вместо set сохраняет порядок добавления
+        self._by_status: Dict[str, Dict[str, None]] = {}
+        self._by_model: Dict[str, Dict[str, None]] = {}
+        self._by_bucket: Dict[int, Dict[str, None]] = {}
+        self._bucket: Dict[str, int] = {}
+        self._seen: Dict[str, datetime] = {}  # Последняя активность агента
+
+        self.active_streams = 0
+        self.total_viewers = 0
+
+        self.version = 0
+        self._agent_versions: Dict[str, int] = {}
+        self._stream_versions: Dict[str, int] = {}
+        self._agent_json: Dict[str, bytes] = {}
+        self._stream_json: Dict[str, bytes] = {}
+
+    def __len__(self) -> int:
+        return len(self.agents)
+
+    def __contains__(self, agent_id: str) -> bool:
+        return agent_id in self.agents
+
+    def get(self, agent_id: str) -> Optional[AgentInfo]:
+        return self.agents.get(agent_id)
+
+    def add(self, agent: AgentInfo):
+        """Добавление агента; прежняя запись с тем же agent_id заменяется"""
+        previous = self.agents.get(agent.agent_id)
+        if previous is not None:
+            self._unindex(previous)
+        else:
+            bisect.insort(self._ids, agent.agent_id)
+        self.agents[agent.agent_id] = agent
+        _index(self._by_status, agent.status, agent.agent_id)
+        _index(self._by_model, agent.camera_model, agent.agent_id)
+        self.seen(agent.agent_id, agent.last_heartbeat)
+        self.touch(agent.agent_id)
+
+    def remove(self, agent_id: str):
+        """Удаление агента и его потока"""
+        agent = self.agents.pop(agent_id, None)
+        if agent is not None:
+            self._unindex(agent)
+            del self._ids[bisect.bisect_left(self._ids, agent_id)]
+            self.version += 1
+            self._agent_versions.pop(agent_id, None)
+            self._agent_json.pop(agent_id, None)
+        self.remove_stream(agent_id)
+
+    def touch(self, agent_id: str):
+        """Запись агента изменилась: сохраненный JSON устарел"""
+        if agent_id in self.agents:
+            self.version += 1
+            self._agent_versions[agent_id] = self.version
+            self._agent_json.pop(agent_id, None)
+
+    def set_status(self, agent_id: str, status: str):
+        agent = self.agents.get(agent_id)
+        if agent is None or agent.status == status:
+            return
+        _unindex(self._by_status, agent.status, agent_id)
+        agent.status = status
+        _index(self._by_status, status, agent_id)
+        self.touch(agent_id)
+
+    def heartbeat(self, agent_id: str, when: Optional[datetime] = None):
+        """Heartbeat агента: last_heartbeat записи и активность"""
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            return
+        agent.last_heartbeat = when or datetime.utcnow()
+        self.seen(agent_id, agent.last_heartbeat)
+        self.touch(agent_id)
+
+    def seen(self, agent_id: str, when: Optional[datetime] = None):
+        """Активность агента без изменения записи (поток медиа вместо heartbeat)"""
+        if agent_id not in self.agents:
+            return
+        when = when or datetime.utcnow()
+        self._seen[agent_id] = when
+        self._set_bucket(agent_id, when)
+
+    def update_stats(self, agent_id: str, values: Dict[str, Any]):
+        """Обновление stats агента; запись меняется, только если значения новые"""
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            return
+        stats = agent.stats
+        if any(key not in stats or stats[key] != value for key, value in values.items()):
+            stats.update(values)
+            self.touch(agent_id)
+
+    def add_stream(self, stream: StreamInfo):
+        self.remove_stream(stream.agent_id)
+        self.streams[stream.agent_id] = stream
+        self.active_streams += stream.active
+        self.total_viewers += stream.viewers_count
+        self._touch_stream(stream.agent_id)
+
+    def remove_stream(self, agent_id: str):
+        stream = self.streams.pop(agent_id, None)
+        if stream is not None:
+            self.active_streams -= stream.active
+            self.total_viewers -= stream.viewers_count
+            self.version += 1
+            self._stream_versions.pop(agent_id, None)
+            self._stream_json.pop(agent_id, None)
+
+    def set_stream_active(self, agent_id: str, active: bool):
+        stream = self.streams.get(agent_id)
+        if stream is None or stream.active == active:
+            return
+        stream.active = active
+        self.active_streams += 1 if active else -1
+        self._touch_stream(agent_id)
+
+    def add_viewers(self, agent_id: str, delta: int):
+        stream = self.streams.get(agent_id)
+        if stream is not None:
+            stream.viewers_count += delta
+            self.total_viewers += delta
+            self._touch_stream(agent_id)
+
+    def agent_json(self, agent_id: str) -> bytes:
+        """JSON записи агента; сериализуется только после изменения"""
+        data = self._agent_json.get(agent_id)
+        if data is None:
+            data = self._agent_json[agent_id] = to_json(asdict(self.agents[agent_id]))
+        return data
+
+    def stream_json(self, agent_id: str) -> bytes:
+        data = self._stream_json.get(agent_id)
+        if data is None:
+            data = self._stream_json[agent_id] = to_json(asdict(self.streams[agent_id]))
+        return data
+
+    def agent_version(self, agent_id: str) -> int:
+        return self._agent_versions[agent_id]
+
+    def stream_version(self, agent_id: str) -> int:
+        return self._stream_versions[agent_id]
+
+    def count(self, status: str) -> int:
+        return len(self._by_status.get(status, ()))
+
+    def stale_since(self, cutoff: datetime) -> Iterator[AgentInfo]:
+        """Агенты, последняя активность которых раньше cutoff
+
+        Просматриваются только интервалы старше cutoff и граничный
+        интервал, а не все агенты.
+        """
+        limit = self._bucket_of(cutoff)
+        for bucket in sorted(key for key in self._by_bucket if key <= limit):
+            for agent_id in self._by_bucket[bucket]:
+                if bucket < limit or self._seen[agent_id] < cutoff:
+                    yield self.agents[agent_id]
+
+    def select(self, status: Optional[str] = None, model: Optional[str] = None,
+               stale_before: Optional[datetime] = None,
+               after: Optional[str] = None) -> Iterator[AgentInfo]:
+        """Агенты по фильтрам в порядке agent_id, начиная после after
+
+        С фильтром перебирается наименьшее из подходящих множеств индекса,
+        без фильтра - упорядоченный список. Запись проверяется заново
+        перед выдачей, поэтому генератор можно читать по частям, пока
+        реестр меняется.
+        """
+        candidates = []
+        if status is not None:
+            candidates.append(self._by_status.get(status, {}))
+        if model is not None:
+            candidates.append(self._by_model.get(model, {}))
+        if stale_before is not None:
+            candidates.append({agent.agent_id: None for agent in self.stale_since(stale_before)})
+
+        ids = self._walk(after) if not candidates else iter(sorted(
+            agent_id for agent_id in min(candidates, key=len) if after is None or agent_id > after
+        ))
+        for agent_id in ids:
+            agent = self.agents.get(agent_id)
+            if agent is None:
+                continue
+            if status is not None and agent.status != status:
+                continue
+            if model is not None and agent.camera_model != model:
+                continue
+            if stale_before is not None and self._seen[agent_id] >= stale_before:
+                continue
+            yield agent
+
+    def select_streams(self, active: Optional[bool] = None,
+                       after: Optional[str] = None) -> Iterator[StreamInfo]:
+        """Потоки в порядке agent_id, начиная после after"""
+        for agent_id in self._walk(after):
+            stream = self.streams.get(agent_id)
+            if stream is not None and (active is None or stream.active == active):
+                yield stream
+
+    def models(self) -> Dict[str, int]:
+        return {model: len(agents) for model, agents in self._by_model.items()}
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "total_agents": len(self.agents),
+            "connected_agents": self.count("connected"),
+            "total_streams": len(self.streams),
+            "active_streams": self.active_streams,
+            "total_viewers": self.total_viewers,
+            "agents_by_status": {status: len(agents) for status, agents in self._by_status.items()}
+        }
+
+    def _touch_stream(self, agent_id: str):
+        self.version += 1
+        self._stream_versions[agent_id] = self.version
+        self._stream_json.pop(agent_id, None)
+
+    def _unindex(self, agent: AgentInfo):
+        _unindex(self._by_status, agent.status, agent.agent_id)
+        _unindex(self._by_model, agent.camera_model, agent.agent_id)
+        _unindex(self._by_bucket, self._bucket.pop(agent.agent_id), agent.agent_id)
+        self._seen.pop(agent.agent_id, None)
+
+    def _walk(self, after: Optional[str]) -> Iterator[str]:
+        """agent_id по возрастанию; позиция ищется заново на каждом шаге"""
+        ids = self._ids
+        position = 0 if after is None else bisect.bisect_right(ids, after)
+        while position < len(ids):
+            agent_id = ids[position]
+            yield agent_id
+            position = bisect.bisect_right(ids, agent_id)
+
+    def _set_bucket(self, agent_id: str, when: datetime):
+        bucket = self._bucket_of(when)
+        previous = self._bucket.get(agent_id)
+        if previous == bucket:
+            return
+        if previous is not None:
+            _unindex(self._by_bucket, previous, agent_id)
+        self._bucket[agent_id] = bucket
+        _index(self._by_bucket, bucket, agent_id)
+
+    def _bucket_of(self, when: datetime) -> int:
+        return int(when.timestamp()) // self.bucket_seconds
+
+
+def to_json(value: Any) -> bytes:
+    """Компактный JSON; datetime - в ISO 8601"""
+    return json.dumps(value, default=_json_default, separators=(",", ":")).encode()
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _index(index: Dict[Any, Dict[str, None]], key: Any, agent_id: str):
+    index.setdefault(key, {})[agent_id] = None
+
+
+def _unindex(index: Dict[Any, Dict[str, None]], key: Any, agent_id: str):
+    agents = index.get(key)
+    if agents is not None:
+        agents.pop(agent_id, None)
+        if not agents:
+            del index[key]
@@ -2,56 +2,108 @@
 Облачный сервер для приема Camera Agents
 """
 import asyncio
+import itertools
 import json
+import secrets
 import time
 import uuid
-from typing import Dict, Any, Set
-from dataclasses import dataclass, asdict
-from datetime import datetime
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Set
+from dataclasses import fields
+from datetime import datetime, timezone
 import logging
 from pathlib import Path
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import uvicorn
 
+from archive import MediaArchive
+from media_hub import MediaHub
+from registry import AgentInfo, AgentRegistry, StreamInfo, to_json
+from timing_wheel import TimingWheel
+from tunnel_server import AgentTunnel
 
-@dataclass
-class AgentInfo:
-    """Информация об агенте"""
-    agent_id: str
-    camera_model: str
-    status: str
-    connected_at: datetime
-    last_heartbeat: datetime
-    ip_address: str
-    stats: Dict[str, Any]
+# Формат кадров общий с агентом (путь к пакету agent добавлен в tunnel_server)
+from agent.networking.framing import (
+    BATCH, FLAG_SPOOLED, LENGTH, MEDIA, MEDIA_HEADER, TUNNEL_OPEN, TUNNEL_RST
+)
 
+# Подтверждение приема медиа кадров отправляется раз в столько кадров
+MEDIA_ACK_INTERVAL = 32
 
-@dataclass
-class StreamInfo:
-    """Информация о потоке"""
-    agent_id: str
-    stream_url: str
-    quality: str
-    active: bool
-    viewers_count: int
+# Страницы списков агентов и потоков
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NDJSON_CHUNK = 256  # Строк NDJSON на одну запись в сокет
+
+# Агент без heartbeat и подтвержденных кадров дольше трех своих интервалов
+# heartbeat считается потерянным; проверка раз в тик. Интервал агент
+# сообщает при регистрации, без него - интервал из настроек сервера
+HEARTBEAT_INTERVAL = 30.0
+HEARTBEAT_MISSES = 3
+MIN_HEARTBEAT_INTERVAL = 1.0
+MAX_HEARTBEAT_INTERVAL = 3600.0
+EXPIRY_TICK = 1.0
+CLOSE_TIMEOUT = 5.0  # Ожидание закрытия сокета потерянного агента
+
+# Сессия отключенного агента (туннель с портами, возобновление) живет
+# столько секунд; не вернувшийся за это время агент регистрируется заново
+SESSION_GRACE = 300.0
+
+AGENT_FIELDS = tuple(field.name for field in fields(AgentInfo))
+STREAM_FIELDS = tuple(field.name for field in fields(StreamInfo))
+
+# Каналы медиа кадров потоков камеры (как у агента)
+STREAM_CHANNELS = {"main": 0, "sub": 1}
 
 
 class CloudServer:
     """Облачный сервер для приема агентов"""
     
-    def __init__(self, host: str = "0.0.0.0", port: int = 8080):
+    def __init__(self, host: str = "0.0.0.0", port: int = 8080,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 tunnel_host: str = "127.0.0.1", archive_dir: str = "archive",
+                 session_grace: float = SESSION_GRACE, archive_max_bytes: int = 1024 ** 3):
         self.host = host
         self.port = port
-        self.app = FastAPI(title="Camera Agent Cloud Server")
+        self.tunnel_host = tunnel_host  # Адрес портов туннеля до камер
+        self.heartbeat_interval = heartbeat_interval
+        self.session_grace = session_grace
+        self.app = FastAPI(title="Camera Agent Cloud Server", lifespan=self._lifespan)
         
-        # Хранилище данных
-        self.agents: Dict[str, AgentInfo] = {}
-        self.streams: Dict[str, StreamInfo] = {}
+        # Хранилище данных: изменения индексируемых полей - через реестр
+        self.registry = AgentRegistry()
+        self.agents: Dict[str, AgentInfo] = self.registry.agents
+        self.streams: Dict[str, StreamInfo] = self.registry.streams
         self.connections: Dict[str, WebSocket] = {}
         
+        # Сессии для возобновления без повторной регистрации
+        self.sessions: Dict[str, str] = {}  # session_token -> agent_id
+        self.agent_sessions: Dict[str, str] = {}  # agent_id -> session_token
+        self.media_sequences: Dict[str, int] = {}  # Последний принятый кадр агента
+        
+        # Сроки heartbeat подключенных агентов (time.monotonic()); сроки
+        # дольше горизонта колесо переносит само
+        self.expiry = TimingWheel(EXPIRY_TICK, heartbeat_interval * HEARTBEAT_MISSES,
+                                  time.monotonic())
+        self.heartbeat_timeouts: Dict[str, float] = {}  # Таймаут агента по его интервалу
+        self.expired_total = 0
+        
+        # Сроки сессий отключенных агентов
+        self.session_expiry = TimingWheel(EXPIRY_TICK, session_grace, time.monotonic())
+        self.ended_sessions_total = 0
+        
+        # Раздача кадров агентов зрителям
+        self.hub = MediaHub()
+        
+        # Туннели до камер: порт на сервере на время сессии агента
+        self.tunnels: Dict[str, AgentTunnel] = {}
+        
+        # Кадры, записанные агентами во время обрыва
+        self.archive = MediaArchive(archive_dir, max_bytes=archive_max_bytes)
+        
         # Настройка CORS
         self.app.add_middleware(
             CORSMiddleware,
@@ -90,23 +142,60 @@ class CloudServer:
             }
         
         @self.app.get("/agents")
-        async def get_agents():
-            """Получение списка агентов"""
-            return [asdict(agent) for agent in self.agents.values()]
+        async def get_agents(status: Optional[str] = None, model: Optional[str] = None,
+                             stale_since: Optional[datetime] = None,
+                             fields: Optional[str] = None, cursor: Optional[str] = None,
+                             limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                             output: str = Query("json", alias="format"),
+                             if_none_match: Optional[str] = Header(None)):
+            """Получение списка агентов
+            
+            Фильтры выбираются по индексам реестра. С cursor или limit
+            ответ - страница {"items", "next_cursor"}, с format=ndjson -
+            поток строк NDJSON без сборки всего списка в памяти.
+            """
+            if stale_since is not None and stale_since.tzinfo is not None:
+                # Время сервера - наивное UTC
+                stale_since = stale_since.astimezone(timezone.utc).replace(tzinfo=None)
+            agents = self.registry.select(status, model, stale_since, after=cursor)
+            return self._list_response(
+                agents, lambda agent: self.registry.agent_json(agent.agent_id),
+                _parse_fields(fields, AGENT_FIELDS), cursor, limit, output, if_none_match
+            )
+        
+        @self.app.get("/statistics")
+        async def get_statistics():
+            """Статистика сервера"""
+            return self.get_statistics()
         
         @self.app.get("/agents/{agent_id}")
-        async def get_agent(agent_id: str):
+        async def get_agent(agent_id: str, if_none_match: Optional[str] = Header(None)):
             """Получение информации об агенте"""
             if agent_id not in self.agents:
                 raise HTTPException(status_code=404, detail="Agent not found")
-            return asdict(self.agents[agent_id])
+            return _json_response(self.registry.agent_json(agent_id),
+                                  _etag(self.registry.agent_version(agent_id)), if_none_match)
         
         @self.app.get("/agents/{agent_id}/stream")
-        async def get_agent_stream(agent_id: str):
+        async def get_agent_stream(agent_id: str, if_none_match: Optional[str] = Header(None)):
             """Получение потока агента"""
             if agent_id not in self.streams:
                 raise HTTPException(status_code=404, detail="Stream not found")
-            return asdict(self.streams[agent_id])
+            return _json_response(self.registry.stream_json(agent_id),
+                                  _etag(self.registry.stream_version(agent_id)), if_none_match)
+        
+        @self.app.get("/agents/{agent_id}/tunnel")
+        async def get_agent_tunnel(agent_id: str):
+            """Порты туннеля агента на сервере"""
+            tunnel = self.tunnels.get(agent_id)
+            if tunnel is None:
+                raise HTTPException(status_code=404, detail="Tunnel not found")
+            return {
+                "host": tunnel.host,
+                "ports": {str(camera): server for camera, server in tunnel.addresses().items()},
+                "connected": tunnel.mux is not None,
+                "stats": tunnel.stats
+            }
         
         @self.app.post("/agents/{agent_id}/control")
         async def control_agent(agent_id: str, command: Dict[str, Any]):
@@ -123,29 +212,136 @@ class CloudServer:
             return {"status": "command_sent"}
         
         @self.app.get("/streams")
-        async def get_streams():
-            """Получение списка потоков"""
-            return [asdict(stream) for stream in self.streams.values()]
+        async def get_streams(active: Optional[bool] = None,
+                              fields: Optional[str] = None, cursor: Optional[str] = None,
+                              limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                              output: str = Query("json", alias="format"),
+                              if_none_match: Optional[str] = Header(None)):
+            """Получение списка потоков; страницы и NDJSON - как у /agents"""
+            streams = self.registry.select_streams(active, after=cursor)
+            return self._list_response(
+                streams, lambda stream: self.registry.stream_json(stream.agent_id),
+                _parse_fields(fields, STREAM_FIELDS), cursor, limit, output, if_none_match
+            )
+        
+        @self.app.websocket("/streams/{agent_id}/ws")
+        async def viewer_websocket(websocket: WebSocket, agent_id: str,
+                                   channel: Optional[int] = Query(None, ge=0, le=0xFFFF),
+                                   stream: Optional[str] = None):
+            """WebSocket зрителя: медиа кадры одного канала потока, начиная с ключевого
+            
+            Канал задается номером (channel) или именем потока (stream=main,
+            sub); по умолчанию - основной поток.
+            """
+            await websocket.accept()
+            if agent_id not in self.streams:
+                await websocket.close(code=4404)
+                return
+            if channel is None:
+                channel = STREAM_CHANNELS.get(stream or "main")
+                if channel is None:
+                    await websocket.close(code=4400, reason=f"Unknown stream: {stream}")
+                    return
+            
+            subscription = self.hub.subscribe(agent_id, channel)
+            self.registry.add_viewers(agent_id, 1)
+            
+            async def watch_disconnect():
+                # Зритель ничего не присылает: чтение нужно только, чтобы
+                # заметить отключение, пока поток стоит
+                while (await websocket.receive())["type"] != "websocket.disconnect":
+                    pass
+                subscription.close()
+            
+            watcher = asyncio.ensure_future(watch_disconnect())
+            try:
+                while True:
+                    unit = await subscription.get()
+                    if unit is None:
+                        break
+                    await websocket.send_bytes(unit.frame)
+            except WebSocketDisconnect:
+                pass
+            finally:
+                watcher.cancel()
+                self.hub.unsubscribe(subscription)
+                self.registry.add_viewers(agent_id, -1)
         
         @self.app.websocket("/agent/{agent_id}")
         async def agent_websocket(websocket: WebSocket, agent_id: str):
             """WebSocket подключение агента"""
             await websocket.accept()
             self.connections[agent_id] = websocket
+            self.session_expiry.cancel(agent_id)
+            # Сокет без регистрации и heartbeat тоже закрывается по сроку
+            self.expiry.schedule(agent_id, time.monotonic() + self._heartbeat_timeout(agent_id))
             
             self.logger.info(f"Agent {agent_id} connected")
             
             try:
                 while True:
                     # Получение данных от агента
-                    data = await websocket.receive_text()
-                    message = json.loads(data)
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        raise WebSocketDisconnect(message.get("code", 1000))
                     
-                    await self._handle_agent_message(agent_id, message)
+                    # Медиа идет двоичными кадрами без разбора JSON,
+                    # JSON используется только для управляющих сообщений
+                    data = message.get("bytes")
+                    if data is not None:
+                        if not await self._handle_agent_frame(agent_id, data):
+                            # Кадр не сохранен и не подтвержден: агент повторит
+                            # его после возобновления сессии
+                            await self._close_socket(websocket, code=1011)
+                            raise WebSocketDisconnect(1011)
+                    else:
+                        await self._handle_agent_message(agent_id, json.loads(message["text"]))
                     
             except WebSocketDisconnect:
                 self.logger.info(f"Agent {agent_id} disconnected")
-                await self._handle_agent_disconnect(agent_id)
+                # При переносе соединения агента новое подключение приходит
+                # раньше закрытия прежнего и уже заменило его
+                if self.connections.get(agent_id) is websocket:
+                    await self._handle_agent_disconnect(agent_id)
+    
+    def _list_response(self, records: Iterator[Any], serialize: Callable[[Any], bytes],
+                       projection: Optional[List[str]], cursor: Optional[str],
+                       limit: Optional[int], output: str, if_none_match: Optional[str]):
+        """Ответ со списком записей реестра в порядке agent_id
+        
+        Курсор - agent_id последней полученной записи; следующая страница
+        начинается после него, даже если реестр изменился между запросами.
+        Ответ собирается из сохраненного JSON записей; ETag - версия
+        реестра, поэтому повторный опрос без изменений получает 304 без
+        обхода записей.
+        """
+        if output not in ("json", "ndjson"):
+            raise HTTPException(status_code=400, detail=f"Unknown format: {output}")
+        etag = _etag(self.registry.version)
+        if _etag_matches(etag, if_none_match):
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        if projection is not None:
+            serialize = lambda record: to_json(_project(record, projection))
+        
+        if output == "ndjson":
+            if limit is not None:
+                records = itertools.islice(records, limit)
+            return StreamingResponse(_ndjson_lines(records, serialize),
+                                     media_type="application/x-ndjson", headers={"ETag": etag})
+        
+        if cursor is None and limit is None:
+            # Прежний ответ - весь список
+            body = b"[" + b",".join(serialize(record) for record in records) + b"]"
+        else:
+            limit = limit or DEFAULT_PAGE_SIZE
+            page = list(itertools.islice(records, limit + 1))
+            next_cursor = page[limit - 1].agent_id if len(page) > limit else None
+            body = b"".join((
+                b'{"items":[', b",".join(serialize(record) for record in page[:limit]),
+                b'],"next_cursor":', to_json(next_cursor), b"}"
+            ))
+        return Response(body, media_type="application/json", headers={"ETag": etag})
     
     async def _handle_agent_message(self, agent_id: str, message: Dict[str, Any]):
         """Обработка сообщения от агента"""
@@ -154,18 +350,72 @@ class CloudServer:
         if message_type == "register":
             await self._handle_agent_registration(agent_id, message.get("data", {}))
         
+        elif message_type == "resume":
+            await self._handle_agent_resume(agent_id, message.get("data", {}))
+        
         elif message_type == "heartbeat":
             await self._handle_agent_heartbeat(agent_id, message.get("data", {}))
         
-        elif message_type == "stream_data":
-            await self._handle_stream_data(agent_id, message.get("data"))
-        
         elif message_type == "status_update":
             await self._handle_status_update(agent_id, message.get("data", {}))
         
+        elif message_type == "tunnel_ready":
+            await self._handle_tunnel_ready(agent_id, message.get("data", {}))
+        
         else:
             self.logger.warning(f"Unknown message type from agent {agent_id}: {message_type}")
     
+    async def _handle_agent_frame(self, agent_id: str, frame: memoryview) -> bool:
+        """Обработка двоичного кадра от агента
+        
+        False - медиа кадр не сохранен: ни он, ни следующие кадры не
+        подтверждаются.
+        """
+        if len(frame) < 4:
+            self.logger.warning(f"Short binary frame from agent {agent_id}")
+            return True
+        
+        frame_type = frame[0]
+        
+        if frame_type == MEDIA:
+            if len(frame) < MEDIA_HEADER.size:
+                self.logger.warning(f"Short media frame from agent {agent_id}")
+                return True
+            _, flags, channel, sequence, timestamp = MEDIA_HEADER.unpack_from(frame)
+            await self._handle_stream_data(
+                agent_id, memoryview(frame)[MEDIA_HEADER.size:],
+                channel=channel, sequence=sequence, timestamp=timestamp, flags=flags
+            )
+            
+            self.media_sequences[agent_id] = sequence
+            if sequence % MEDIA_ACK_INTERVAL == MEDIA_ACK_INTERVAL - 1:
+                # Подтвержденные кадры из архива записаны до ответа агенту
+                if not await self._flush_archive(agent_id):
+                    return False
+                await self._send_media_ack(agent_id, sequence)
+        
+        elif frame_type == BATCH:
+            view = memoryview(frame)
+            offset = 4
+            while offset + LENGTH.size <= len(view):
+                (length,) = LENGTH.unpack_from(view, offset)
+                offset += LENGTH.size
+                if not await self._handle_agent_frame(agent_id, view[offset:offset + length]):
+                    return False
+                offset += length
+        
+        elif TUNNEL_OPEN <= frame_type <= TUNNEL_RST:
+            tunnel = self.tunnels.get(agent_id)
+            if tunnel is not None:
+                tunnel.feed_frame(frame)
+            else:
+                self.logger.debug(f"Tunnel frame from agent {agent_id} without tunnel")
+        
+        else:
+            self.logger.warning(f"Unknown frame type from agent {agent_id}: {frame_type:#x}")
+        
+        return True
+    
     async def _handle_agent_registration(self, agent_id: str, data: Dict[str, Any]):
         """Обработка регистрации агента"""
         try:
@@ -179,7 +429,9 @@ class CloudServer:
                 stats=data.get("stats", {})
             )
             
-            self.agents[agent_id] = agent_info
+            self.registry.add(agent_info)
+            self._set_heartbeat_interval(agent_id, data)
+            self._mark_alive(agent_id)
             
             # Создание записи о потоке
             stream_info = StreamInfo(
@@ -187,65 +439,332 @@ class CloudServer:
                 stream_url=f"rtsp://{self.host}:8554/{agent_id}",
                 quality=data.get("quality", "medium"),
                 active=True,
-                viewers_count=0
+                # Зрители потока остаются подписанными при повторной регистрации
+                viewers_count=self.hub.subscribers(agent_id)
             )
             
-            self.streams[agent_id] = stream_info
+            self.registry.add_stream(stream_info)
+            
+            # Новая сессия заменяет прежнюю, нумерация кадров начинается заново
+            old_token = self.agent_sessions.pop(agent_id, None)
+            if old_token:
+                self.sessions.pop(old_token, None)
+            session_token = secrets.token_urlsafe(24)
+            self.sessions[session_token] = agent_id
+            self.agent_sessions[agent_id] = session_token
+            self.media_sequences[agent_id] = -1
+            
+            # Новая сессия - новый порт туннеля
+            tunnel = await self._open_tunnel(agent_id)
             
             self.logger.info(f"Agent {agent_id} registered successfully")
             
             # Отправка подтверждения агенту
+            reply = {
+                "agent_id": agent_id,
+                "stream_url": stream_info.stream_url,
+                "session_token": session_token,
+                "server_time": datetime.utcnow().isoformat()
+            }
+            if tunnel is not None:
+                reply["tunnel_port"] = tunnel.port
             await self.connections[agent_id].send_text(json.dumps({
                 "type": "registration_confirmed",
-                "data": {
-                    "agent_id": agent_id,
-                    "stream_url": stream_info.stream_url,
-                    "server_time": datetime.utcnow().isoformat()
-                }
+                "data": reply
             }))
             
         except Exception as e:
             self.logger.error(f"Error handling agent registration: {e}")
     
+    async def _handle_agent_resume(self, agent_id: str, data: Dict[str, Any]):
+        """Возобновление сессии агента после переподключения"""
+        session_token = data.get("session_token")
+        
+        if (not session_token or self.sessions.get(session_token) != agent_id
+                or agent_id not in self.agents):
+            self.logger.info(f"Agent {agent_id} resume rejected")
+            await self.connections[agent_id].send_text(json.dumps({
+                "type": "resume_rejected",
+                "data": {"agent_id": agent_id}
+            }))
+            return
+        
+        self.registry.set_status(agent_id, "connected")
+        self._set_heartbeat_interval(agent_id, data)
+        self._mark_alive(agent_id)
+        self.registry.set_stream_active(agent_id, True)
+        # Прежнее соединение еще может держать кадры архива: без записи
+        # они не считаются принятыми
+        await self._flush_archive(agent_id)
+        
+        # Порты туннеля сохраняются, каналы идут через новое соединение
+        reply = {
+            "agent_id": agent_id,
+            "session_token": session_token,
+            "acked_sequence": self.media_sequences.get(agent_id, -1),
+            "server_time": datetime.utcnow().isoformat()
+        }
+        tunnel = self.tunnels.get(agent_id)
+        if tunnel is not None:
+            tunnel.attach(self.connections[agent_id].send_bytes)
+            reply["tunnel_port"] = tunnel.port
+        
+        self.logger.info(f"Agent {agent_id} resumed session")
+        
+        # Агент повторит кадры после последнего принятого сервером
+        await self.connections[agent_id].send_text(json.dumps({
+            "type": "resume_confirmed",
+            "data": reply
+        }))
+    
+    async def _send_media_ack(self, agent_id: str, sequence: int):
+        """Подтверждение приема медиа кадров до sequence включительно
+
+        Поток медиа заменяет heartbeat: агент с подтверждаемым потоком
+        считается живым.
+        """
+        self._mark_alive(agent_id)
+        
+        websocket = self.connections.get(agent_id)
+        if websocket:
+            await websocket.send_text(json.dumps({
+                "type": "media_ack",
+                "data": {"sequence": sequence}
+            }))
+    
     async def _handle_agent_heartbeat(self, agent_id: str, data: Dict[str, Any]):
         """Обработка heartbeat от агента"""
         if agent_id in self.agents:
-            self.agents[agent_id].last_heartbeat = datetime.utcnow()
-            self.agents[agent_id].stats = data.get("stats", {})
+            agent = self.agents[agent_id]
+            self._mark_alive(agent_id)
+            
+            delta = data.get("stats_delta")
+            if delta is not None:
+                # Агент присылает только изменения: счетчики суммируются,
+                # текущие значения заменяются
+                stats = agent.stats
+                for key, value in delta.get("counters", {}).items():
+                    stats[key] = stats.get(key, 0) + value
+                stats.update(delta.get("gauges", {}))
+            else:
+                agent.stats = data.get("stats", {})
+            # Меняются last_heartbeat и stats: JSON записи строится заново
+            self.registry.heartbeat(agent_id)
             
             self.logger.debug(f"Heartbeat from agent {agent_id}")
+        
+        # Ответ подтверждает агенту живость соединения
+        websocket = self.connections.get(agent_id)
+        if websocket:
+            await websocket.send_text(json.dumps({
+                "type": "heartbeat_ack",
+                "data": {"server_time": datetime.utcnow().isoformat()}
+            }))
     
-    async def _handle_stream_data(self, agent_id: str, data: bytes):
-        """Обработка данных потока от агента"""
-        # TODO: Реализовать обработку и ретрансляцию потока
-        # Здесь можно интегрировать с RTSP сервером или другим стриминг решением
+    async def _handle_stream_data(self, agent_id: str, data: memoryview, channel: int = 0,
+                                  sequence: int = 0, timestamp: int = 0, flags: int = 0):
+        """Обработка данных потока от агента
+        
+        Живой поток раздается зрителям через хаб. Запись за время обрыва
+        агент удаляет у себя после отправки, поэтому она сохраняется в
+        архив; на диск она попадает до подтверждения приема.
+        """
+        if flags & FLAG_SPOOLED:
+            header = MEDIA_HEADER.pack(MEDIA, flags, channel, sequence, timestamp)
+            self.archive.append(agent_id, sequence, header, data)
+            return
         
-        if agent_id in self.streams:
-            self.streams[agent_id].viewers_count += 1  # Простая логика подсчета зрителей
+        self.hub.publish(agent_id, data, channel=channel, timestamp=timestamp, flags=flags)
+    
+    async def _flush_archive(self, agent_id: str) -> bool:
+        """Запись принятых кадров архива; False - запись не удалась
         
-        self.logger.debug(f"Received stream data from agent {agent_id}: {len(data)} bytes")
+        Кадры с первого не записанного считаются не принятыми: агент
+        повторит их после возобновления сессии.
+        """
+        lost = await self.archive.flush(agent_id)
+        if lost is None:
+            return True
+        self.media_sequences[agent_id] = lost - 1 if lost else -1
+        return False
+    
+    async def _close_archive(self, agent_id: str):
+        await self._flush_archive(agent_id)
+        await self.archive.close(agent_id)
+    
+    async def _open_tunnel(self, agent_id: str) -> Optional[AgentTunnel]:
+        """Порт туннеля для новой сессии агента; прежний порт закрывается"""
+        previous = self.tunnels.pop(agent_id, None)
+        if previous is not None:
+            await previous.close()
+        
+        tunnel = AgentTunnel(agent_id, self.tunnel_host)
+        try:
+            await tunnel.listen()
+        except OSError as e:
+            # Без туннеля агент работает дальше: медиа идет через WebSocket
+            self.logger.error(f"Error opening tunnel port for agent {agent_id}: {e}")
+            return None
+        tunnel.attach(self.connections[agent_id].send_bytes)
+        self.tunnels[agent_id] = tunnel
+        return tunnel
+    
+    async def _handle_tunnel_ready(self, agent_id: str, data: Dict[str, Any]):
+        """Агент готов принимать каналы до портов камеры"""
+        tunnel = self.tunnels.get(agent_id)
+        if tunnel is None:
+            self.logger.warning(f"Tunnel ready from agent {agent_id} without tunnel")
+            return
+        
+        try:
+            await tunnel.ready(data.get("ports", []))
+        except OSError as e:
+            self.logger.error(f"Error opening tunnel ports for agent {agent_id}: {e}")
+        
+        addresses = ", ".join(f"{self.tunnel_host}:{server} -> {camera}"
+                              for camera, server in tunnel.addresses().items())
+        self.logger.info(f"Tunnel for agent {agent_id} ready: {addresses}")
     
     async def _handle_status_update(self, agent_id: str, data: Dict[str, Any]):
         """Обработка обновления статуса агента"""
         if agent_id in self.agents:
-            self.agents[agent_id].status = data.get("status", "unknown")
-            self.agents[agent_id].stats.update(data.get("stats", {}))
+            self.registry.set_status(agent_id, data.get("status", "unknown"))
+            self.registry.update_stats(agent_id, data.get("stats", {}))
             
             self.logger.info(f"Status update from agent {agent_id}: {data.get('status')}")
     
     async def _handle_agent_disconnect(self, agent_id: str):
         """Обработка отключения агента"""
-        if agent_id in self.agents:
-            self.agents[agent_id].status = "disconnected"
+        self.registry.set_status(agent_id, "disconnected")
+        self.registry.set_stream_active(agent_id, False)
+        
+        self.expiry.cancel(agent_id)
         
-        if agent_id in self.streams:
-            self.streams[agent_id].active = False
+        tunnel = self.tunnels.get(agent_id)
+        if tunnel is not None:
+            tunnel.detach()
         
         if agent_id in self.connections:
             del self.connections[agent_id]
         
+        await self._close_archive(agent_id)
+        self.session_expiry.schedule(agent_id, time.monotonic() + self.session_grace)
+        
         self.logger.info(f"Agent {agent_id} disconnected")
     
+    def _mark_alive(self, agent_id: str):
+        """Агент жив: активность в реестре и новый срок в колесе таймеров
+        
+        Вызывается на каждое подтверждение медиа, поэтому запись агента,
+        ее JSON и ETag не меняются; last_heartbeat обновляет heartbeat.
+        """
+        self.registry.seen(agent_id)
+        if agent_id in self.connections:
+            self.expiry.schedule(agent_id, time.monotonic() + self._heartbeat_timeout(agent_id))
+    
+    def _heartbeat_timeout(self, agent_id: str) -> float:
+        return self.heartbeat_timeouts.get(agent_id, self.heartbeat_interval * HEARTBEAT_MISSES)
+    
+    def _set_heartbeat_interval(self, agent_id: str, data: Dict[str, Any]):
+        """Таймаут агента - три интервала heartbeat из регистрации или возобновления"""
+        interval = data.get("heartbeat_interval")
+        if not isinstance(interval, (int, float)) or not interval > 0:
+            interval = self.heartbeat_interval
+        interval = min(max(float(interval), MIN_HEARTBEAT_INTERVAL), MAX_HEARTBEAT_INTERVAL)
+        self.heartbeat_timeouts[agent_id] = interval * HEARTBEAT_MISSES
+    
+    async def _expire_agents(self):
+        """Раз в тик закрывает агентов с истекшим сроком heartbeat"""
+        while True:
+            await asyncio.sleep(EXPIRY_TICK)
+            now = time.monotonic()
+            try:
+                await self._expire(now)
+                await self._end_sessions(now)
+            except Exception as e:
+                self.logger.error(f"Error expiring agents: {e}")
+    
+    async def _expire(self, now: float):
+        """Потерянные агенты: статус stale, поток неактивен, сокет закрыт
+        
+        Колесо возвращает только истекшие сроки, поэтому тик стоит
+        O(истекших), а не O(всех агентов). Сессия сохраняется: агент
+        возобновит ее после переподключения.
+        """
+        expired = self.expiry.advance(now)
+        if not expired:
+            return
+        
+        sockets = []
+        for agent_id in expired:
+            self.registry.set_status(agent_id, "stale")
+            self.registry.set_stream_active(agent_id, False)
+            # Закрытие сокета уже не вызовет _handle_agent_disconnect
+            websocket = self.connections.pop(agent_id, None)
+            if websocket is not None:
+                sockets.append(websocket)
+            tunnel = self.tunnels.get(agent_id)
+            if tunnel is not None:
+                tunnel.detach()
+            self.session_expiry.schedule(agent_id, now + self.session_grace)
+        
+        self.expired_total += len(expired)
+        self.logger.warning(f"{len(expired)} agents missed {HEARTBEAT_MISSES} heartbeats, "
+                            f"marked stale")
+        await asyncio.gather(*(self._close_socket(websocket) for websocket in sockets),
+                             *(self._close_archive(agent_id) for agent_id in expired))
+    
+    async def _end_sessions(self, now: float):
+        """Завершение сессий агентов, не вернувшихся за session_grace
+        
+        Порты туннеля закрываются, состояние сессии удаляется; запись
+        агента в реестре остается со статусом отключения.
+        """
+        ended = [agent_id for agent_id in self.session_expiry.advance(now)
+                 if agent_id not in self.connections]
+        if not ended:
+            return
+        
+        tunnels = []
+        for agent_id in ended:
+            session_token = self.agent_sessions.pop(agent_id, None)
+            if session_token is not None:
+                self.sessions.pop(session_token, None)
+            self.media_sequences.pop(agent_id, None)
+            self.heartbeat_timeouts.pop(agent_id, None)
+            tunnel = self.tunnels.pop(agent_id, None)
+            if tunnel is not None:
+                tunnels.append(tunnel)
+        
+        self.ended_sessions_total += len(ended)
+        self.logger.info(f"{len(ended)} agent sessions ended after {self.session_grace:.0f}s "
+                         f"without reconnect")
+        await asyncio.gather(*(tunnel.close() for tunnel in tunnels))
+    
+    async def _close_socket(self, websocket: WebSocket, code: int = 1001):
+        """Закрытие сокета; запись в мертвое TCP соединение не ждется дольше CLOSE_TIMEOUT"""
+        try:
+            await asyncio.wait_for(websocket.close(code=code), CLOSE_TIMEOUT)
+        except Exception as e:
+            self.logger.debug(f"Closing agent socket failed: {e}")
+    
+    @asynccontextmanager
+    async def _lifespan(self, app: FastAPI):
+        """Фоновые задачи приложения: сроки heartbeat и сессий
+        
+        Запускаются при старте приложения, как бы его ни запускали
+        (start(), внешний uvicorn с self.app, TestClient), и
+        останавливаются при его остановке вместе с туннелями и архивом.
+        """
+        expiry_task = asyncio.ensure_future(self._expire_agents())
+        try:
+            yield
+        finally:
+            expiry_task.cancel()
+            await asyncio.gather(expiry_task, return_exceptions=True)
+            await asyncio.gather(*(tunnel.close() for tunnel in self.tunnels.values()))
+            await self.archive.close()
+    
     async def start(self):
         """Запуск сервера"""
         self.logger.info(f"Starting Cloud Server on {self.host}:{self.port}")
@@ -261,17 +780,59 @@ class CloudServer:
         await server.serve()
     
     def get_statistics(self) -> Dict[str, Any]:
-        """Получение статистики сервера"""
-        connected_agents = sum(1 for agent in self.agents.values() if agent.status == "connected")
-        active_streams = sum(1 for stream in self.streams.values() if stream.active)
-        
-        return {
-            "total_agents": len(self.agents),
-            "connected_agents": connected_agents,
-            "total_streams": len(self.streams),
-            "active_streams": active_streams,
-            "total_viewers": sum(stream.viewers_count for stream in self.streams.values())
-        }
+        """Получение статистики сервера
+        
+        Счетчики ведет реестр при каждом изменении: без обхода агентов.
+        """
+        statistics = self.registry.get_statistics()
+        statistics["expired_agents"] = self.expired_total
+        statistics["ended_sessions"] = self.ended_sessions_total
+        statistics["tunnels"] = len(self.tunnels)
+        statistics["media_hub"] = self.hub.get_stats()
+        statistics["archive"] = dict(self.archive.stats)
+        return statistics
+
+
+def _parse_fields(value: Optional[str], allowed: Iterable[str]) -> Optional[List[str]]:
+    """Список полей проекции; agent_id включается всегда - это курсор"""
+    if not value:
+        return None
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ["agent_id"] + [name for name in names if name != "agent_id"]
+
+
+def _project(record: Any, projection: List[str]) -> Dict[str, Any]:
+    return {name: getattr(record, name) for name in projection}
+
+
+def _etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def _etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """Совпадение с заголовком If-None-Match (список, *, слабые ETag)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def _json_response(body: bytes, etag: str, if_none_match: Optional[str]) -> Response:
+    if _etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+async def _ndjson_lines(records: Iterator[Any], serialize: Callable[[Any], bytes]):
+    """Строки NDJSON частями; между частями цикл событий обслуживает агентов"""
+    while True:
+        chunk = [serialize(record) for record in itertools.islice(records, NDJSON_CHUNK)]
+        if not chunk:
+            return
+        yield b"\n".join(chunk) + b"\n"
 
 
 async def main():
@@ -281,12 +842,25 @@ async def main():
     parser = argparse.ArgumentParser(description="Camera Agent Cloud Server")
     parser.add_argument("--host", default="0.0.0.0", help="Host to bind to")
     parser.add_argument("--port", type=int, default=8080, help="Port to bind to")
+    parser.add_argument("--tunnel-host", default="127.0.0.1",
+                        help="Host for tunnel ports to agent cameras")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="Heartbeat interval for agents that do not report one, seconds")
+    parser.add_argument("--archive-max-bytes", type=int, default=1024 ** 3,
+                        help="Archive size limit per agent; oldest files are removed")
+    parser.add_argument("--session-grace", type=float, default=SESSION_GRACE,
+                        help="Seconds to keep a disconnected agent's session and tunnel ports")
+    parser.add_argument("--archive-dir", default="archive",
+                        help="Directory for frames spooled by agents during outages")
     parser.add_argument("--config", help="Configuration file")
     
     args = parser.parse_args()
     
     # Создание и запуск сервера
-    server = CloudServer(host=args.host, port=args.port)
+    server = CloudServer(host=args.host, port=args.port, tunnel_host=args.tunnel_host,
+                         heartbeat_interval=args.heartbeat_interval, archive_dir=args.archive_dir,
+                         session_grace=args.session_grace,
+                         archive_max_bytes=args.archive_max_bytes)
     
     try:
         await server.start()
@@ -0,0 +1,74 @@
+"""
+Колесо таймеров для сроков heartbeat агентов
+"""
+import math
+from typing import Dict, List, Optional
+
+
+class TimingWheel:
+    """Хешированное колесо таймеров
+
+    Срок попадает в слот номера тика, в котором истекает. Колесо
+    охватывает весь горизонт (horizon / tick слотов), поэтому в слоте
+    лежат только ключи, истекающие в этом тике: продвижение стоит
+    O(истекших), перенос срока - O(1). Сроки дальше горизонта
+    ограничиваются последним слотом и при срабатывании переносятся.
+    """
+
+    def __init__(self, tick: float, horizon: float, now: float = 0.0):
+        self.tick = tick
+        self.size = int(math.ceil(horizon / tick)) + 1
+        self._slots: List[Dict[str, float]] = [{} for _ in range(self.size)]
+        self._slot_of: Dict[str, int] = {}  # ключ -> слот
+        self._current = int(now // tick)  # Номер последнего обработанного тика
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._slot_of
+
+    def schedule(self, key: str, deadline: float):
+        """Установка срока ключа; прежний срок заменяется"""
+        number = max(int(math.ceil(deadline / self.tick)), self._current + 1)
+        number = min(number, self._current + self.size - 1)
+        slot = number % self.size
+        previous = self._slot_of.get(key)
+        if previous is not None and previous != slot:
+            del self._slots[previous][key]
+        self._slots[slot][key] = deadline
+        self._slot_of[key] = slot
+
+    def cancel(self, key: str):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self, now: float) -> List[str]:
+        """Продвижение до now; возвращает ключи с истекшим сроком"""
+        expired = []
+        target = int(now // self.tick)
+        # После долгой паузы достаточно одного оборота колеса
+        start = max(self._current + 1, target - self.size + 1)
+        for number in range(start, target + 1):
+            # Перенос срока считается от обрабатываемого тика: иначе после
+            # паузы он попадает в уже пройденный слот и ждет лишний оборот
+            self._current = number
+            slot = self._slots[number % self.size]
+            if not slot:
+                continue
+            self._slots[number % self.size] = {}
+            for key, deadline in slot.items():
+                if deadline <= now:
+                    del self._slot_of[key]
+                    expired.append(key)
+                else:
+                    # Срок за горизонтом при постановке
+                    del self._slot_of[key]
+                    self.schedule(key, deadline)
+        self._current = max(self._current, target)
+        return expired
+
+    def deadline(self, key: str) -> Optional[float]:
+        slot = self._slot_of.get(key)
+        return None if slot is None else self._slots[slot][key]
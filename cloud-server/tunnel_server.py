@@ -0,0 +1,112 @@
+"""
+Серверная сторона туннеля: TCP порты на сервере до портов камеры
+"""
+import asyncio
+import logging
+import sys
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Мультиплексор общий с агентом
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agent.networking.tunnel_mux import TunnelMultiplexer, pipe  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+FrameSender = Callable[[bytes], Awaitable[None]]
+
+
+class AgentTunnel:
+    """Туннель одного агента
+
+    Порт на сервере принимает TCP соединения (Flussonic, ffmpeg) и для
+    каждого открывает канал мультиплексора до порта камеры: первый порт
+    из tunnel_ready доступен на порту, выданном при регистрации, прочие -
+    на дополнительных портах. Порты живут, пока жива сессия агента;
+    мультиплексор - пока живо соединение, после возобновления сессии он
+    создается заново для нового соединения.
+    """
+
+    def __init__(self, agent_id: str, host: str = "127.0.0.1"):
+        self.agent_id = agent_id
+        self.host = host
+        self.port = 0  # Порт на сервере для первого порта камеры
+        self.ports: List[int] = []  # Порты камеры из tunnel_ready
+        self.listeners: Dict[int, asyncio.AbstractServer] = {}  # порт камеры -> сервер
+        self.mux: Optional[TunnelMultiplexer] = None
+        self.stats = {"connections": 0, "rejected": 0}
+        self._main: Optional[asyncio.AbstractServer] = None
+
+    async def listen(self, port: int = 0) -> int:
+        """Открытие основного порта; 0 - свободный порт от ОС"""
+        self._main = await asyncio.start_server(self._serve_main, self.host, port)
+        self.port = self._main.sockets[0].getsockname()[1]
+        return self.port
+
+    def attach(self, send_frame: FrameSender) -> TunnelMultiplexer:
+        """Мультиплексор для нового соединения агента"""
+        self.detach()
+        self.mux = TunnelMultiplexer(send_frame, initiator=True)
+        return self.mux
+
+    def detach(self):
+        """Соединение агента потеряно: открытые каналы сбрасываются"""
+        if self.mux is not None:
+            self.mux.close()
+            self.mux = None
+
+    def feed_frame(self, frame: bytes):
+        if self.mux is not None:
+            self.mux.feed_frame(frame)
+
+    async def ready(self, ports: List[int]):
+        """Агент открыл туннель до портов камеры"""
+        self.ports = list(ports)
+        for camera_port in self.ports[1:]:
+            if camera_port not in self.listeners:
+                self.listeners[camera_port] = await asyncio.start_server(
+                    lambda reader, writer, port=camera_port: self._serve(reader, writer, port),
+                    self.host, 0
+                )
+
+    def addresses(self) -> Dict[int, int]:
+        """Порт камеры -> порт на сервере"""
+        addresses = {self.ports[0]: self.port} if self.ports else {}
+        for camera_port, server in self.listeners.items():
+            addresses[camera_port] = server.sockets[0].getsockname()[1]
+        return addresses
+
+    async def close(self):
+        self.detach()
+        servers = list(self.listeners.values())
+        if self._main is not None:
+            servers.append(self._main)
+        for server in servers:
+            server.close()
+        await asyncio.gather(*(server.wait_closed() for server in servers))
+        self.listeners.clear()
+        self._main = None
+
+    async def _serve_main(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not self.ports:
+            self.stats["rejected"] += 1
+            writer.close()
+            return
+        await self._serve(reader, writer, self.ports[0])
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                     camera_port: int):
+        if self.mux is None:
+            # Агент не подключен: клиент переподключится сам
+            self.stats["rejected"] += 1
+            writer.close()
+            return
+        self.stats["connections"] += 1
+        try:
+            channel = await self.mux.open_channel(camera_port)
+        except Exception as e:
+            logger.warning(f"[TUNNEL] Agent {self.agent_id}: channel to port {camera_port} failed: {e}")
+            writer.close()
+            return
+        await pipe(channel, reader, writer)
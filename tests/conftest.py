@@ -0,0 +1,11 @@
+"""
+Общие настройки тестов
+"""
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# Пакет агента и модули облачного сервера (server.py запускается из своего каталога)
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "cloud-server"))
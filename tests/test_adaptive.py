@@ -0,0 +1,61 @@
+"""
+Переключение основной поток / подпоток по оценке канала
+"""
+from agent.streaming.adaptive import MAIN_STREAM, SUBSTREAM, AdaptiveStreamSelector
+
+
+def _run(selector: AdaptiveStreamSelector, now: float, seconds: int, sent_ratio: float,
+         delay: float = 0.05):
+    """Посекундные окна до первого переключения: 100 КБ/с с камеры,
+    отправлена доля sent_ratio; возвращает время и выбранный поток"""
+    for _ in range(seconds):
+        selector.record_input(100_000)
+        selector.record_sent(int(100_000 * sent_ratio), delay)
+        now += 1.0
+        decision = selector.decide(now=now)
+        if decision is not None:
+            selector.switched(decision, now)
+            return now, decision
+    return now, None
+
+
+def test_congestion_switches_down_and_clear_link_probes_main():
+    selector = AdaptiveStreamSelector(down_hold=3.0, up_hold=30.0)
+    start = selector._window_start
+
+    now, decision = _run(selector, start, 10, sent_ratio=0.5)
+    # Переключение после устойчивой перегрузки, а не по первому окну
+    assert decision == SUBSTREAM
+    assert start + 4 <= now <= start + 6
+    switched_at = now
+
+    now, decision = _run(selector, now, 100, sent_ratio=1.0)
+    assert decision == MAIN_STREAM
+    assert now - switched_at >= 30.0
+    assert selector.stats["switches_down"] == selector.stats["switches_up"] == 1
+
+
+def test_failed_probe_doubles_hold():
+    selector = AdaptiveStreamSelector(down_hold=3.0, up_hold=30.0, max_up_hold=1000.0)
+    now, _ = _run(selector, selector._window_start, 10, sent_ratio=0.5)
+    now, decision = _run(selector, now, 100, sent_ratio=1.0)
+    assert decision == MAIN_STREAM
+    failed, hold = selector.stats["failed_probes"], selector.up_hold
+
+    # Основной поток снова не проходит сразу после пробы
+    now, decision = _run(selector, now, 10, sent_ratio=0.5)
+    assert decision == SUBSTREAM
+    assert selector.stats["failed_probes"] == failed + 1
+    assert selector.up_hold == hold * 2
+    switched_at = now
+
+    # Следующая проба не раньше удвоенного срока
+    now, decision = _run(selector, now, 200, sent_ratio=1.0)
+    assert decision == MAIN_STREAM
+    assert now - switched_at >= hold * 2
+
+
+def test_queue_delay_alone_signals_congestion():
+    selector = AdaptiveStreamSelector(down_hold=2.0, high_delay=1.0)
+    now, decision = _run(selector, selector._window_start, 10, sent_ratio=1.0, delay=3.0)
+    assert decision == SUBSTREAM
@@ -0,0 +1,55 @@
+"""
+Переподключение агента отдельной задачей
+"""
+import asyncio
+
+import pytest
+
+from agent.core.agent import AgentConfig, AgentStatus, CameraAgent
+
+
+class _DeadConnection:
+    """Соединение, обрыв которого заметил агент"""
+    retry_after = None
+
+    def is_connected(self) -> bool:
+        return False
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_connection_checks_spawn_a_single_reconnect():
+    agent = CameraAgent(AgentConfig(agent_id="cam", reconnect_interval=0,
+                                    reconnect_max_interval=0, network_monitor=False))
+    agent.status = AgentStatus.CONNECTED
+    agent.connection = _DeadConnection()
+    agent._network_changed = asyncio.Event()
+
+    attempts = 0
+    server_back = asyncio.Event()
+
+    async def connect_to_cloud(previous=None):
+        nonlocal attempts
+        attempts += 1
+        await server_back.wait()
+
+    agent._connect_to_cloud = connect_to_cloud
+
+    # Проверки мониторинга и циклов потоков не ждут переподключения
+    await asyncio.wait_for(agent._check_connection(), 0.1)
+    await asyncio.wait_for(agent._check_connection(), 0.1)
+    agent._request_reconnect()
+    await asyncio.sleep(0.01)
+
+    assert agent.status == AgentStatus.RECONNECTING
+    assert agent.tasks.running("reconnect")
+    assert attempts == 1
+    assert agent.reconnections.value == 1
+
+    server_back.set()
+    await asyncio.sleep(0.01)
+    assert agent.status == AgentStatus.CONNECTED
+    assert not agent.tasks.running("reconnect")
+    await agent.tasks.close()
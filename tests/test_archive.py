@@ -0,0 +1,79 @@
+"""
+Кадры, записанные агентом во время обрыва, сохраняются сервером
+"""
+import os
+
+import pytest
+
+from agent.networking.framing import FLAG_SPOOLED, MEDIA, MEDIA_HEADER
+from archive import ARCHIVE_LENGTH, MediaArchive
+from server import MEDIA_ACK_INTERVAL, CloudServer
+
+
+def _frame(sequence: int, flags: int = FLAG_SPOOLED) -> bytes:
+    return MEDIA_HEADER.pack(MEDIA, flags, 0, sequence, sequence * 3000) + b"au%d" % sequence
+
+
+def _read_archive(directory):
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as archive:
+            data = archive.read()
+        offset = 0
+        while offset < len(data):
+            (length,) = ARCHIVE_LENGTH.unpack_from(data, offset)
+            offset += ARCHIVE_LENGTH.size
+            frames.append(data[offset:offset + length])
+            offset += length
+    return frames
+
+
+@pytest.mark.asyncio
+async def test_spooled_frames_are_archived_before_ack(tmp_path):
+    server = CloudServer(archive_dir=str(tmp_path / "archive"))
+    frames = [_frame(sequence) for sequence in range(MEDIA_ACK_INTERVAL)]
+    for frame in frames[:-1]:
+        assert await server._handle_agent_frame("cam/1", memoryview(frame))
+    # До подтверждения кадры только в памяти
+    assert not os.path.exists(server.archive.path("cam/1"))
+
+    assert await server._handle_agent_frame("cam/1", memoryview(frames[-1]))
+    assert server.media_sequences["cam/1"] == MEDIA_ACK_INTERVAL - 1
+    assert _read_archive(server.archive.path("cam/1")) == frames
+    assert server.archive.path("cam/1").startswith(str(tmp_path / "archive"))
+    # Записанное за обрыв не попадает зрителям живого потока
+    assert server.hub.get_stats()["published"] == 0
+    await server.archive.close()
+
+
+@pytest.mark.asyncio
+async def test_unarchived_frames_are_not_acked(tmp_path):
+    blocked = tmp_path / "archive"
+    blocked.write_bytes(b"")  # Каталог архива не создать
+    server = CloudServer(archive_dir=str(blocked))
+
+    for sequence in range(MEDIA_ACK_INTERVAL - 1):
+        flags = FLAG_SPOOLED if sequence >= 5 else 0
+        assert await server._handle_agent_frame("cam", memoryview(_frame(sequence, flags)))
+    assert not await server._handle_agent_frame("cam", memoryview(_frame(MEDIA_ACK_INTERVAL - 1)))
+    # Агент повторит кадры с первого не записанного
+    assert server.media_sequences["cam"] == 4
+    assert server.archive.stats["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_archive_rotates_and_keeps_max_bytes(tmp_path):
+    archive = MediaArchive(str(tmp_path), file_bytes=1000, max_bytes=3000)
+    header = MEDIA_HEADER.pack(MEDIA, FLAG_SPOOLED, 0, 0, 0)
+    for sequence in range(10):
+        archive.append("cam", sequence, header, memoryview(b"x" * 500))
+        archive.append("cam", sequence, header, memoryview(b"y" * 500))
+        assert await archive.flush("cam") is None
+    await archive.close()
+
+    names = sorted(os.listdir(archive.path("cam")))
+    sizes = [os.path.getsize(os.path.join(archive.path("cam"), name)) for name in names]
+    # Старые файлы удалены, остались последние в пределах max_bytes
+    assert names[-1] == "000000000009.media"
+    assert sum(sizes) <= 3000 + sizes[-1]
+    assert archive.stats["files_removed"] == 10 - len(names)
@@ -0,0 +1,63 @@
+"""
+Объединение мелких кадров в одно сообщение
+"""
+import asyncio
+
+import pytest
+
+from agent.networking.coalescer import SendCoalescer
+from agent.networking.framing import BATCH, HEADER, LENGTH
+
+
+def _unbatch(message: bytes):
+    frame_type, _, _ = HEADER.unpack_from(message)
+    if frame_type != BATCH:
+        return [message]
+    frames, offset = [], HEADER.size
+    while offset < len(message):
+        (length,) = LENGTH.unpack_from(message, offset)
+        offset += LENGTH.size
+        frames.append(message[offset:offset + length])
+        offset += length
+    return frames
+
+
+@pytest.mark.asyncio
+async def test_frames_of_access_unit_go_out_as_one_batch():
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    coalescer = SendCoalescer(send, max_bytes=1024, max_delay=10)
+    frames = [b"\x01\x00\x00\x00a", b"\x01\x00\x00\x00b", b"\x01\x00\x00\x00c"]
+    await coalescer.send(frames[0])
+    await coalescer.send(frames[1])
+    assert messages == []
+    await coalescer.send(frames[2], end_of_unit=True)
+
+    assert len(messages) == 1 and _unbatch(messages[0]) == frames
+    assert coalescer.stats["flush_marker"] == 1
+    assert coalescer.stats["max_packets_per_write"] == 3
+
+    # Одиночный кадр уходит без обертки пакета
+    await coalescer.send(frames[0], end_of_unit=True)
+    assert messages[1] == frames[0]
+
+
+@pytest.mark.asyncio
+async def test_size_and_delay_thresholds_flush():
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    coalescer = SendCoalescer(send, max_bytes=8, max_delay=0.01)
+    await coalescer.send(b"\x01\x00\x00\x00" + b"x" * 8)
+    assert coalescer.stats["flush_size"] == 1
+
+    await coalescer.send(b"\x01\x00\x00\x00y")
+    await asyncio.sleep(0.05)
+    assert coalescer.stats["flush_delay"] == 1
+    assert len(messages) == 2
+    coalescer.close()
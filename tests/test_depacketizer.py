@@ -0,0 +1,111 @@
+"""
+Сборка кадров H.264/H.265 из RTP: фрагменты, агрегаты, потери
+"""
+import pytest
+
+from agent.streaming.depacketizer import (
+    START_CODE, Depacketizer, H264Depacketizer, H265Depacketizer, create_depacketizer
+)
+
+SPS = b"\x67\x42\x00\x1f"
+PPS = b"\x68\xce\x3c\x80"
+IDR = b"\x65" + b"\x88" * 10
+
+
+def _collect(depacketizer_class, **kwargs):
+    units = []
+    return depacketizer_class(units.append, **kwargs), units
+
+
+def _stap_a(*nals: bytes) -> bytes:
+    return b"\x18" + b"".join(len(nal).to_bytes(2, "big") + nal for nal in nals)
+
+
+def _fu_a(nal: bytes, size: int):
+    """Фрагменты FU-A NAL по size байт полезной нагрузки"""
+    indicator = (nal[0] & 0xE0) | 28
+    body = nal[1:]
+    chunks = [body[i:i + size] for i in range(0, len(body), size)]
+    for index, chunk in enumerate(chunks):
+        header = nal[0] & 0x1F
+        if index == 0:
+            header |= 0x80
+        if index == len(chunks) - 1:
+            header |= 0x40
+        yield bytes([indicator, header]) + chunk
+
+
+def test_depacketizer_is_abstract():
+    with pytest.raises(TypeError):
+        Depacketizer(lambda unit: None)
+
+
+def test_h264_stap_a_and_fu_a_form_one_access_unit():
+    depacketizer, units = _collect(H264Depacketizer)
+    packets = [_stap_a(SPS, PPS)] + list(_fu_a(IDR, 4))
+    for index, packet in enumerate(packets):
+        depacketizer.push(memoryview(packet), 3000, 100 + index, index == len(packets) - 1)
+
+    assert len(units) == 1
+    unit = units[0]
+    assert unit.keyframe and unit.parameter_sets and unit.timestamp == 3000
+    assert bytes(unit.data) == START_CODE + SPS + START_CODE + PPS + START_CODE + IDR
+
+
+def test_h264_keyframe_gets_parameter_sets_from_sdp():
+    depacketizer, units = _collect(H264Depacketizer, parameter_sets=[SPS, PPS])
+    depacketizer.push(memoryview(IDR), 0, 1, True)
+    assert bytes(units[0].data) == START_CODE + SPS + START_CODE + PPS + START_CODE + IDR
+
+
+def test_h264_lost_fragment_drops_until_keyframe():
+    depacketizer, units = _collect(H264Depacketizer)
+    fragments = list(_fu_a(IDR, 3))
+    depacketizer.push(memoryview(fragments[0]), 0, 1, False)
+    # Средний фрагмент потерян
+    depacketizer.push(memoryview(fragments[2]), 0, 3, False)
+    depacketizer.push(memoryview(fragments[3]), 0, 4, True)
+    # Зависимый кадр без ключевого тоже отбрасывается
+    depacketizer.push(memoryview(b"\x41\x9a"), 3000, 5, True)
+    assert units == []
+    assert depacketizer.stats["lost_packets"] == 1
+    assert depacketizer.stats["dropped_access_units"] == 2
+
+    depacketizer.push(memoryview(IDR), 6000, 6, True)
+    assert len(units) == 1 and units[0].keyframe
+
+
+def test_h264_timestamp_change_ends_access_unit_without_marker():
+    depacketizer, units = _collect(H264Depacketizer)
+    depacketizer.push(memoryview(IDR), 0, 1, False)
+    depacketizer.push(memoryview(b"\x41\x9a"), 3000, 2, True)
+    assert [unit.timestamp for unit in units] == [0, 3000]
+
+
+def test_h265_aggregation_packet_and_fu():
+    vps, sps, pps = b"\x40\x01\x0c", b"\x42\x01\x01", b"\x44\x01\xc1"
+    idr = b"\x26\x01" + b"\xaf" * 8  # IDR_W_RADL (19)
+    depacketizer, units = _collect(H265Depacketizer)
+    aggregate = b"\x60\x01" + b"".join(len(nal).to_bytes(2, "big") + nal for nal in (vps, sps, pps))
+    fu_indicator = bytes([(idr[0] & 0x81) | (49 << 1), idr[1]])
+    depacketizer.push(memoryview(aggregate), 90, 1, False)
+    depacketizer.push(memoryview(fu_indicator + b"\x93" + idr[2:6]), 90, 2, False)
+    depacketizer.push(memoryview(fu_indicator + b"\x53" + idr[6:]), 90, 3, True)
+
+    assert len(units) == 1
+    assert units[0].keyframe and units[0].parameter_sets
+    assert bytes(units[0].data) == b"".join(START_CODE + nal for nal in (vps, sps, pps, idr))
+
+
+def test_truncated_aggregate_breaks_access_unit():
+    depacketizer, units = _collect(H264Depacketizer)
+    depacketizer.push(memoryview(b"\x18\x00\x10" + SPS), 0, 1, True)
+    assert units == [] and depacketizer.stats["dropped_access_units"] == 1
+
+
+def test_create_depacketizer_decodes_sprop_parameter_sets():
+    depacketizer = create_depacketizer(
+        "h264", {"sprop-parameter-sets": "Z0IAHw==,aM48gA=="}, lambda unit: None
+    )
+    assert isinstance(depacketizer, H264Depacketizer)
+    assert depacketizer.parameter_sets == [SPS, PPS]
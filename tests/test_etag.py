@@ -0,0 +1,71 @@
+"""
+Сохраненный JSON записей и ETag: 304 без изменений, поток медиа запись не меняет
+"""
+import json
+
+from fastapi.testclient import TestClient
+
+from agent.networking.framing import FLAG_AU_END, FLAG_AU_START, pack_media_frame
+from server import MEDIA_ACK_INTERVAL, CloudServer
+
+
+def _send(websocket, message_type: str, data: dict):
+    websocket.send_text(json.dumps({"type": message_type, "data": data}))
+
+
+def _media_ack(websocket, first: int):
+    """Пачка медиа кадров до подтверждения; прежние сообщения к этому времени обработаны"""
+    for sequence in range(first, first + MEDIA_ACK_INTERVAL):
+        websocket.send_bytes(pack_media_frame(0, sequence, sequence * 3000, b"au",
+                                              FLAG_AU_START | FLAG_AU_END))
+    assert json.loads(websocket.receive_text())["type"] == "media_ack"
+
+
+def test_agent_etag_changes_only_with_record():
+    server = CloudServer()
+    with TestClient(server.app) as client, client.websocket_connect("/agent/cam") as agent:
+        _send(agent, "register", {"stats": {"fps": 20}})
+        agent.receive_text()
+
+        response = client.get("/agents/cam")
+        etag = response.headers["etag"]
+        assert client.get("/agents/cam", headers={"If-None-Match": etag}).status_code == 304
+        assert client.get("/agents", headers={"If-None-Match": "*"}).status_code == 304
+
+        # Подтверждения медиа продлевают срок агента, но не меняют запись
+        deadline = server.expiry.deadline("cam")
+        _media_ack(agent, 0)
+        assert server.expiry.deadline("cam") > deadline
+        assert client.get("/agents/cam", headers={"If-None-Match": etag}).status_code == 304
+        list_etag = client.get("/agents").headers["etag"]
+
+        # Статус с теми же значениями - тоже без изменений
+        _send(agent, "status_update", {"status": "connected", "stats": {"fps": 20}})
+        _media_ack(agent, MEDIA_ACK_INTERVAL)
+        assert client.get("/agents", headers={"If-None-Match": list_etag}).status_code == 304
+
+        _send(agent, "status_update", {"status": "connected", "stats": {"fps": 15}})
+        _media_ack(agent, 2 * MEDIA_ACK_INTERVAL)
+        response = client.get("/agents/cam", headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.json()["stats"]["fps"] == 15
+        etag = response.headers["etag"]
+
+        _send(agent, "heartbeat", {"stats": {"fps": 15}})
+        agent.receive_text()
+        response = client.get("/agents/cam", headers={"If-None-Match": f'W/{etag}, "0"'})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+
+
+def test_cached_json_is_reused_until_change():
+    server = CloudServer()
+    with TestClient(server.app) as client, client.websocket_connect("/agent/cam") as agent:
+        _send(agent, "register", {})
+        agent.receive_text()
+        first = server.registry.agent_json("cam")
+        assert server.registry.agent_json("cam") is first
+        server.registry.seen("cam")
+        assert server.registry.agent_json("cam") is first
+        server.registry.set_status("cam", "stale")
+        assert server.registry.agent_json("cam") is not first
+        assert json.loads(server.registry.agent_json("cam"))["status"] == "stale"
@@ -0,0 +1,92 @@
+"""
+Потерянные агенты: срок по интервалу heartbeat каждого агента
+"""
+import json
+import time
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+
+from registry import AgentInfo
+from server import HEARTBEAT_MISSES, CloudServer
+from timing_wheel import TimingWheel
+
+
+def _register(websocket, **data):
+    websocket.send_text(json.dumps({"type": "register", "data": data}))
+    assert json.loads(websocket.receive_text())["type"] == "registration_confirmed"
+
+
+def test_agents_expire_after_their_own_heartbeat_interval():
+    server = CloudServer(heartbeat_interval=20)
+    with TestClient(server.app) as client, \
+            client.websocket_connect("/agent/fast") as fast, \
+            client.websocket_connect("/agent/slow") as slow, \
+            client.websocket_connect("/agent/default") as default:
+        _register(fast, heartbeat_interval=2)
+        _register(slow, heartbeat_interval=120)
+        _register(default)
+        assert server.heartbeat_timeouts == {
+            "fast": 2 * HEARTBEAT_MISSES,
+            "slow": 120 * HEARTBEAT_MISSES,
+            "default": 20 * HEARTBEAT_MISSES
+        }
+
+        # Через 10 с истек только срок агента с интервалом 2 с
+        now = time.monotonic()
+        fast.portal.call(server._expire, now + 10)
+        assert server.agents["fast"].status == "stale"
+        assert fast.receive()["code"] == 1001
+        assert server.agents["slow"].status == "connected"
+        assert server.agents["default"].status == "connected"
+
+        # Срок дальше горизонта колеса (60 с) не истекает раньше времени
+        fast.portal.call(server._expire, now + 100)
+        assert server.agents["default"].status == "stale"
+        assert server.agents["slow"].status == "connected"
+        fast.portal.call(server._expire, now + 400)
+        assert server.agents["slow"].status == "stale"
+
+
+def test_sweeper_runs_with_application_lifespan():
+    server = CloudServer()
+    server.registry.add(AgentInfo("lost", "dahua", "connected", datetime.utcnow(),
+                                  datetime.utcnow(), "10.0.0.1", {}))
+    server.expiry.schedule("lost", time.monotonic())
+    # Проверка сроков запускается приложением, без CloudServer.start()
+    with TestClient(server.app):
+        deadline = time.monotonic() + 5
+        while server.agents["lost"].status != "stale" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert server.agents["lost"].status == "stale"
+    assert server.expired_total == 1
+
+
+def test_wheel_rolls_over_and_reschedules_far_deadlines():
+    wheel = TimingWheel(tick=1.0, horizon=10.0, now=0.0)
+    wheel.schedule("near", 3.5)
+    wheel.schedule("far", 35.0)  # За горизонтом: в последнем слоте, затем перенос
+    wheel.schedule("moved", 5.0)
+    wheel.schedule("moved", 25.0)
+    assert len(wheel) == 3 and wheel.deadline("far") == 35.0
+
+    expired = []
+    for now in range(1, 40):
+        for key in wheel.advance(float(now)):
+            expired.append((now, key))
+    # Каждый ключ - в первом тике не раньше своего срока, несколько оборотов колеса
+    assert expired == [(4, "near"), (25, "moved"), (35, "far")]
+    assert len(wheel) == 0
+
+
+def test_wheel_after_long_pause_expires_all_due_keys():
+    wheel = TimingWheel(tick=1.0, horizon=10.0, now=0.0)
+    for index in range(10):
+        wheel.schedule(f"agent{index}", 1.0 + index)
+    wheel.schedule("later", 200.0)
+    wheel.cancel("agent3")
+    # Цикл событий стоял дольше оборота колеса
+    assert sorted(wheel.advance(150.0)) == sorted(f"agent{index}" for index in range(10)
+                                                 if index != 3)
+    assert "later" in wheel and wheel.advance(199.0) == []
+    assert wheel.advance(200.0) == ["later"]
@@ -0,0 +1,41 @@
+"""
+Формат кадров агента и сервера - одно определение
+"""
+import pytest
+
+import media_hub
+import server
+from agent.networking import framing
+from agent.networking.framing import (
+    FLAG_AU_END, FLAG_AU_START, FLAG_KEYFRAME, pack_batch, pack_frame, pack_media_frame
+)
+
+
+def test_server_uses_agent_wire_format():
+    for name in ("MEDIA", "MEDIA_HEADER", "BATCH", "LENGTH", "FLAG_SPOOLED",
+                 "TUNNEL_OPEN", "TUNNEL_RST"):
+        assert getattr(server, name) is getattr(framing, name)
+    for name in ("MEDIA", "MEDIA_HEADER", "FLAG_KEYFRAME", "FLAG_AU_START", "FLAG_AU_END"):
+        assert getattr(media_hub, name) is getattr(framing, name)
+
+
+@pytest.mark.asyncio
+async def test_agent_batch_is_parsed_by_server():
+    cloud = server.CloudServer()
+    viewer = cloud.hub.subscribe("cam", 0)
+    whole = FLAG_AU_START | FLAG_AU_END
+    batch = pack_batch([
+        pack_media_frame(0, 7, 90000, b"key", whole | FLAG_KEYFRAME),
+        pack_media_frame(0, 8, 93000, b"delta", whole),
+    ])
+    assert await cloud._handle_agent_frame("cam", memoryview(batch))
+    assert cloud.media_sequences["cam"] == 8
+    units = [await viewer.get(), await viewer.get()]
+    assert [bytes(unit.data) for unit in units] == [b"key", b"delta"]
+    # Зритель получает кадр в том же формате, что отправил агент
+    frame_type, flags, channel, _, timestamp = framing.MEDIA_HEADER.unpack_from(units[0].frame)
+    assert (frame_type, flags, channel, timestamp) == (framing.MEDIA, whole | FLAG_KEYFRAME, 0, 90000)
+
+    # Неизвестный тип кадра не принимается за медиа
+    assert await cloud._handle_agent_frame("cam", memoryview(pack_frame(0x7F, 0, b"x")))
+    assert cloud.media_sequences["cam"] == 8
@@ -0,0 +1,59 @@
+"""
+Списки /agents и /streams: фильтры, страницы, NDJSON
+"""
+import json
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+
+from registry import AgentInfo, StreamInfo
+from server import CloudServer
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def _server(count: int) -> CloudServer:
+    server = CloudServer()
+    for index in range(count):
+        agent_id = f"cam{index:03d}"
+        server.registry.add(AgentInfo(agent_id, "hik" if index % 2 else "dahua",
+                                      "connected", NOW, NOW, "10.0.0.1", {}))
+        server.registry.add_stream(StreamInfo(agent_id, "rtsp://x", "high", index % 3 == 0, 0))
+    return server
+
+
+def test_agents_are_paged_by_cursor():
+    server = _server(25)
+    with TestClient(server.app) as client:
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 10, "model": "hik"}
+            if cursor:
+                params["cursor"] = cursor
+            page = client.get("/agents", params=params).json()
+            seen += [agent["agent_id"] for agent in page["items"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == [f"cam{index:03d}" for index in range(1, 25, 2)]
+
+        # Без cursor и limit - прежний ответ списком
+        assert len(client.get("/agents").json()) == 25
+
+
+def test_projection_and_ndjson():
+    server = _server(5)
+    with TestClient(server.app) as client:
+        response = client.get("/agents", params={"fields": "status", "format": "ndjson"})
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert lines[0] == {"agent_id": "cam000", "status": "connected"}
+        assert len(lines) == 5
+
+        streams = client.get("/streams", params={"active": "true", "limit": 1}).json()
+        assert [stream["agent_id"] for stream in streams["items"]] == ["cam000"]
+        assert streams["next_cursor"] == "cam000"
+
+        assert client.get("/agents", params={"fields": "password"}).status_code == 400
+        assert client.get("/agents", params={"format": "xml"}).status_code == 400
+        assert client.get("/agents", params={"limit": 0}).status_code == 422
@@ -0,0 +1,74 @@
+"""
+Раздача медиа зрителям по каналам потока
+"""
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from media_hub import FLAG_AU_END, FLAG_AU_START, FLAG_KEYFRAME, MEDIA, MEDIA_HEADER, MediaHub
+from server import CloudServer
+
+WHOLE = FLAG_AU_START | FLAG_AU_END
+
+
+def _publish_two_channels(hub: MediaHub, count: int):
+    """Основной поток (GOP 10) и субпоток (GOP 4) вперемешку"""
+    for index in range(count):
+        hub.publish("cam", memoryview(b"main%d" % index), channel=0, timestamp=index,
+                    flags=WHOLE | (FLAG_KEYFRAME if index % 10 == 0 else 0))
+        hub.publish("cam", memoryview(b"sub%d" % index), channel=1, timestamp=index,
+                    flags=WHOLE | (FLAG_KEYFRAME if index % 4 == 2 else 0))
+
+
+@pytest.mark.asyncio
+async def test_viewer_receives_only_its_channel():
+    hub = MediaHub()
+    main = hub.subscribe("cam", 0)
+    sub = hub.subscribe("cam", 1)
+    _publish_two_channels(hub, 20)
+
+    main_units = [await main.get() for _ in range(len(main.queue))]
+    sub_units = [await sub.get() for _ in range(len(sub.queue))]
+
+    assert {unit.channel for unit in main_units} == {0}
+    assert {unit.channel for unit in sub_units} == {1}
+    assert [bytes(unit.data) for unit in main_units] == [b"main%d" % i for i in range(20)]
+    # Субпоток начинается со своего ключевого кадра, нумерация канала своя
+    assert [bytes(unit.data) for unit in sub_units] == [b"sub%d" % i for i in range(2, 20)]
+    assert [unit.sequence for unit in sub_units] == list(range(2, 20))
+    assert hub.subscribers("cam") == 2 and hub.subscribers("cam", 1) == 1
+
+
+@pytest.mark.asyncio
+async def test_lagging_viewer_resumes_on_own_channel_keyframe():
+    """После сброса очереди зритель ждет ключевого кадра своего канала"""
+    hub = MediaHub(max_units=3)
+    main = hub.subscribe("cam", 0)
+    _publish_two_channels(hub, 12)
+
+    units = [await main.get() for _ in range(len(main.queue))]
+    assert main.skips > 0
+    assert units[0].keyframe and units[0].channel == 0
+    assert bytes(units[0].data) == b"main10"
+
+
+def test_viewer_websocket_selects_stream():
+    cloud = CloudServer()
+    # Один цикл событий на все сокеты: хаб будит зрителя из цикла агента
+    with TestClient(cloud.app) as client, client.websocket_connect("/agent/cam") as agent:
+        agent.send_text(json.dumps({"type": "register", "data": {}}))
+        agent.receive_text()
+        with client.websocket_connect("/streams/cam/ws?stream=sub") as viewer:
+            while not cloud.hub.subscribers("cam", 1):
+                time.sleep(0.01)
+            for channel, payload in ((0, b"main-key"), (1, b"sub-key")):
+                agent.send_bytes(MEDIA_HEADER.pack(MEDIA, WHOLE | FLAG_KEYFRAME, channel,
+                                                   channel, 0) + payload)
+            frame = viewer.receive_bytes()
+            assert MEDIA_HEADER.unpack_from(frame)[2] == 1
+            assert frame[MEDIA_HEADER.size:] == b"sub-key"
+            assert cloud.streams["cam"].viewers_count == 1
+        with client.websocket_connect("/streams/cam/ws?stream=thermal") as viewer:
+            assert viewer.receive()["code"] == 4400
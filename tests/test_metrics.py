@@ -0,0 +1,68 @@
+"""
+Счетчики, гистограммы и endpoint /metrics агента
+"""
+import asyncio
+
+import pytest
+
+from agent.core.metrics import Histogram, MetricsRegistry, MetricsServer
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram((0.01, 0.1, 1.0))
+    for value in (0.005, 0.01, 0.05, 0.5, 5.0):
+        histogram.observe(value)
+    # Граница корзины включительно (le), сверх последней - +Inf
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(1.0) == float("inf")
+    assert histogram.get_stats()["buckets"] == {"0.01": 2, "0.1": 3, "1": 4, "+Inf": 5}
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter("frames_total", "Frames", {"stream": "main"}).inc(3)
+    registry.gauge("queue_bytes", "Queue", function=lambda: 1.5)
+    registry.histogram("send_seconds", "Send", {"stream": "main"}, buckets=(0.1,)).observe(0.05)
+
+    text = registry.render()
+    assert '# TYPE frames_total counter\nframes_total{stream="main"} 3\n' in text
+    assert "queue_bytes 1.5\n" in text
+    assert 'send_seconds_bucket{stream="main",le="0.1"} 1\n' in text
+    assert 'send_seconds_bucket{stream="main",le="+Inf"} 1\n' in text
+    assert 'send_seconds_count{stream="main"} 1\n' in text
+
+
+def test_delta_reports_counter_increments_and_changed_gauges():
+    registry = MetricsRegistry()
+    frames = registry.counter("frames_total", "Frames")
+    level = registry.gauge("level", "Level")
+    frames.inc(5)
+    level.set(2)
+    baseline = registry.snapshot()
+
+    frames.inc(2)
+    delta = registry.delta(registry.snapshot(), baseline)
+    assert delta == {"counters": {"frames_total": 2}, "gauges": {}}
+    level.set(3)
+    assert registry.delta(registry.snapshot(), baseline)["gauges"] == {"level": 3}
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    registry = MetricsRegistry()
+    registry.counter("frames_total", "Frames").inc()
+    server = MetricsServer(registry, "127.0.0.1", 0)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+    try:
+        for path, status in ((b"/metrics", b"200"), (b"/other", b"404")):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET " + path + b" HTTP/1.1\r\nHost: agent\r\n\r\n")
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            assert response.split(b" ")[1] == status
+            if status == b"200":
+                assert response.endswith(b"frames_total 1\n")
+    finally:
+        await server.stop()
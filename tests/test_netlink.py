@@ -0,0 +1,75 @@
+"""
+Адреса и маршруты rtnetlink: выбор маршрута по умолчанию и снимок таблицы
+"""
+import socket
+import struct
+
+import pytest
+
+from agent.networking import netlink
+from agent.networking.netlink import (
+    IFA_LOCAL, IFADDRMSG, RT_TABLE_MAIN, RTA_GATEWAY, RTA_OIF, RTA_PRIORITY, RTATTR,
+    RTM_DELROUTE, RTM_NEWADDR, RTM_NEWROUTE, RTMSG, RTN_UNICAST, AddressMonitor, RouteTable
+)
+
+
+def _attribute(attribute_type: int, value: bytes) -> bytes:
+    data = RTATTR.pack(RTATTR.size + len(value), attribute_type) + value
+    return data + b"\0" * (-len(data) % 4)
+
+
+def _address(index: int, address: str) -> memoryview:
+    return memoryview(IFADDRMSG.pack(socket.AF_INET, 24, 0, 0, index)
+                      + _attribute(IFA_LOCAL, socket.inet_aton(address)))
+
+
+def _route(index: int, gateway: str, priority=None) -> memoryview:
+    payload = RTMSG.pack(socket.AF_INET, 0, 0, 0, RT_TABLE_MAIN, 0, 0, RTN_UNICAST, 0)
+    payload += _attribute(RTA_OIF, struct.pack("=I", index))
+    payload += _attribute(RTA_GATEWAY, socket.inet_aton(gateway))
+    if priority is not None:
+        payload += _attribute(RTA_PRIORITY, struct.pack("=I", priority))
+    return memoryview(payload)
+
+
+def test_default_route_with_lowest_metric_wins():
+    table = RouteTable()
+    table.apply(RTM_NEWADDR, _address(2, "192.168.1.10"))
+    table.apply(RTM_NEWADDR, _address(3, "10.0.0.5"))
+    # eth0 с метрикой 600 (резерв) и wwan с метрикой 100 на большем индексе
+    table.apply(RTM_NEWROUTE, _route(2, "192.168.1.1", priority=600))
+    table.apply(RTM_NEWROUTE, _route(3, "10.0.0.1", priority=100))
+    assert table.state() == ("10.0.0.5", "10.0.0.1")
+
+    # Маршрут с другой метрикой на том же интерфейсе - отдельный маршрут
+    table.apply(RTM_NEWROUTE, _route(2, "192.168.1.1", priority=50))
+    assert table.state() == ("192.168.1.10", "192.168.1.1")
+    table.apply(RTM_DELROUTE, _route(2, "192.168.1.1", priority=50))
+    assert table.state() == ("10.0.0.5", "10.0.0.1")
+    table.apply(RTM_DELROUTE, _route(3, "10.0.0.1", priority=100))
+    assert table.state() == ("192.168.1.10", "192.168.1.1")
+
+
+def test_route_without_priority_has_metric_zero():
+    table = RouteTable()
+    table.apply(RTM_NEWADDR, _address(2, "192.168.1.10"))
+    table.apply(RTM_NEWADDR, _address(3, "10.0.0.5"))
+    table.apply(RTM_NEWROUTE, _route(2, "192.168.1.1", priority=10))
+    table.apply(RTM_NEWROUTE, _route(3, "10.0.0.1"))
+    assert table.state() == ("10.0.0.5", "10.0.0.1")
+
+
+@pytest.mark.asyncio
+async def test_failed_dump_does_not_escape_start(monkeypatch):
+    try:
+        socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE).close()
+    except (AttributeError, OSError):
+        pytest.skip("rtnetlink недоступен")
+
+    def failing_dump():
+        raise OSError("dump timed out")
+
+    monitor = AddressMonitor(lambda previous, state: None)
+    monkeypatch.setattr(netlink, "dump", failing_dump)
+    assert await monitor.start() == (None, None)
+    assert not monitor.available
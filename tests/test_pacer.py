@@ -0,0 +1,54 @@
+"""
+Корзина токенов и равномерная отправка ключевых кадров
+"""
+import pytest
+
+from agent.networking.pacer import MediaPacer
+from agent.networking.scheduler import TokenBucket
+
+
+def test_token_bucket_allows_burst_then_paces():
+    bucket = TokenBucket(rate=1000, burst=500)
+    start = bucket._updated
+    assert bucket.reserve(500, start) == 0.0
+    # Всплеск выбран: следующие 250 байт - через четверть секунды
+    assert bucket.reserve(250, start) == pytest.approx(0.25)
+    # Токены копятся со временем, но не больше burst
+    assert bucket.reserve(100, start + 10) == 0.0
+    assert bucket.tokens == pytest.approx(400)
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(rate=0, burst=0)
+    assert bucket.reserve(10 ** 9, bucket._updated) == 0.0
+
+
+@pytest.mark.asyncio
+async def test_keyframe_is_spread_over_frame_interval():
+    pacer = MediaPacer(chunk_size=1000, clock_rate=90000)
+    sent = []
+
+    async def send_chunk(chunk, first, last):
+        sent.append((len(chunk), first, last))
+
+    await pacer.pace(b"p" * 10, 0, send_chunk)
+    # Интервал кадра по RTP timestamp: 9000 / 90000 = 0.1 с
+    waited = await pacer.pace(b"k" * 4500, 9000, send_chunk)
+    assert pacer.interval == pytest.approx(0.1)
+    assert sent[1:] == [(1000, True, False), (1000, False, False), (1000, False, False),
+                        (1000, False, False), (500, False, True)]
+    # Пять фрагментов через 0.02 с: последний не раньше 0.08 с
+    assert waited >= 0.07
+
+
+def test_timestamp_jump_keeps_previous_interval():
+    pacer = MediaPacer(default_interval=0.04)
+    pacer._update_interval(0)
+    pacer._update_interval(3600)
+    assert pacer.interval == pytest.approx(0.04)
+    pacer._update_interval(3600 + 90000 * 5)  # Переключение потока
+    assert pacer.interval == pytest.approx(0.04)
+    # Переход timestamp через 2^32
+    pacer._update_interval(0xFFFFF000)
+    pacer._update_interval((0xFFFFF000 + 7200) & 0xFFFFFFFF)
+    assert pacer.interval == pytest.approx(0.08)
@@ -0,0 +1,79 @@
+"""
+Реестр агентов: индексы, статистика и выборка по страницам
+"""
+from datetime import datetime, timedelta
+
+from registry import AgentInfo, AgentRegistry, StreamInfo
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def _agent(agent_id: str, status: str = "connected", model: str = "dahua",
+           heartbeat: datetime = NOW) -> AgentInfo:
+    return AgentInfo(agent_id, model, status, NOW, heartbeat, "10.0.0.1", {})
+
+
+def _assert_consistent(registry: AgentRegistry):
+    """Индексы и счетчики совпадают с полным пересчетом"""
+    by_status, by_model = {}, {}
+    for agent in registry.agents.values():
+        by_status[agent.status] = by_status.get(agent.status, 0) + 1
+        by_model[agent.camera_model] = by_model.get(agent.camera_model, 0) + 1
+    assert registry.get_statistics()["agents_by_status"] == by_status
+    assert registry.models() == by_model
+    assert registry._ids == sorted(registry.agents)
+    assert registry.active_streams == sum(s.active for s in registry.streams.values())
+    assert registry.total_viewers == sum(s.viewers_count for s in registry.streams.values())
+
+
+def test_indexes_follow_every_change():
+    registry = AgentRegistry()
+    for index in range(10):
+        registry.add(_agent(f"cam{index}", model="hik" if index % 3 else "dahua"))
+        registry.add_stream(StreamInfo(f"cam{index}", "rtsp://x", "high", index % 2 == 0, 0))
+    _assert_consistent(registry)
+
+    registry.set_status("cam1", "disconnected")
+    registry.set_status("cam2", "disconnected")
+    registry.set_stream_active("cam1", True)
+    registry.add_viewers("cam4", 3)
+    registry.add(_agent("cam3", status="disconnected", model="axis"))  # Повторная регистрация
+    registry.remove("cam5")
+    _assert_consistent(registry)
+    assert registry.count("disconnected") == 3
+    assert registry.get_statistics()["total_viewers"] == 3
+    assert "cam5" not in registry and "cam5" not in registry.streams
+
+
+def test_stale_agents_found_by_heartbeat_bucket():
+    registry = AgentRegistry(bucket_seconds=60)
+    registry.add(_agent("old", heartbeat=NOW - timedelta(minutes=10)))
+    registry.add(_agent("edge", heartbeat=NOW - timedelta(seconds=95)))
+    registry.add(_agent("fresh", heartbeat=NOW - timedelta(seconds=85)))
+    cutoff = NOW - timedelta(seconds=90)
+    assert sorted(agent.agent_id for agent in registry.stale_since(cutoff)) == ["edge", "old"]
+
+    registry.heartbeat("old", NOW)
+    assert [agent.agent_id for agent in registry.select(stale_before=cutoff)] == ["edge"]
+
+
+def test_select_pages_by_cursor_while_registry_changes():
+    registry = AgentRegistry()
+    for agent_id in ("c", "a", "e", "b", "d"):
+        registry.add(_agent(agent_id, status="offline" if agent_id in "bd" else "connected"))
+
+    assert [agent.agent_id for agent in registry.select(after="b")] == ["c", "d", "e"]
+    assert [agent.agent_id for agent in registry.select("connected", after="a")] == ["c", "e"]
+    assert [agent.agent_id for agent in registry.select(model="axis")] == []
+
+    # Генератор читается по частям: удаление и добавление не ломают обход
+    pages = registry.select()
+    assert next(pages).agent_id == "a"
+    registry.remove("b")
+    registry.add(_agent("bb"))
+    assert [agent.agent_id for agent in pages] == ["bb", "c", "d", "e"]
+
+    registry.add_stream(StreamInfo("c", "rtsp://x", "high", True, 0))
+    registry.add_stream(StreamInfo("e", "rtsp://x", "high", False, 0))
+    assert [stream.agent_id for stream in registry.select_streams(active=True)] == ["c"]
+    assert [stream.agent_id for stream in registry.select_streams(after="c")] == ["e"]
@@ -0,0 +1,60 @@
+"""
+Кольцевой буфер повторной отправки: вытеснение целых GOP
+"""
+import pytest
+
+from agent.streaming.ring_buffer import GopRingBuffer
+
+
+def _drain(buffer: GopRingBuffer):
+    items = []
+    while buffer:
+        items.append(buffer.pop())
+    return items
+
+
+def test_overflow_evicts_oldest_gop_whole():
+    buffer = GopRingBuffer(max_bytes=10)
+    for data, sync in ((b"K1", True), (b"d1", False), (b"d2", False),
+                       (b"K2", True), (b"d3", False)):
+        assert buffer.push(data, sync)
+    # 12 байт не помещаются: уходит вся первая GOP, а не один кадр
+    assert buffer.push(b"d4", sync=False)
+    assert _drain(buffer) == [b"K2", b"d3", b"d4"]
+    assert buffer.stats["dropped_gops"] == 1
+    assert buffer.stats["dropped_items"] == 3
+    assert buffer.stats["dropped_bytes"] == 6
+    assert buffer.bytes_used == 0
+
+
+def test_frames_of_evicted_tail_gop_are_dropped_until_keyframe():
+    buffer = GopRingBuffer(max_bytes=6)
+    buffer.push(b"K1", True)
+    buffer.push(b"d1", False)
+    buffer.push(b"d2", False)
+    # Вытеснена GOP, в которую пишется хвост: ее кадры больше не нужны
+    assert not buffer.push(b"d3d3", sync=False)
+    assert not buffer.push(b"d4", sync=False)
+    assert buffer.push(b"K2", sync=True)
+    assert _drain(buffer) == [b"K2"]
+
+
+def test_capacity_limit_and_wraparound():
+    buffer = GopRingBuffer(max_bytes=1000, capacity=3)
+    for index in range(5):
+        assert buffer.push(b"%d" % index)
+    assert buffer.stats["dropped_gops"] == 2
+    assert buffer.pop() == b"2"
+    # Слот освободился в начале массива: запись идет по кругу
+    buffer.push(b"5")
+    assert _drain(buffer) == [b"3", b"4", b"5"]
+
+
+def test_item_larger_than_budget_is_rejected():
+    buffer = GopRingBuffer(max_bytes=4)
+    assert buffer.push(b"K1", True)
+    assert not buffer.push(b"x" * 5, sync=True)
+    assert buffer.stats["rejected"] == 1
+    assert buffer.peek() == b"K1"
+    with pytest.raises(ValueError):
+        GopRingBuffer(max_bytes=0)
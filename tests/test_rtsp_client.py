@@ -0,0 +1,151 @@
+"""
+RTSP клиент: сессия с камерой и разбор потока ответов и interleaved кадров
+"""
+import asyncio
+
+import pytest
+
+from agent.streaming.rtsp_client import (
+    RtspClient, RtspError, SessionDescription, _RtspProtocol, parse_auth_params, parse_rtp_header,
+    parse_sdp
+)
+
+SDP = ("v=0\r\n"
+       "m=video 0 RTP/AVP 96\r\n"
+       "a=rtpmap:96 H264/90000\r\n"
+       "a=fmtp:96 packetization-mode=1\r\n"
+       "a=control:track1\r\n")
+
+
+class _Camera:
+    """RTSP сервер камеры; SETUP первого соединения отклоняется"""
+
+    def __init__(self, reject_first_setup: bool):
+        self.reject_first_setup = reject_first_setup
+        self.connections = 0
+        self.methods = []
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        connection = self.connections
+        while True:
+            lines = []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    writer.close()
+                    return
+                if line == b"\r\n":
+                    break
+                lines.append(line.decode().strip())
+            method = lines[0].split()[0]
+            cseq = next(line.split(":")[1].strip() for line in lines if line.startswith("CSeq"))
+            self.methods.append((connection, method))
+
+            headers, body = [f"CSeq: {cseq}"], b""
+            if method == "SETUP" and connection == 1 and self.reject_first_setup:
+                writer.write(f"RTSP/1.0 454 Session Not Found\r\nCSeq: {cseq}\r\n\r\n".encode())
+                await writer.drain()
+                writer.close()
+                return
+            if method == "DESCRIBE":
+                body = SDP.encode()
+                headers += ["Content-Type: application/sdp", f"Content-Length: {len(body)}"]
+            elif method == "SETUP":
+                headers.append("Session: 12345678;timeout=60")
+            writer.write(("RTSP/1.0 200 OK\r\n" + "\r\n".join(headers) + "\r\n\r\n").encode()
+                         + body)
+            await writer.drain()
+
+
+@pytest.mark.asyncio
+async def test_rejected_cached_setup_reopens_session():
+    camera = _Camera(reject_first_setup=True)
+    server = await asyncio.start_server(camera.serve, "127.0.0.1", 0)
+    url = f"rtsp://127.0.0.1:{server.sockets[0].getsockname()[1]}/live"
+    stale = parse_sdp(SDP.replace("track1", "gone"))
+    stale.base = url
+
+    client = RtspClient(url, "admin", "admin", on_packet=lambda channel, packet: None,
+                        timeout=2)
+    try:
+        description = await client.connect(cached=stale)
+        assert isinstance(description, SessionDescription)
+        assert description.control == "track1"
+        assert client.session_id == "12345678"
+
+        # Закрытие отклоненного соединения не завершает новую сессию
+        await asyncio.sleep(0.05)
+        assert not client.closed.done()
+        assert camera.connections == 2
+        assert [method for connection, method in camera.methods if connection == 2] == [
+            "OPTIONS", "DESCRIBE", "SETUP", "PLAY"
+        ]
+    finally:
+        await client.close()
+        server.close()
+
+
+class _Receiver:
+    """Клиент, собирающий разобранные ответы и пакеты"""
+
+    def __init__(self):
+        self._transport = None
+        self.responses = []
+        self.packets = []
+
+    def _on_response(self, response):
+        self.responses.append(response)
+
+    def _on_packet(self, channel, packet):
+        self.packets.append((channel, bytes(packet)))
+
+    def _connection_lost(self, exc):
+        pass
+
+
+def _feed(protocol: _RtspProtocol, data: bytes, chunk: int):
+    for offset in range(0, len(data), chunk):
+        part = data[offset:offset + chunk]
+        buffer = protocol.get_buffer(len(part))
+        buffer[:len(part)] = part
+        protocol.buffer_updated(len(part))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk", [1, 7, 4096])
+async def test_parser_splits_responses_and_interleaved_frames(chunk):
+    receiver = _Receiver()
+    protocol = _RtspProtocol(receiver, buffer_size=0)
+    body = SDP.encode()
+    stream = (
+        b"RTSP/1.0 200 OK\r\nCSeq: 3\r\nContent-Length: " + str(len(body)).encode()
+        + b"\r\nWWW-Authenticate: Basic realm=\"cam\"\r\n\r\n" + body
+        + b"$\x00\x00\x03abc"
+        + b"RTSP/1.0 401 Unauthorized\r\nCSeq: 4\r\n\r\n"
+        + b"$\x01" + b"\xff\xff" + b"x" * 65535
+    )
+    _feed(protocol, stream, chunk)
+
+    assert [(r.status, r.headers["cseq"]) for r in receiver.responses] == [(200, "3"), (401, "4")]
+    assert receiver.responses[0].body == body
+    assert receiver.responses[0].auth_challenges == ['Basic realm="cam"']
+    assert receiver.packets == [(0, b"abc"), (1, b"x" * 65535)]
+
+
+def test_rtp_header_with_csrc_extension_and_padding():
+    header = bytes([0x80 | 0x20 | 0x10 | 1, 0x80 | 96]) + (513).to_bytes(2, "big")
+    header += (90000).to_bytes(4, "big") + b"SSRC" + b"CSRC"
+    extension = b"\xbe\xde\x00\x01" + b"EXT!"
+    packet = header + extension + b"payload" + b"\x00\x00\x03"
+    marker, sequence, timestamp, payload = parse_rtp_header(memoryview(packet))
+    assert (marker, sequence, timestamp) == (True, 513, 90000)
+    assert bytes(payload) == b"payload"
+
+    with pytest.raises(RtspError):
+        parse_rtp_header(memoryview(b"\x80" * 11))
+
+
+def test_auth_params_quoted_and_token_values():
+    params = parse_auth_params('realm="IP Camera", nonce="a,b", qop=auth, Stale=FALSE')
+    assert params == {"realm": "IP Camera", "nonce": "a,b", "qop": "auth", "stale": "FALSE"}
@@ -0,0 +1,57 @@
+"""
+Ретранслятор RTSP: очереди клиента и авторизация
+"""
+import asyncio
+
+import pytest
+
+from agent.streaming.rtsp_client import md5_hex
+from agent.streaming.rtsp_relay import REALM, RtspRelay, _RelayClient, _RelayConnection
+
+
+class _Channel:
+    """Канал туннеля, записывающий отправленное"""
+
+    def __init__(self):
+        self.written = []
+
+    async def write(self, data: bytes):
+        self.written.append(data)
+
+
+def _digest(connection: _RelayConnection, realm: str, password: str = "secret") -> str:
+    ha1 = md5_hex(f"admin:{realm}:{password}")
+    ha2 = md5_hex("DESCRIBE:rtsp://cam/live")
+    response = md5_hex(f"{ha1}:{connection.nonce}:{ha2}")
+    return (f'Digest username="admin", realm="{realm}", nonce="{connection.nonce}", '
+            f'uri="rtsp://cam/live", response="{response}"')
+
+
+@pytest.mark.asyncio
+async def test_control_responses_survive_media_overflow():
+    channel = _Channel()
+    client = _RelayClient(channel, max_bytes=100)
+    assert client.offer(b"k" * 60, keyframe=True) == 0
+    client.send(b"RTSP/1.0 200 OK\r\nCSeq: 7\r\n\r\n")
+    # Переполнение очищает медиа, но не ответ на keepalive
+    assert client.offer(b"d" * 60, keyframe=False) == 2
+    assert not client.queue and client.queued_bytes == 0
+    assert list(client.control) == [b"RTSP/1.0 200 OK\r\nCSeq: 7\r\n\r\n"]
+
+    client.offer(b"K" * 10, keyframe=True)
+    writer = asyncio.ensure_future(client.write_loop())
+    await asyncio.sleep(0)
+    client.close()
+    await writer
+    assert channel.written == [b"RTSP/1.0 200 OK\r\nCSeq: 7\r\n\r\n", b"K" * 10]
+
+
+def test_digest_uses_relay_realm():
+    relay = RtspRelay("rtsp://127.0.0.1:554", "admin", "secret")
+    connection = _RelayConnection(relay, _Channel())
+    assert connection._authorized("DESCRIBE", _digest(connection, REALM))
+    # Клиент не выбирает область: ответ для чужой области не принимается
+    assert not connection._authorized("DESCRIBE", _digest(connection, "other"))
+    assert not connection._authorized("DESCRIBE", _digest(connection, REALM, "wrong"))
+    assert connection._authorized("DESCRIBE", "Basic YWRtaW46c2VjcmV0")
+    assert not connection._authorized("DESCRIBE", "Basic YWRtaW46d3Jvbmc=")
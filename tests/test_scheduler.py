@@ -0,0 +1,81 @@
+"""
+Взвешенное разделение соединения между основным потоком и подпотоком
+"""
+import asyncio
+
+import pytest
+
+from agent.networking.scheduler import StreamScheduler
+
+
+async def _queue_fragments(scheduler: StreamScheduler, fragments, order):
+    """Фрагменты (канал, размер) встают в очередь, пока соединение занято"""
+    async def send(channel, nbytes):
+        async with scheduler.slot(channel, nbytes):
+            order.append(channel)
+            await asyncio.sleep(0)
+
+    release = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot(9, 1):
+            await release.wait()
+
+    holding = asyncio.ensure_future(holder())
+    await asyncio.sleep(0)
+    tasks = [asyncio.ensure_future(send(channel, nbytes)) for channel, nbytes in fragments]
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(holding, *tasks)
+
+
+@pytest.mark.asyncio
+async def test_bandwidth_is_shared_by_weight():
+    scheduler = StreamScheduler()
+    scheduler.add_stream(0, "main", 1.0)
+    scheduler.add_stream(1, "sub", 4.0)
+    order = []
+    await _queue_fragments(scheduler, [(0, 1000)] * 20 + [(1, 1000)] * 20, order)
+
+    # Пока у обоих потоков есть фрагменты, подпоток получает 4/5 отправок
+    assert order[:10].count(1) == 8
+    stats = scheduler.get_stats()
+    assert stats["main"]["fragments"] == stats["sub"]["fragments"] == 20
+    assert stats["main"]["waiting"] == stats["sub"]["waiting"] == 0
+
+
+@pytest.mark.asyncio
+async def test_small_fragment_does_not_wait_for_whole_keyframe():
+    scheduler = StreamScheduler()
+    scheduler.add_stream(0, "main", 1.0)
+    scheduler.add_stream(1, "sub", 1.0)
+    order = []
+    # Ключевой кадр основного потока из 8 фрагментов, затем кадр подпотока
+    await _queue_fragments(scheduler, [(0, 16000)] * 8 + [(1, 2000)], order)
+    assert order.index(1) <= 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_stall_queue():
+    scheduler = StreamScheduler()
+    order = []
+
+    async def send(channel):
+        async with scheduler.slot(channel, 100):
+            order.append(channel)
+
+    release = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot(0, 100):
+            await release.wait()
+
+    holding = asyncio.ensure_future(holder())
+    await asyncio.sleep(0)
+    cancelled = asyncio.ensure_future(send(1))
+    waiting = asyncio.ensure_future(send(2))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    release.set()
+    await asyncio.wait_for(asyncio.gather(holding, waiting), 1)
+    assert order == [2]
@@ -0,0 +1,99 @@
+"""
+Кэш описаний потоков: одновременная проверка и разрешение из SDP
+"""
+import asyncio
+import base64
+
+import pytest
+
+from agent.streaming.rtsp_client import parse_sdp
+from agent.streaming.sdp_cache import SdpCache, parse_resolution
+
+
+def _ue(value: int) -> str:
+    code = bin(value + 1)[2:]
+    return "0" * (len(code) - 1) + code
+
+
+def _h264_sps_1080p() -> bytes:
+    """SPS Baseline 1920x1088 с обрезкой 8 строк снизу"""
+    bits = "".join([
+        f"{0x67:08b}", f"{66:08b}", "0" * 8, f"{40:08b}",
+        _ue(0), _ue(0), _ue(2), _ue(1), "0",
+        _ue(119), _ue(67), "1", "1",
+        "1", _ue(0), _ue(0), _ue(0), _ue(4),
+        "0", "1",
+    ])
+    bits += "0" * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+
+def _sdp(fmtp: str = "", extra: str = "") -> str:
+    return ("v=0\r\nm=video 0 RTP/AVP 96\r\na=rtpmap:96 H264/90000\r\n"
+            f"a=fmtp:96 packetization-mode=1{fmtp}\r\n{extra}a=control:track1\r\n")
+
+
+def test_resolution_from_sps_and_sdp_attributes():
+    sps = base64.b64encode(_h264_sps_1080p()).decode()
+    description = parse_sdp(_sdp(f";sprop-parameter-sets={sps},aM48gA=="))
+    assert parse_resolution(description) == (1920, 1080)
+
+    description = parse_sdp(_sdp(extra="a=x-dimensions:1280,720\r\n"))
+    assert parse_resolution(description) == (1280, 720)
+    assert parse_resolution(parse_sdp(_sdp())) is None
+
+
+class _SlowCamera:
+    """RTSP сервер, отвечающий на каждый запрос с задержкой"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.describes = 0
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            lines = []
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                lines.append(line.decode().strip())
+            if not lines:
+                writer.close()
+                return
+            cseq = next(line.split(":")[1].strip() for line in lines if line.startswith("CSeq"))
+            await asyncio.sleep(self.delay)
+            body = b""
+            headers = [f"CSeq: {cseq}"]
+            if lines[0].startswith("DESCRIBE"):
+                self.describes += 1
+                body = _sdp().encode()
+                headers += ["Content-Type: application/sdp", f"Content-Length: {len(body)}"]
+            writer.write(("RTSP/1.0 200 OK\r\n" + "\r\n".join(headers) + "\r\n\r\n").encode()
+                         + body)
+            await writer.drain()
+
+
+@pytest.mark.asyncio
+async def test_streams_are_probed_concurrently_and_cached():
+    camera = _SlowCamera(delay=0.2)
+    server = await asyncio.start_server(camera.serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    urls = [f"rtsp://127.0.0.1:{port}/main", f"rtsp://127.0.0.1:{port}/sub",
+            "rtsp://127.0.0.1:1/closed"]
+    cache = SdpCache()
+    try:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await cache.probe(urls, "admin", "admin", timeout=2.0)
+        # Два запроса по 0.2 с на поток; по очереди было бы не меньше 0.8 с
+        assert loop.time() - started < 0.7
+        assert results[urls[0]].codec == "H264" and results[urls[1]].codec == "H264"
+        assert results[urls[2]] is None
+        assert cache.stats["probe_errors"] == 1
+
+        # Описание уже в кэше: сессия агента по тому же URL обходится без DESCRIBE
+        await cache.probe(urls[:2], "admin", "admin")
+        assert camera.describes == 2
+        assert cache.description(urls[0]) is results[urls[0]].description
+        assert cache.description("rtsp://10.0.0.2:554/main") is None
+        assert cache.stats["hits"] == cache.stats["misses"] == 1
+    finally:
+        server.close()
@@ -0,0 +1,47 @@
+"""
+Хранилище кадров на время обрыва: закрытие сегментов вне цикла событий
+"""
+import asyncio
+
+import pytest
+
+from agent.streaming.depacketizer import AccessUnit
+from agent.streaming.spool import SegmentSpool
+
+
+def _unit(index: int) -> AccessUnit:
+    return AccessUnit(bytearray(b"%05d" % index * 1000), index, index % 5 == 0, False)
+
+
+@pytest.mark.asyncio
+async def test_rollover_seals_in_executor_under_io_lock(tmp_path):
+    spool = SegmentSpool(str(tmp_path), segment_size=64 * 1024, block_size=4096)
+    finished = []
+    finish_segment = spool._finish_segment
+
+    def checked_finish(writer, write_map):
+        # Закрытие идет в исполнителе и не пересекается со сбросом
+        finished.append((writer.number, spool._io_lock.locked()))
+        finish_segment(writer, write_map)
+
+    spool._finish_segment = checked_finish
+
+    for index in range(20):
+        spool.append(0, _unit(index))
+    # Переход на новый сегмент не закрывает прежний в цикле событий
+    assert spool._sealing and not finished
+    sync = asyncio.ensure_future(spool.sync())
+    for index in range(20, 40):
+        spool.append(0, _unit(index))
+    await sync
+    await spool.seal()
+
+    assert not spool._sealing
+    assert [number for number, _ in finished] == sorted(number for number, _ in finished)
+    assert all(locked for _, locked in finished)
+    timestamps = []
+    while (record := spool.read()) is not None:
+        timestamps.append(record.unit.timestamp)
+        spool.commit()
+    assert timestamps == list(range(40))
+    await spool.close()
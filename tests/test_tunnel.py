@@ -0,0 +1,209 @@
+"""
+Туннель от облачного сервера до порта RTSP камеры
+"""
+import asyncio
+import json
+import socket
+import time
+
+import pytest
+import uvicorn
+from fastapi.testclient import TestClient
+
+from agent.core.agent import TunnelConnection
+from agent.networking.tunnel_mux import TunnelChannel, TunnelMultiplexer, pipe
+from server import CloudServer
+
+RTSP_REPLY = b"RTSP/1.0 200 OK\r\nCSeq: 1\r\nPublic: OPTIONS, DESCRIBE\r\n\r\n"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _camera(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """RTSP сервер камеры: ответ на запрос до пустой строки"""
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    writer.write(RTSP_REPLY)
+    await writer.drain()
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_server_opens_channel_to_camera_rtsp_port():
+    camera = await asyncio.start_server(_camera, "127.0.0.1", 0)
+    camera_port = camera.sockets[0].getsockname()[1]
+
+    cloud = CloudServer(host="127.0.0.1", port=_free_port())
+    server = uvicorn.Server(uvicorn.Config(cloud.app, host="127.0.0.1", port=cloud.port,
+                                           log_level="warning"))
+    serving = asyncio.ensure_future(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    connection = TunnelConnection(f"ws://127.0.0.1:{cloud.port}/agent", "token", "cam-1",
+                                  tunnel_ports=[camera_port], timeout=5)
+    try:
+        await connection.register()
+        await connection.establish_tunnel()
+
+        # Порт выдан сервером при регистрации, а не взят из конфигурации агента
+        tunnel = cloud.tunnels["cam-1"]
+        assert connection.tunnel_port == tunnel.port != 8554
+        while not tunnel.ports:
+            await asyncio.sleep(0.01)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", tunnel.port)
+        writer.write(b"OPTIONS rtsp://127.0.0.1/ RTSP/1.0\r\nCSeq: 1\r\n\r\n")
+        await writer.drain()
+        reply = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+
+        assert reply == RTSP_REPLY
+        assert tunnel.stats["connections"] == 1
+        assert connection.mux.stats["channels_opened"] == 1
+    finally:
+        await connection.close()
+        await asyncio.gather(*(tunnel.close() for tunnel in cloud.tunnels.values()))
+        server.should_exit = True
+        await serving
+        camera.close()
+
+
+class _TransportClosed(Exception):
+    """Ошибка транспорта, не ConnectionError (как websockets ConnectionClosed)"""
+
+
+@pytest.mark.asyncio
+async def test_pipe_closes_both_ends_when_tunnel_drops():
+    """Обрыв транспорта при возврате кредита закрывает канал и сокет"""
+    async def send_frame(frame: bytes):
+        raise _TransportClosed("transport closed")
+
+    accepted = asyncio.get_running_loop().create_future()
+    local = await asyncio.start_server(lambda r, w: accepted.set_result((r, w)),
+                                       "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection("127.0.0.1",
+                                                   local.sockets[0].getsockname()[1])
+    peer_reader, peer_writer = await accepted
+
+    mux = TunnelMultiplexer(send_frame, initiator=True, window=1024)
+    channel = TunnelChannel(mux, 1, 554)
+    mux.channels[channel.id] = channel
+    # Больше половины окна: чтение вернет кредит через оборванный транспорт
+    channel._on_data(memoryview(b"x" * 1024))
+
+    await asyncio.wait_for(pipe(channel, reader, writer), 5)
+
+    assert channel.reset
+    assert channel.id not in mux.channels
+    assert await asyncio.wait_for(peer_reader.read(), 5) == b""
+    peer_writer.close()
+    local.close()
+
+
+async def _linked_pair(window: int = 1024, max_frame: int = 256):
+    """Два мультиплексора, связанных напрямую; канал сервера и канал агента"""
+    accepted: asyncio.Queue = asyncio.Queue()
+
+    async def to_agent(frame: bytes):
+        agent.feed_frame(frame)
+
+    async def to_server(frame: bytes):
+        server.feed_frame(frame)
+
+    server = TunnelMultiplexer(to_agent, initiator=True, window=window, max_frame=max_frame)
+    agent = TunnelMultiplexer(to_server, allowed_ports=[554], window=window,
+                              max_frame=max_frame, handlers={554: accepted.put})
+    channel = await server.open_channel(554)
+    return server, agent, channel, await accepted.get()
+
+
+@pytest.mark.asyncio
+async def test_writer_waits_for_credit_from_reader():
+    server, agent, channel, remote = await _linked_pair(window=1024, max_frame=256)
+    writing = asyncio.ensure_future(channel.write(b"x" * 1500))
+    await asyncio.sleep(0.01)
+    # Окно получателя выбрано, остаток ждет кредита
+    assert not writing.done()
+    assert server.stats["bytes_sent"] == 1024
+
+    received = b""
+    while len(received) < 1500:
+        received += await remote.read()
+    await asyncio.wait_for(writing, 1)
+    assert received == b"x" * 1500
+    assert agent.stats["bytes_received"] == 1500
+
+
+@pytest.mark.asyncio
+async def test_fin_half_closes_and_releases_channel():
+    server, agent, channel, remote = await _linked_pair()
+    await channel.write_eof()
+    assert await remote.read() == b""
+    # Полузакрытый канал еще пишет в обратную сторону
+    await remote.write(b"reply")
+    assert bytes(await channel.read()) == b"reply"
+    assert channel.id in server.channels and remote.id in agent.channels
+
+    await remote.write_eof()
+    assert await channel.read() == b""
+    assert not server.channels and not agent.channels
+    with pytest.raises(ConnectionResetError):
+        await channel.write(b"late")
+
+
+@pytest.mark.asyncio
+async def test_rst_aborts_blocked_writer_on_other_side():
+    server, agent, channel, remote = await _linked_pair(window=256, max_frame=256)
+    writing = asyncio.ensure_future(channel.write(b"x" * 512))
+    await asyncio.sleep(0.01)
+    await remote.abort()
+    with pytest.raises(ConnectionResetError):
+        await asyncio.wait_for(writing, 1)
+    assert channel.reset and remote.reset
+    assert not server.channels and not agent.channels
+
+
+@pytest.mark.asyncio
+async def test_channel_to_disallowed_port_is_reset():
+    async def to_agent(frame: bytes):
+        agent.feed_frame(frame)
+
+    async def to_server(frame: bytes):
+        server.feed_frame(frame)
+
+    server = TunnelMultiplexer(to_agent, initiator=True)
+    agent = TunnelMultiplexer(to_server, allowed_ports=[554])
+    channel = await server.open_channel(22)
+    assert await asyncio.wait_for(channel.read(), 1) == b""
+    assert channel.reset
+    assert agent.stats["channels_rejected"] == 1
+
+
+def test_tunnel_ports_closed_after_session_grace():
+    cloud = CloudServer(session_grace=60)
+    with TestClient(cloud.app) as client:
+        for agent_id in ("gone", "back"):
+            with client.websocket_connect(f"/agent/{agent_id}") as agent:
+                agent.send_text(json.dumps({"type": "register", "data": {}}))
+                agent.receive_text()
+        while any(cloud.agents[agent_id].status != "disconnected" for agent_id in ("gone", "back")):
+            time.sleep(0.01)
+        port = cloud.tunnels["gone"].port
+
+        with client.websocket_connect("/agent/back") as agent:
+            # Вернувшийся за время сессии агент ее сохраняет
+            agent.portal.call(cloud._end_sessions, time.monotonic() + 61)
+
+            assert set(cloud.tunnels) == {"back"}
+            assert set(cloud.agent_sessions) == {"back"}
+            assert set(cloud.sessions.values()) == {"back"}
+            assert "gone" not in cloud.media_sequences
+            assert "gone" not in cloud.heartbeat_timeouts
+            assert cloud.get_statistics()["ended_sessions"] == 1
+            with pytest.raises(ConnectionRefusedError):
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк раздачи медиа зрителям (cloud-server/media_hub.py)
+
+Один поток агента публикует кадры видео (ключевой кадр раз в GOP) с
+максимальной скоростью, на него подписаны N зрителей. Быстрые зрители
+забирают кадры сразу, медленные тратят slow_delay на кадр и отстают.
+Для сравнения та же раздача с копией кадра в неограниченную очередь
+каждого зрителя.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-server"))
+
+from media_hub import FLAG_AU_END, FLAG_AU_START, FLAG_KEYFRAME, MEDIA, MEDIA_HEADER, MediaHub
+
+
+def make_units(count: int, gop: int, size: int, keyframe_size: int):
+    """(флаги, данные) кадров: ключевой кадр в начале каждого GOP"""
+    delta = memoryview(b"\x00" * size)
+    key = memoryview(b"\x01" * keyframe_size)
+    units = []
+    for index in range(count):
+        flags = FLAG_AU_START | FLAG_AU_END
+        if index % gop == 0:
+            units.append((flags | FLAG_KEYFRAME, key))
+        else:
+            units.append((flags, delta))
+    return units
+
+
+async def run_hub(units, viewers: int, slow: int, slow_delay: float, max_units: int):
+    hub = MediaHub(max_units=max_units)
+    subscriptions = [hub.subscribe("agent") for _ in range(viewers)]
+    peak_bytes = 0
+
+    async def consume(subscription, delay: float):
+        while await subscription.get() is not None:
+            if delay:
+                await asyncio.sleep(delay)
+
+    consumers = [asyncio.ensure_future(consume(subscription, slow_delay if index < slow else 0))
+                 for index, subscription in enumerate(subscriptions)]
+    await asyncio.sleep(0)
+
+    publish_time = 0.0
+    for timestamp, (flags, data) in enumerate(units):
+        publish_started = time.perf_counter()
+        hub.publish("agent", data, timestamp=timestamp, flags=flags)
+        publish_time += time.perf_counter() - publish_started
+        if timestamp % 64 == 0:
+            # Очереди делят буферы кадров: считается каждый буфер один раз
+            frames = {id(unit.frame): len(unit.frame)
+                      for subscription in subscriptions for unit in subscription.queue}
+            peak_bytes = max(peak_bytes, sum(frames.values()))
+        await asyncio.sleep(0)  # Зрители забирают кадры между публикациями
+
+    fast = subscriptions[slow:]
+    result = {
+        "publish_us": publish_time / len(units) * 1e6,
+        "fast_delivered": min((s.delivered + len(s.queue) for s in fast), default=0),
+        "slow_skips": sum(s.skips for s in subscriptions[:slow]),
+        "peak_mib": peak_bytes / 1024 / 1024
+    }
+    for subscription in subscriptions:
+        hub.unsubscribe(subscription)
+    await asyncio.gather(*consumers)
+    return result
+
+
+async def run_copy(units, viewers: int, slow: int, slow_delay: float):
+    """Копия кадра в неограниченную очередь каждого зрителя"""
+    queues = [asyncio.Queue() for _ in range(viewers)]
+    peak_bytes = 0
+    queued = [0] * viewers
+
+    async def consume(index: int, delay: float):
+        while True:
+            frame = await queues[index].get()
+            if frame is None:
+                return
+            queued[index] -= len(frame)
+            if delay:
+                await asyncio.sleep(delay)
+
+    consumers = [asyncio.ensure_future(consume(index, slow_delay if index < slow else 0))
+                 for index in range(viewers)]
+    await asyncio.sleep(0)
+
+    publish_time = 0.0
+    for timestamp, (flags, data) in enumerate(units):
+        publish_started = time.perf_counter()
+        for index, queue in enumerate(queues):
+            frame = MEDIA_HEADER.pack(MEDIA, flags, 0, timestamp, timestamp) + data
+            queued[index] += len(frame)
+            queue.put_nowait(frame)
+        publish_time += time.perf_counter() - publish_started
+        if timestamp % 64 == 0:
+            peak_bytes = max(peak_bytes, sum(queued))
+        await asyncio.sleep(0)
+
+    for queue in queues:
+        queue.put_nowait(None)
+    await asyncio.gather(*consumers)
+    return {"publish_us": publish_time / len(units) * 1e6, "peak_mib": peak_bytes / 1024 / 1024}
+
+
+async def run(args):
+    units = make_units(args.frames, args.gop, args.size, args.keyframe_size)
+    print(f"Кадров: {args.frames}, GOP: {args.gop}, кадр {args.size // 1024} KiB, "
+          f"ключевой {args.keyframe_size // 1024} KiB, очередь зрителя {args.max_units} кадров")
+    print(f"{'зрителей':>9} {'медл.':>6} | {'хаб мкс/кадр':>13} {'пик MiB':>8} "
+          f"{'быстрым':>8} {'пропусков':>10} | {'копии мкс/кадр':>15} {'пик MiB':>8}")
+    for viewers in args.viewers:
+        slow = int(viewers * args.slow_share)
+        hub = await run_hub(units, viewers, slow, args.slow_delay, args.max_units)
+        copy = await run_copy(units, viewers, slow, args.slow_delay)
+        print(f"{viewers:>9} {slow:>6} | {hub['publish_us']:>13.1f} {hub['peak_mib']:>8.1f} "
+              f"{hub['fast_delivered']:>8} {hub['slow_skips']:>10} | "
+              f"{copy['publish_us']:>15.1f} {copy['peak_mib']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк раздачи медиа зрителям")
+    parser.add_argument("--viewers", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--frames", type=int, default=1500)
+    parser.add_argument("--gop", type=int, default=30)
+    parser.add_argument("--size", type=int, default=16 * 1024, help="Размер кадра, байт")
+    parser.add_argument("--keyframe-size", type=int, default=128 * 1024,
+                        help="Размер ключевого кадра, байт")
+    parser.add_argument("--max-units", type=int, default=64, help="Очередь зрителя, кадров")
+    parser.add_argument("--slow-share", type=float, default=0.1, help="Доля медленных зрителей")
+    parser.add_argument("--slow-delay", type=float, default=0.002,
+                        help="Время медленного зрителя на кадр, с")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
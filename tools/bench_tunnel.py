@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк мультиплексированного туннеля на loopback
+
+Сторона сервера и сторона агента соединены WebSocket на 127.0.0.1, за
+агентом работают локальные TCP серверы, изображающие камеру: источник
+объемного потока (RTSP/HTTP) и эхо-сервер для измерения задержки.
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import websockets
+
+from agent.networking.tunnel_mux import TunnelMultiplexer
+
+CHUNK = b"\x00" * 64 * 1024
+
+
+async def bulk_source(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Источник: отдает запрошенное число мегабайт и закрывает поток"""
+    megabytes = int((await reader.readline()).decode())
+    for _ in range(megabytes * 16):
+        writer.write(CHUNK)
+        await writer.drain()
+    writer.close()
+
+
+async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Эхо-сервер для измерения задержки"""
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def read_all(channel) -> int:
+    total = 0
+    while True:
+        data = await channel.read()
+        if not data:
+            return total
+        total += len(data)
+
+
+async def pull(mux: TunnelMultiplexer, port: int, megabytes: int) -> int:
+    channel = await mux.open_channel(port)
+    await channel.write(f"{megabytes}\n".encode())
+    await channel.write_eof()
+    return await read_all(channel)
+
+
+async def ping(mux: TunnelMultiplexer, port: int, count: int):
+    """Задержка прохождения 64 байт туда и обратно"""
+    channel = await mux.open_channel(port)
+    samples = []
+    payload = b"x" * 64
+    for _ in range(count):
+        started = time.perf_counter()
+        await channel.write(payload)
+        received = 0
+        while received < len(payload):
+            received += len(await channel.read())
+        samples.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(0.005)
+    await channel.write_eof()
+    return samples
+
+
+def report_latency(title: str, samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{title:<40} p50={statistics.median(samples):7.2f} ms  "
+          f"p99={p99:7.2f} ms  n={len(samples)}")
+
+
+async def run(args):
+    bulk_server = await asyncio.start_server(bulk_source, "127.0.0.1", 0)
+    echo_server = await asyncio.start_server(echo, "127.0.0.1", 0)
+    bulk_port = bulk_server.sockets[0].getsockname()[1]
+    echo_port = echo_server.sockets[0].getsockname()[1]
+
+    server_mux = None
+    connected = asyncio.Event()
+
+    async def tunnel_server(websocket):
+        # Сторона туннельного сервера: открывает каналы к камере
+        nonlocal server_mux
+        server_mux = TunnelMultiplexer(websocket.send, initiator=True,
+                                       window=args.window)
+        connected.set()
+        async for message in websocket:
+            server_mux.feed_frame(message)
+
+    ws_server = await websockets.serve(tunnel_server, "127.0.0.1", 0, max_size=None)
+    ws_port = list(ws_server.sockets)[0].getsockname()[1]
+
+    # Сторона агента
+    websocket = await websockets.connect(f"ws://127.0.0.1:{ws_port}", max_size=None)
+    agent_mux = TunnelMultiplexer(websocket.send, allowed_ports=[bulk_port, echo_port],
+                                  window=args.window)
+
+    async def agent_receive():
+        async for message in websocket:
+            agent_mux.feed_frame(message)
+
+    receive_task = asyncio.ensure_future(agent_receive())
+    await connected.wait()
+
+    print(f"Окно канала: {args.window // 1024} KiB, объем на канал: {args.megabytes} MiB")
+
+    report_latency("Задержка, туннель без нагрузки",
+                   await ping(server_mux, echo_port, args.pings))
+
+    for channels in args.channels:
+        started = time.perf_counter()
+        totals = await asyncio.gather(*[
+            pull(server_mux, bulk_port, args.megabytes) for _ in range(channels)
+        ])
+        elapsed = time.perf_counter() - started
+        megabytes = sum(totals) / 1024 / 1024
+        print(f"Пропускная способность, каналов: {channels:<3}     "
+              f"{megabytes / elapsed:8.1f} MiB/s  ({megabytes:.0f} MiB за {elapsed:.2f} s)")
+
+    # Задержка интерактивного канала при параллельной объемной передаче
+    bulk = asyncio.ensure_future(asyncio.gather(*[
+        pull(server_mux, bulk_port, args.megabytes * 4) for _ in range(4)
+    ]))
+    samples = await ping(server_mux, echo_port, args.pings)
+    await bulk
+    report_latency("Задержка при 4 объемных каналах", samples)
+
+    # Ожидание полузакрытия каналов перед остановкой серверов
+    while agent_mux.channels:
+        await asyncio.sleep(0.01)
+    receive_task.cancel()
+    await websocket.close()
+    ws_server.close()
+    bulk_server.close()
+    echo_server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк туннеля")
+    parser.add_argument("--megabytes", type=int, default=32, help="Объем на канал, MiB")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--window", type=int, default=256 * 1024, help="Окно канала, байт")
+    parser.add_argument("--pings", type=int, default=200)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -138,12 +138,12 @@ class CameraAgentBuilder:
         (output_path / "agent" / "streaming").mkdir(parents=True, exist_ok=True)
         (output_path / "agent" / "networking").mkdir(parents=True, exist_ok=True)
         
-        # Копирование базовых файлов
-        shutil.copy2(
-            self.agent_root / "core" / "agent.py",
-            output_path / "agent" / "core"
-        )
-        
+        # Копирование модулей агента (platform_specific.py генерируется отдельно)
+        for package in ["core", "platform", "streaming", "networking"]:
+            for module in (self.agent_root / package).glob("*.py"):
+                if module.name != "__init__.py":
+                    shutil.copy2(module, output_path / "agent" / package)
+
         # Создание __init__.py файлов
         for init_file in [
             output_path / "agent" / "__init__.py",
@@ -166,9 +166,11 @@ class CameraAgentBuilder:
 """
 
 import os
-import subprocess
 import logging
-from typing import Dict, Any
+from typing import Any, Dict, List, Optional
+
+from agent.core.commands import CommandRunner, apply_sysctl
+from agent.streaming.sdp_cache import sdp_cache
 
 logger = logging.getLogger(__name__)
 
@@ -178,16 +180,22 @@ class PlatformSpecific:
     def __init__(self):
         self.camera_model = "{camera_model}"
         self.config = {camera_config}
+        # Команды не блокируют цикл событий агента (heartbeat, видео)
+        self.commands = CommandRunner(concurrency=2, timeout=10)
     
-    async def init_camera_interface(self):
-        """Инициализация интерфейса камеры"""
+    async def init_camera_interface(self, username: str = "admin", password: str = "admin",
+                                    urls: Optional[List[str]] = None):
+        """Инициализация интерфейса камеры
+        
+        urls - RTSP URL потоков, как их открывает агент (AgentConfig.camera_rtsp_urls)
+        """
         logger.info(f"Инициализация интерфейса камеры {{self.camera_model}}")
         
         # Настройка RTSP сервера камеры
         await self._configure_rtsp_server()
         
         # Проверка доступности потоков
-        await self._check_stream_availability()
+        await self._check_stream_availability(urls or self.camera_rtsp_urls(), username, password)
     
     async def init_network_stack(self):
         """Инициализация сетевого стека"""
@@ -202,33 +210,45 @@ class PlatformSpecific:
     async def _configure_rtsp_server(self):
         """Настройка RTSP сервера"""
         try:
-            # Команды для настройки RTSP сервера на камере
+            # Независимые команды настройки RTSP сервера на камере
+            # выполняются одновременно; ошибки журналирует CommandRunner
             rtsp_commands = [
                 "echo 'RTSP сервер настроен'",
                 # Добавить реальные команды для конкретной камеры
             ]
+            await self.commands.run_all(rtsp_commands)
             
-            for cmd in rtsp_commands:
-                result = subprocess.run(cmd, shell=True, capture_output=True)
-                if result.returncode != 0:
-                    logger.warning(f"Команда {{cmd}} завершилась с ошибкой")
-                    
         except Exception as e:
             logger.error(f"Ошибка настройки RTSP сервера: {{e}}")
     
-    async def _check_stream_availability(self):
-        """Проверка доступности потоков"""
-        stream_paths = self.config.get("stream_paths", [])
-        
-        for path in stream_paths:
-            rtsp_url = f"rtsp://localhost{{self.config['rtsp_port']}}{{path}}"
-            logger.info(f"Проверка потока: {{rtsp_url}}")
-            # TODO: Реализовать проверку доступности потока
+    def camera_rtsp_urls(self, camera_ip: str = "127.0.0.1") -> List[str]:
+        """RTSP URL потоков в том же виде, что и AgentConfig.camera_rtsp_urls"""
+        return [
+            f"rtsp://{{camera_ip}}:{{self.config['rtsp_port']}}{{path}}"
+            for path in self.config.get("stream_paths") or ["/"]
+        ]
+    
+    async def _check_stream_availability(self, urls: List[str], username: str = "admin",
+                                         password: str = "admin"):
+        """Проверка доступности потоков
+        
+        Все URL проверяются одновременно (OPTIONS и DESCRIBE с коротким
+        таймаутом); описания попадают в кэш по тем же URL, с которыми
+        агент открывает сессии, и сессии начинаются без DESCRIBE.
+        """
+        results = await sdp_cache.probe(urls, username, password, timeout=2.0)
+        for url, info in results.items():
+            if info:
+                resolution = "x".join(map(str, info.resolution)) if info.resolution else "?"
+                logger.info(f"Поток {{url}}: {{info.codec}} {{resolution}}")
+            else:
+                logger.warning(f"Поток {{url}} недоступен")
     
     async def _configure_network_interfaces(self):
         """Настройка сетевых интерфейсов"""
+        # Параметры ядра пишутся прямо в /proc/sys, без запуска sysctl
+        apply_sysctl(self.config.get("sysctl", {{}}))
         # TODO: Реализовать настройку сетевых интерфейсов
-        pass
     
     async def _configure_firewall(self):
         """Настройка firewall"""